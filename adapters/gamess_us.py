@@ -1,4 +1,5 @@
 # -*- coding:utf-8 mode:python; tab-width:4; indent-tabs-mode:nil; py-indent-offset:4 -*-
+import collections
 import hashlib
 import uuid
 
@@ -66,7 +67,7 @@ class GAMESSUSJob(cpinterface.Job):
         super(GAMESSUSJob, self).extract_geometry(data, options=options)
         #after standard geometry extraction, rescale the first (special)
         #GAMESS geometry which is in bohr instead of angstroms
-        for j in range(len(self.system.atoms)):
+        for j in range(self.system.natoms):
             for k in [1, 2, 3]:
                 self.geometry_history[0][j][k] = self.bohr_to_angstrom(self.geometry_history[0][j][k])
 
@@ -113,7 +114,169 @@ class GAMESSUSJob(cpinterface.Job):
             self.extract_geometry(self.logdata)
             self.runstate = "complete"
 
+def wrap_tokens(tokens, maxlen=70):
+    """Pack space-separated tokens into pieces that can be joined with
+    "\n " into lines of at most maxlen characters (a single token longer
+    than that gets a line to itself). Pieces after the first begin with a
+    space, so continuation lines are indented.
+
+    :param tokens: tokens of one directive, e.g. text.split(" ")
+    :type tokens : list
+    :param maxlen: maximum line length to generate
+    :type maxlen : int
+    :return: pieces
+    :rtype : list
+    """
+
+    pieces = []
+    current = []
+    #the first line is the bare piece; later lines get a joining space
+    #and a leading space
+    length = -1
+    for token in tokens:
+        size = len(token) + 1
+        if current and length + size > maxlen:
+            pieces.append(" ".join(current))
+            current = [""]
+            length = 1
+
+        current.append(token)
+        length += size
+
+    if current:
+        pieces.append(" ".join(current))
+
+    return pieces
+
+class Namelist(object):
+    """A GAMESS-US input group such as $CONTRL, kept as ordered
+    keyword=value entries and written wrapped to fit the 80 character line
+    limit of GAMESS-US.
+    """
+
+    def __init__(self, name, entries=()):
+        """:param name: group name without the $, e.g. "CONTRL"
+        :type name : str
+        :param entries: initial (keyword, value) pairs
+        :type entries : list
+        """
+
+        self.name = name
+        self.entries = collections.OrderedDict(entries)
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+
+    @classmethod
+    def find(cls, data, name):
+        """Read the first group with the given name from input text. Values
+        continued over several comma separated tokens, as tokens() writes
+        lists, are read back as lists of strings; other values are strings.
+
+        :param data: GAMESS-US input text
+        :type data : str
+        :param name: group name without the $, e.g. "CONTRL"
+        :type name : str
+        :return: (group, region_start_index, region_end_index)
+        :rtype : tuple
+        """
+
+        begin = data.find("$" + name)
+        if begin == -1:
+            raise ValueError("No ${0} group found".format(name))
+
+        end = data.find("$END", begin)
+        if end == -1:
+            raise ValueError("No $END terminating ${0} group".format(name))
+
+        end += len("$END")
+        entries = []
+        for token in data[begin:end].split()[1:-1]:
+            if entries and entries[-1][1][-1].endswith(","):
+                entries[-1][1].append(token)
+                continue
+
+            if "=" not in token:
+                raise ValueError("Expected keyword=value in ${0} group, got {1}".format(name, repr(token)))
+            key, value = token.split("=", 1)
+            entries.append((key, [value]))
+
+        entries = [(key, values[0]) if len(values) == 1
+                   else (key, [v.rstrip(",") for v in values])
+                   for key, values in entries]
+
+        #the region includes the blank first column, as write() does
+        if begin > 0 and data[begin - 1] == " ":
+            begin -= 1
+
+        return cls(name, entries), begin, end
+
+    def tokens(self):
+        """Get the space-separated tokens of the group. List values are
+        written comma separated, e.g. basnam(1)=H0, O0, H0.
+
+        :return: tokens including the $name and $END markers
+        :rtype : list
+        """
+
+        tokens = ["", "$" + self.name]
+        for key, value in self.entries.items():
+            if isinstance(value, (list, tuple)):
+                values = [str(v) + "," for v in value]
+                values[-1] = values[-1][:-1]
+                values[0] = "{0}={1}".format(key, values[0])
+                tokens += values
+            else:
+                tokens.append("{0}={1}".format(key, value))
+
+        tokens.append("$END")
+        return tokens
+
+    def write(self, maxlen=70):
+        """Write the group as wrapped GAMESS-US input.
+
+        :param maxlen: maximum line length to generate
+        :type maxlen : int
+        :return: group text
+        :rtype : str
+        """
+
+        return "\n ".join(wrap_tokens(self.tokens(), maxlen))
+
 class GAMESSUS(cpinterface.MolecularCalculator):
+    #semiempirical elements are taken from the GAMESS manual, "MOPAC
+    #Calculations Within GAMESS",
+    #http://www.msg.ameslab.gov/gamess/GAMESS_Manual/refs.pdf
+    supported_elements = {"semiempirical:pm3" : ["H", "Li", "Be", "C", "N",
+                                                 "O", "F", "Na", "Mg", "Al",
+                                                 "Si", "P", "S", "Cl", "K",
+                                                 "Ca", "Zn", "Ga", "Ge", "As",
+                                                 "Se", "Br", "Cd", "In", "Sn",
+                                                 "Sb", "Te", "I", "Hg", "Tl",
+                                                 "Pb", "Bi"],
+                          "semiempirical:am1" : ["H", "B", "C", "N", "O", "F",
+                                                 "Na", "Mg", "Al", "Si", "P",
+                                                 "S", "Cl", "K", "Ca", "Zn",
+                                                 "Ge", "Br", "Sn", "I", "Hg"],
+                          "semiempirical:mndo" : ["H", "Li", "B", "C", "N",
+                                                  "O", "F", "Al", "Si", "P",
+                                                  "S", "Cl", "Zn", "Ge", "Br",
+                                                  "Sn", "I", "Hg", "Pb"]}
+
+    #RM1 has its own parameters for C, N, O, F, P, S, Cl, Br, I;
+    #otherwise AM1 parameters are used
+    supported_elements["semiempirical:rm1"] = supported_elements["semiempirical:am1"]
+
+    #Hartree-Fock is limited only by the basis set
+    basis_set_methods = ("hf:rhf", "hf:uhf", "hf:rohf")
+    supported_elements.update(dict.fromkeys(basis_set_methods,
+                                            cpinterface.basis_set_elements))
+
+    basis_format = "gamess-us"
+
     def __init__(self, *args, **kw):
         super(GAMESSUS, self).__init__(*args, **kw)
         
@@ -123,44 +286,6 @@ class GAMESSUS(cpinterface.MolecularCalculator):
         self.coordinate_choices = ["cartesian", "zmatrix"]
         self.references = ["RHF", "ROHF", "UHF"]
 
-    def check_element_support(self, system, method):
-        """Check that the chosen semiempirical method is parameterized for
-        all the elements in the system. Supported elements are taken from
-        the GAMESS manual, "MOPAC Calculations Within GAMESS",
-        http://www.msg.ameslab.gov/gamess/GAMESS_Manual/refs.pdf
-
-        :param system: molecular system
-        :type system : geoprep.System
-        :param method: name of method
-        :type method : str
-        :return: elements from system
-        """
-
-        emap = {"semiempirical:pm3" : ["H", "Li", "Be", "C", "N", "O", "F",
-                                       "Na", "Mg", "Al", "Si", "P", "S", "Cl",
-                                       "K", "Ca", "Zn", "Ga", "Ge", "As", "Se",
-                                       "Br", "Cd", "In", "Sn", "Sb", "Te",
-                                       "I", "Hg", "Tl", "Pb", "Bi"],
-                "semiempirical:am1" : ["H", "B", "C", "N", "O", "F", "Na",
-                                       "Mg", "Al", "Si", "P", "S", "Cl",
-                                       "K", "Ca", "Zn", "Ge", "Br", "Sn", "I",
-                                       "Hg"],
-                "semiempirical:mndo" : ["H", "Li", "B", "C", "N", "O", "F",
-                                        "Al", "Si", "P", "S", "Cl", "Zn",
-                                        "Ge", "Br", "Sn", "I", "Hg", "Pb"]}
-
-        #RM1 has its own parameters for C, N, O, F, P, S, Cl, Br, I;
-        #otherwise AM1 parameters are used
-        emap["semiempirical:rm1"] = emap["semiempirical:am1"]
-
-        elements = system.elements
-        allowed = emap[method]
-        for e in elements:
-            if e not in allowed:
-                raise ValueError("Element {0} not parameterized for {1}".format(repr(e), repr(method)))
-
-        return elements
-    
     def create_geometry(self, system, options={}):
         """Create input geometry for a subsequent calculation.
 
@@ -271,48 +396,38 @@ class GAMESSUS(cpinterface.MolecularCalculator):
         else:
             raise ValueError("GAMESS-US does not currently support {0}".method)
 
-    def reformat_long_line(self, data, start_marker, end_marker, maxlen=70):
-        """GAMESS-US does not read lines longer than 80 characters. This
-        method breaks up long directives into multiple lines.
-
-        :param data: text of input deck that needs fixing
-        :type data : str
-        :param start_marker: token that marks fixup start, e.g. "$CONTRL"
-        :type start_marker : str
-        :param end_marker: token that marks fixup end, e.g. "$END"
-        :type end_marker : str
-        :param maxlen: maximum line length to generate
-        :type maxlen : int
-        :return: (shortened_line_list, region_start_index, region_end_index)
-        :rtype : tuple
+    def assemble_deck(self, geometry, controls, groups):
+        """Assemble an input deck from the geometry input written by
+        create_geometry. Entries in controls go at the start of its $CONTRL
+        group, and the other groups are inserted right after it.
+
+        :param geometry: input from create_geometry
+        :type geometry : str
+        :param controls: (keyword, value) pairs for $CONTRL
+        :type controls : list
+        :param groups: additional groups, as Namelists or already written text
+        :type groups : list
+        :return: input deck
+        :rtype : str
         """
-            
-        begin_index = data.find(start_marker)
-        end_index = data.find(end_marker) + len(end_marker)
-        inner = data[begin_index : end_index]
-
-        pieces = []
-        current_split = 0
-        last_split = 0
-        while inner:
-            #stop when remainder fits wholly
-            if len(inner) < maxlen:
-                pieces.append(inner)
-                break
-
-            #look for largest split that isn't too large
-            current_split = inner.find(" ", last_split + 1)
-            if current_split >= maxlen or current_split == -1:
-                t = inner[:last_split]
-                pieces.append(t)
-                inner = inner[last_split:]
-                current_split = 0
-                last_split = 0
 
-            else:
-                last_split = current_split
+        contrl, begin, end = Namelist.find(geometry, "CONTRL")
+        entries = controls + contrl.entries.items()
+        contrl = Namelist("CONTRL", entries)
 
-        return pieces, begin_index, end_index
+        #groups follow the whole line holding $CONTRL's $END
+        line_end = geometry.find("\n", end)
+        if line_end == -1:
+            line_end = len(geometry)
+
+        parts = [geometry[:begin], contrl.write(), geometry[end:line_end]]
+        for group in groups:
+            if isinstance(group, Namelist):
+                group = group.write()
+            parts += ["\n", group]
+
+        parts.append(geometry[line_end:])
+        return "".join(parts)
 
     def make_semiempirical_job(self, system, method, runtyp, options={}):
         """Create a semiempirical input specification for a calculation.
@@ -354,28 +469,11 @@ class GAMESSUS(cpinterface.MolecularCalculator):
             self.log("Forcing UHF for multiplicity {0}".format(system.spin))
             reference = "UHF"
 
-        control_options = {"runtyp" : runtyp, "mult" : system.spin,
-                           "icharg" : system.charge, "reference" : reference,
-                           "scf_iterations" : options.get("scf_iterations")}
-            
-        contrl = "SCFTYP={reference} RUNTYP={runtyp} ICHARG={icharg} MULT={mult} MAXIT={scf_iterations} ".format(**control_options)
-        deck = deck.replace("$CONTRL ", "$CONTRL " + contrl)
-
-        pieces, begin, end = self.reformat_long_line(deck, "$CONTRL", "$END")
-        new_contrl = "\n ".join(pieces)
-
-        deck = deck[:begin] + new_contrl + deck[end:]
-        basis = " $BASIS GBASIS={0} $END".format(semethod)
-        lines = deck.split("\n")
-        joblines = []
-        inserted = False
-        for line in lines:
-            joblines.append(line)
-            if "$END" in line and not inserted:
-                inserted = True
-                joblines.append(basis)
-
-        deck = "\n".join(joblines)
+        controls = [("SCFTYP", reference), ("RUNTYP", runtyp),
+                    ("ICHARG", system.charge), ("MULT", system.spin),
+                    ("MAXIT", options.get("scf_iterations"))]
+        basis = Namelist("BASIS", [("GBASIS", semethod)])
+        deck = self.assemble_deck(deck, controls, [basis])
 
         job = GAMESSUSJob(deck=deck, system=system,
                           extras=options.get("extras", {}))
@@ -389,81 +487,86 @@ class GAMESSUS(cpinterface.MolecularCalculator):
         :type system : geoprep.System
         :param options: additional keyword based control options
         :type options : dict
-        :return: ISPHER flag data, assignment array, basis data, comments
+        :return: ISPHER flag data, $BASIS group text, basis data, comments
         :rtype : dict
         """
 
-        defaults = {"basis_format" : "gamess-us"}
+        defaults = {"basis_format" : self.basis_format}
         options = dict(defaults.items() + options.items())
         property_name = options["basis_tag_name"]
-        ubb = {}
-        basis_names = []
         basis_blocks = []
-        comments = []
         bsd = self.get_basis_data(system, options=options)
         data = bsd["data"]
-        if bsd["spherical_or_cartesian"] == "spherical":
+        form = bsd["spherical_or_cartesian"]
+        if form == "spherical":
             ispher = 1
         else:
             ispher = 0
 
         symbols = system.atom_properties("symbols")
-        for j, basis_name in enumerate(system.atom_properties("basis_name")):
-            add_new_block = False
-            element = symbols[j]
-            if element not in ubb:
-                ubb[element] = []
-                
-            basis_element = "{0}:{1}".format(basis_name, element)
-
-            #this (basis, element) pair is new, so add it
-            if basis_element not in ubb[element]:
-                ubb[element].append(basis_element)
-                add_new_block = True
-
-            basis_index = ubb[element].index(basis_element)
-            basis_alias = "{0}{1}".format(element, basis_index)
-            basis_names.append(basis_alias)
-            comment = "{0} {1}".format(element, basis_name)
-            comments.append(comment)
-            
-            if add_new_block:
-                basis_text = data[basis_name][element]
-                extra_comments = []
-                non_comments = []
-                for line in basis_text.split("\n"):
-                    if line.startswith("!"):
-                        extra_comments.append(line)
-                    else:
-                        non_comments.append(line)
-
-                basis_text = "\n".join(non_comments[1:])
-                if extra_comments:
-                    extra_comments[0] = "\n" + extra_comments[0]
-                
-                tpl = "!\t{comment}{extra_comments}\n ${name}\n{data}\n\n $END"
-                block = tpl.format(**{"comment" : comment,
-                                      "extra_comments" : "\n".join(extra_comments),
-                                      "name" : basis_alias,
-                                      "data" : basis_text})
-                basis_blocks.append(block)
+        comments = ["{0} {1}".format(element, basis_name)
+                    for element, basis_name in
+                    zip(symbols, system.atom_properties("basis_name"))]
+
+        basis_names, pairs = self.basis_aliases(system)
+        for basis_alias, basis_name, element in pairs:
+            basis_text = data[basis_name][element]
+            block = self.basis_block(basis_alias, basis_name, element,
+                                     basis_text, form)
+            basis_blocks.append(block)
 
         blocks = "\n".join(basis_blocks)
 
-        indexes = ", ".join(basis_names)
-        bn = " $BASIS basnam(1)={0} $END".format(indexes)
-        pieces, begin, end = self.reformat_long_line(bn, " $BASIS", "$END")
-        new_bn = "\n ".join(pieces)
+        basis = Namelist("BASIS", [("basnam(1)", basis_names)])
 
-        r = {"ispher" : ispher, "basis_control" : new_bn,
+        r = {"ispher" : ispher, "basis_control" : basis.write(),
              "basis_data" : blocks, "comments" : comments}
 
         #set basis tag for each atom
-        system.set_properties(property_name, range(len(system.atoms)),
+        system.set_properties(property_name, range(system.natoms),
                               basis_names)
 
         return r
 
+    def format_basis_block(self, alias, basis_name, element, basis_text,
+                           form):
+        """Format basis data for one element as an inline $alias group,
+        headed by a comment e.g. "H 3-21G" and any comments from the data.
+
+        :param alias: basis alias, e.g. Cl0
+        :type alias : str
+        :param basis_name: basis set name
+        :type basis_name : str
+        :param element: element symbol
+        :type element : str
+        :param basis_text: GAMESS-US format basis data
+        :type basis_text : str
+        :param form: "spherical" or "cartesian" (unused here)
+        :type form : str
+        :return: basis block
+        :rtype : str
+        """
+
+        comment = "{0} {1}".format(element, basis_name)
+        extra_comments = []
+        non_comments = []
+        for line in basis_text.split("\n"):
+            if line.startswith("!"):
+                extra_comments.append(line)
+            else:
+                non_comments.append(line)
+
+        basis_text = "\n".join(non_comments[1:])
+        if extra_comments:
+            extra_comments[0] = "\n" + extra_comments[0]
+
+        tpl = "!\t{comment}{extra_comments}\n ${name}\n{data}\n\n $END"
+        block = tpl.format(**{"comment" : comment,
+                              "extra_comments" : "\n".join(extra_comments),
+                              "name" : alias,
+                              "data" : basis_text})
+        return block
+
     def make_hf_job(self, system, method, runtyp, options={}):
         """Create an input specification for a Hartree-Fock calculation.
         
@@ -505,33 +608,16 @@ class GAMESSUS(cpinterface.MolecularCalculator):
 
         bd = self.prepare_basis_data(system, options=options)
 
-        control_options = {"runtyp" : runtyp, "mult" : system.spin,
-                           "icharg" : system.charge, "reference" : reference,
-                           "scf_iterations" : options.get("scf_iterations"),
-                           "ispher" : bd["ispher"]}
-            
-        contrl = "SCFTYP={reference} RUNTYP={runtyp} ICHARG={icharg} ISPHER={ispher} MULT={mult} MAXIT={scf_iterations} ".format(**control_options)
-        deck = deck.replace("$CONTRL ", "$CONTRL " + contrl)
-
-        pieces, begin, end = self.reformat_long_line(deck, " $CONTRL", "$END")
-        new_contrl = "\n ".join(pieces)
+        controls = [("SCFTYP", reference), ("RUNTYP", runtyp),
+                    ("ICHARG", system.charge), ("ISPHER", bd["ispher"]),
+                    ("MULT", system.spin),
+                    ("MAXIT", options.get("scf_iterations"))]
+        deck = self.assemble_deck(deck, controls, [bd["basis_control"]])
 
-        deck = deck[:begin] + new_contrl + deck[end:]
-        
-        basis = bd["basis_control"]
-        lines = deck.split("\n")
-        joblines = []
-        inserted = False
-        for line in lines:
-            joblines.append(line)
-            if "$END" in line and not inserted:
-                inserted = True
-                joblines.append(basis)
-
-        deck = "\n".join(joblines)
-        deck += "\n!Basis set assignments:\n"
-        deck += "\n".join(["!\t" + x for x in bd["comments"]]) + "\n\n"
-        deck += bd["basis_data"]
+        parts = [deck, "\n!Basis set assignments:\n"]
+        parts += ["!\t" + x + "\n" for x in bd["comments"]]
+        parts += ["\n", bd["basis_data"]]
+        deck = "".join(parts)
 
         job = GAMESSUSJob(deck=deck, system=system)
         return job
@@ -98,6 +98,28 @@ class Mopac7Job(cpinterface.Job):
         self.runstate = "complete"
 
 class Mopac7(cpinterface.MolecularCalculator):
+    #supported elements are taken from section 3.5 of the Mopac7 manual.
+    #MINDO/3 is supported only for certain *pairs* of elements, and the
+    #element check may let bad pairs slip through because it is not
+    #pair-aware.
+    supported_elements = {"semiempirical:mndo" : ["H", "Li", "B", "C", "N",
+                                                  "O", "F", "Al", "Si", "P",
+                                                  "S", "Cl", "Zn", "Ge", "Br",
+                                                  "Sn", "I", "Hg", "Pb"],
+                          "semiempirical:am1" : ["H", "B", "C", "N", "O", "F",
+                                                 "Al", "Si", "P", "S", "Cl",
+                                                 "Zn", "Ge", "Br", "Sn", "I",
+                                                 "Hg"],
+                          "semiempirical:pm3" : ["H", "Be", "C", "N", "O", "F",
+                                                 "Mg", "Al", "Si", "P", "S",
+                                                 "Cl", "Zn", "Ga", "Ge", "As",
+                                                 "Se", "Br", "Cd", "In", "Sn",
+                                                 "Sb", "Te", "I", "Hg", "Tl",
+                                                 "Pb", "Bi"],
+                          "semiempirical:mindo/3" : ["H", "B", "C", "N", "O",
+                                                     "F", "Si", "P", "S",
+                                                     "Cl"]}
+
     def __init__(self, *args, **kw):
         super(Mopac7, self).__init__(*args, **kw)
         
@@ -106,45 +128,6 @@ class Mopac7(cpinterface.MolecularCalculator):
         self.coordinate_choices = ["cartesian", "zmatrix"]
         self.references = ["RHF", "UHF"]
 
-    def check_element_support(self, system, method):
-        """Check that the chosen semiempirical method is parameterized for
-        all the elements in the system. Supported elements are taken from
-        section 3.5 of the Mopac7 manual. Unsupported elements will raise
-        an exception.
-
-        Note that MINDO/3 is supported only for certain *pairs* of elements,
-        and this check may let bad pairs slip through because it is not
-        pair-aware.
-
-        :param system: molecular system
-        :type system : geoprep.System
-        :param method: name of method
-        :type method : str
-        :return: elements from system
-        """
-        
-        emap = {"semiempirical:mndo" : ["H", "Li", "B", "C", "N", "O", "F",
-                                        "Al", "Si", "P", "S", "Cl", "Zn",
-                                        "Ge", "Br", "Sn", "I", "Hg", "Pb"],
-                "semiempirical:am1" : ["H", "B", "C", "N", "O", "F", "Al",
-                                       "Si", "P", "S", "Cl", "Zn", "Ge", "Br",
-                                       "Sn", "I", "Hg"],
-                "semiempirical:pm3" : ["H", "Be", "C", "N", "O", "F", "Mg",
-                                       "Al", "Si", "P", "S", "Cl", "Zn", "Ga",
-                                       "Ge", "As", "Se", "Br", "Cd", "In",
-                                       "Sn", "Sb", "Te", "I", "Hg", "Tl", "Pb",
-                                       "Bi"],
-                "semiempirical:mindo/3" : ["H", "B", "C", "N", "O", "F", "Si",
-                                           "P", "S", "Cl"]}
-        
-        elements = system.elements
-        allowed = emap[method]
-        for e in elements:
-            if e not in allowed:
-                raise ValueError("Element {0} not parameterized for {1}".format(repr(e), repr(method)))
-
-        return elements
-
     def check_coordinates(self, coordinate_choice):
         if coordinate_choice in self.coordinate_choices:
             return coordinate_choice
@@ -67,6 +67,13 @@ class NWChemJob(cpinterface.Job):
             self.runstate = "complete"
 
 class NWChem(cpinterface.MolecularCalculator):
+    #Hartree-Fock is limited only by the basis set
+    basis_set_methods = ("hf:rhf", "hf:uhf", "hf:rohf")
+    supported_elements = dict.fromkeys(basis_set_methods,
+                                       cpinterface.basis_set_elements)
+
+    basis_format = "nwchem"
+
     def __init__(self, *args, **kw):
         super(NWChem, self).__init__(*args, **kw)
         
@@ -88,12 +95,10 @@ class NWChem(cpinterface.MolecularCalculator):
 
         tag_name = options["property_name"]
         tags = system.atom_properties(tag_name)
+        coordinates = system.coordinates.tolist()
         entries = []
-        for j, tag in enumerate(tags):
-            atom = system.atoms[j]
-            entry = "{}\t{:.6f}\t{:.6f}\t{:.6f}".format(tag, atom.coords[0],
-                                                        atom.coords[1],
-                                                        atom.coords[2])
+        for tag, xyz in zip(tags, coordinates):
+            entry = "{}\t{:.6f}\t{:.6f}\t{:.6f}".format(tag, *xyz)
             entries.append(entry)
 
         return entries
@@ -225,70 +230,68 @@ class NWChem(cpinterface.MolecularCalculator):
         :rtype : dict
         """
 
-        defaults = {"basis_format" : "nwchem"}
+        defaults = {"basis_format" : self.basis_format}
         options = dict(defaults.items() + options.items())
         property_name = options["basis_tag_name"]
-        ubb = {}
-        basis_names = []
-        basis_blocks = []
         bsd = self.get_basis_data(system, options=options)
         data = bsd["data"]
 
         form = bsd["spherical_or_cartesian"]
 
-        symbols = system.atom_properties("symbols")
-        for j, basis_name in enumerate(system.atom_properties("basis_name")):
-            add_new_block = False
-            element = symbols[j]
-            if element not in ubb:
-                ubb[element] = []
-                
-            basis_element = "{0}:{1}".format(basis_name, element)
-
-            #this (basis, element) pair is new, so add it
-            if basis_element not in ubb[element]:
-                ubb[element].append(basis_element)
-                add_new_block = True
-
-            basis_index = ubb[element].index(basis_element)
-            basis_alias = "{0}{1}".format(element, basis_index)
-            basis_names.append(basis_alias)
-            
-            if add_new_block:
-                el_size = len(element)
-                basis_text = data[basis_name][element]
-
-                #add basis data with comment e.g. "H 3-21G"
-                #each element symbol gets replaced by tag, e.g. Cl -> Cl0
-                comment = "#{0} {1}".format(element, basis_name)
-                basis_lines = [comment]
-                for line in basis_text.split("\n")[1:]:
-                    if line[:el_size] == element:
-                        suffix = line[el_size:]
-                        entry = basis_alias + suffix
-                    else:
-                        entry = line
-                        #remove premature END terminators
-                        if entry == "END":
-                            continue
-                    basis_lines.append(entry)
-                    
-                block = "\n".join(basis_lines)
-                
-                basis_blocks.append(block)
-
-        blocks = "\n".join(basis_blocks)
+        basis_names, pairs = self.basis_aliases(system)
+        basis_lines = []
+        for basis_alias, basis_name, element in pairs:
+            basis_text = data[basis_name][element]
+            basis_lines += self.basis_block(basis_alias, basis_name, element,
+                                            basis_text, form)
+
         head = "basis {0}".format(form)
-        formatted = self.make_control_block([head] + blocks.split("\n"))
+        formatted = self.make_control_block([head] + basis_lines)
 
         #set basis tag for each atom
-        system.set_properties(property_name, range(len(system.atoms)),
+        system.set_properties(property_name, range(system.natoms),
                               basis_names)
 
         r = {"basis_data" : formatted}
 
         return r
 
+    def format_basis_block(self, alias, basis_name, element, basis_text,
+                           form):
+        """Format basis data for one element as lines of a basis control
+        block, with a comment e.g. "#H 3-21G". Each element symbol gets
+        replaced by its alias, e.g. Cl -> Cl0.
+
+        :param alias: basis alias, e.g. Cl0
+        :type alias : str
+        :param basis_name: basis set name
+        :type basis_name : str
+        :param element: element symbol
+        :type element : str
+        :param basis_text: NWChem format basis data
+        :type basis_text : str
+        :param form: "spherical" or "cartesian" (unused here)
+        :type form : str
+        :return: basis block lines
+        :rtype : tuple
+        """
+
+        el_size = len(element)
+        comment = "#{0} {1}".format(element, basis_name)
+        basis_lines = [comment]
+        for line in basis_text.split("\n")[1:]:
+            if line[:el_size] == element:
+                suffix = line[el_size:]
+                entry = alias + suffix
+            else:
+                entry = line
+                #remove premature END terminators
+                if entry == "END":
+                    continue
+            basis_lines.append(entry)
+
+        return tuple(basis_lines)
+
     def make_hf_job(self, system, method, runtyp, options={}):
         """Create an input specification for a Hartree-Fock calculation.
         
@@ -121,6 +121,19 @@ class PDynamoJob(cpinterface.Job):
         self.runstate = "complete"
 
 class PDynamo(cpinterface.MolecularCalculator):
+    #pDynamo checks its own parameter files when a job runs, and element
+    #lists here have not been verified against those files, so no element
+    #is ruled out ahead of time
+    supported_elements = dict.fromkeys(["semiempirical:am1",
+                                        "semiempirical:pm3",
+                                        "semiempirical:pm6",
+                                        "semiempirical:mndo",
+                                        "semiempirical:rm1",
+                                        "semiempirical:pddg/pm3",
+                                        "semiempirical:pddg/mndo",
+                                        "semiempirical:am1/d-phot"],
+                                       sharedutilities.ELEMENTS)
+
     def __init__(self, *args, **kw):
         super(PDynamo, self).__init__(*args, **kw)
         
@@ -72,6 +72,13 @@ class Psi4Job(cpinterface.Job):
             self.runstate = "complete"
 
 class Psi4(cpinterface.MolecularCalculator):
+    #Hartree-Fock is limited only by the basis set
+    basis_set_methods = ("hf:rhf", "hf:uhf", "hf:rohf")
+    supported_elements = dict.fromkeys(basis_set_methods,
+                                       cpinterface.basis_set_elements)
+
+    basis_format = "g94"
+
     def __init__(self, *args, **kw):
         super(Psi4, self).__init__(*args, **kw)
         
@@ -94,12 +101,10 @@ class Psi4(cpinterface.MolecularCalculator):
         tag_name = options["property_name"]
         tags = system.atom_properties(tag_name)
 
+        coordinates = system.coordinates.tolist()
         entries = []
-        for j, tag in enumerate(tags):
-            atom = system.atoms[j]
-            entry = "{}\t{:.6f}\t{:.6f}\t{:.6f}".format(tag, atom.coords[0],
-                                                        atom.coords[1],
-                                                        atom.coords[2])
+        for tag, xyz in zip(tags, coordinates):
+            entry = "{}\t{:.6f}\t{:.6f}\t{:.6f}".format(tag, *xyz)
             entries.append(entry)
 
         return entries
@@ -234,65 +239,60 @@ class Psi4(cpinterface.MolecularCalculator):
         :rtype : dict
         """
 
-        defaults = {"basis_format" : "g94"}
+        defaults = {"basis_format" : self.basis_format}
         options = dict(defaults.items() + options.items())
         property_name = options["basis_tag_name"]
-        ubb = {}
-        basis_names = []
-        basis_blocks = []
         assignments = []
         bsd = self.get_basis_data(system, options=options)
         data = bsd["data"]
 
         form = bsd["spherical_or_cartesian"]
 
-        symbols = system.atom_properties("symbols")
-        for j, basis_name in enumerate(system.atom_properties("basis_name")):
-            add_new_block = False
-            element = symbols[j]
-            if element not in ubb:
-                ubb[element] = []
-                
-            basis_element = "{0}:{1}".format(basis_name, element)
-
-            #this (basis, element) pair is new, so add it
-            if basis_element not in ubb[element]:
-                ubb[element].append(basis_element)
-                add_new_block = True
-
-            basis_index = ubb[element].index(basis_element)
-            basis_alias = "{0}{1}".format(element, basis_index)
-            basis_names.append(basis_alias)
-            
-            if add_new_block:
-                assignment = "assign {0} {1}".format(basis_alias, basis_alias)
-                assignments.append(assignment)
-                basis_text = data[basis_name][element]
-
-                #add basis data with comment e.g. "H 3-21G"
-                #also indicate cartesian/spherical form
-                comment = "#{0} {1}".format(element, basis_name)
-                designation = "[ {0} ]".format(basis_alias)
-                basis_lines = [comment, designation, form, basis_text]
-                                    
-                block = "\n".join(basis_lines)
-                
-                basis_blocks.append(block)
-
-        blocks = "\n".join(basis_blocks)
-        formatted = blocks
+        basis_names, pairs = self.basis_aliases(system)
+        basis_lines = []
+        for basis_alias, basis_name, element in pairs:
+            assignment = "assign {0} {1}".format(basis_alias, basis_alias)
+            assignments.append(assignment)
+            basis_text = data[basis_name][element]
+            basis_lines += self.basis_block(basis_alias, basis_name, element,
+                                            basis_text, form)
 
-        data = self.make_control_block(["basis"] + assignments +
-                                       blocks.split("\n"))
+        data = self.make_control_block(["basis"] + assignments + basis_lines)
 
         #set basis tag for each atom
-        system.set_properties(property_name, range(len(system.atoms)),
+        system.set_properties(property_name, range(system.natoms),
                               basis_names)
 
         r = {"basis_data" : data}
         
         return r
 
+    def format_basis_block(self, alias, basis_name, element, basis_text,
+                           form):
+        """Format basis data for one element as lines of a basis control
+        block, with a comment e.g. "#H 3-21G", the alias designation, and
+        the cartesian/spherical form.
+
+        :param alias: basis alias, e.g. Cl0
+        :type alias : str
+        :param basis_name: basis set name
+        :type basis_name : str
+        :param element: element symbol
+        :type element : str
+        :param basis_text: G94 format basis data
+        :type basis_text : str
+        :param form: "spherical" or "cartesian"
+        :type form : str
+        :return: basis block lines
+        :rtype : tuple
+        """
+
+        comment = "#{0} {1}".format(element, basis_name)
+        designation = "[ {0} ]".format(alias)
+        basis_lines = [comment, designation, form] + basis_text.split("\n")
+
+        return tuple(basis_lines)
+
     def make_hf_job(self, system, method, runtyp, options={}):
         """Create an input specification for a Hartree-Fock calculation.
         
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 mode:python; tab-width:4; indent-tabs-mode:nil; py-indent-offset:4 -*-
+##
+
+"""
+    fragment_construction
+    ~~~~~~~~~~~~~~
+
+    Compare the cost of constructing fragments from large XYZ inputs with
+    lazy initialization ("after") against the same construction followed by
+    the work Fragment.__init__ used to do eagerly ("before"): universal
+    SMILES and title generation, evaluation of every bridged attribute, and
+    element symbol assignment through pybel atom wrappers.
+
+    Run from the top level directory, e.g.
+    python -m benchmarks.fragment_construction --sizes 300 3000 30000
+"""
+import argparse
+import time
+
+from cinfony import pybel
+import geoprep
+from sharedutilities import ELEMENTS
+
+def water_box_xyz(n_waters, spacing=3.1):
+    """Make XYZ data for water molecules placed on a cubic grid.
+
+    :param n_waters: number of water molecules
+    :type n_waters : int
+    :param spacing: distance between grid points, in angstroms
+    :type spacing : float
+    :return: XYZ file contents
+    :rtype : str
+    """
+
+    template = [("O", 0.0, 0.0, 0.0), ("H", 0.757, 0.586, 0.0),
+                ("H", -0.757, 0.586, 0.0)]
+    side = int(round(n_waters ** (1.0 / 3))) + 1
+    lines = [str(3 * n_waters), "water box"]
+    for k in range(n_waters):
+        i, j, l = k % side, (k / side) % side, k / (side * side)
+        for symbol, x, y, z in template:
+            entry = "{0} {1:.6f} {2:.6f} {3:.6f}".format(symbol,
+                                                          x + i * spacing,
+                                                          y + j * spacing,
+                                                          z + l * spacing)
+            lines.append(entry)
+
+    return "\n".join(lines) + "\n"
+
+def lazy_construction(molecule):
+    """Construct a fragment the current way.
+
+    :param molecule: molecule to wrap
+    :type molecule : cinfony.pybel.Molecule
+    :return: fragment
+    :rtype : geoprep.Fragment
+    """
+
+    return geoprep.Fragment(molecule)
+
+def eager_construction(molecule):
+    """Construct a fragment and then force all of the derived values that
+    used to be computed at construction time.
+
+    :param molecule: molecule to wrap
+    :type molecule : cinfony.pybel.Molecule
+    :return: fragment
+    :rtype : geoprep.Fragment
+    """
+
+    f = geoprep.Fragment(molecule)
+    f.smiles
+    f.title
+    for attr in geoprep.Fragment.bridged_attrs:
+        getattr(f, attr, None)
+
+    [ELEMENTS[atom.atomicnum - 1] for atom in f.atoms]
+
+    return f
+
+def best_time(construct, data, repeat):
+    """Time construction of fragments from XYZ data, excluding parsing.
+
+    :param construct: construction function taking a molecule
+    :type construct : function
+    :param data: XYZ file contents
+    :type data : str
+    :param repeat: number of timed repetitions
+    :type repeat : int
+    :return: best elapsed time in seconds
+    :rtype : float
+    """
+
+    best = None
+    for k in range(repeat):
+        molecule = pybel.readstring("xyz", data)
+        start = time.time()
+        construct(molecule)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[30, 300, 3000, 30000],
+                        help="approximate numbers of atoms to test")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed repetitions per size")
+    options = parser.parse_args()
+
+    print ("{0:>8} {1:>12} {2:>12} {3:>8}".format("atoms", "before (s)",
+                                                  "after (s)", "ratio"))
+    for size in options.sizes:
+        data = water_box_xyz(max(1, size / 3))
+        natoms = 3 * max(1, size / 3)
+        before = best_time(eager_construction, data, options.repeat)
+        after = best_time(lazy_construction, data, options.repeat)
+        ratio = before / max(after, 1e-9)
+        print ("{0:>8} {1:>12.5f} {2:>12.5f} {3:>8.1f}".format(natoms, before,
+                                                              after, ratio))
+
+if __name__ == "__main__":
+    main()
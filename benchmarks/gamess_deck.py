@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 mode:python; tab-width:4; indent-tabs-mode:nil; py-indent-offset:4 -*-
+##
+
+"""
+    gamess_deck
+    ~~~~~~~~~~~~~~
+
+    Compare GAMESS-US deck assembly for large water boxes the old way
+    ("before": repeated str.find wrapping plus whole-deck replace, split,
+    and join passes) against the Namelist based assembly ("after"), and
+    time complete semiempirical and HF deck generation.
+
+    Run from the top level directory, e.g.
+    python -m benchmarks.gamess_deck --sizes 1000 10000
+"""
+import argparse
+import cStringIO as StringIO
+import time
+
+import geoprep
+from adapters import gamess_us
+from benchmarks.fragment_construction import water_box_xyz
+
+def legacy_reformat_long_line(data, start_marker, end_marker, maxlen=70):
+    """The original GAMESSUS.reformat_long_line.
+    """
+
+    begin_index = data.find(start_marker)
+    end_index = data.find(end_marker) + len(end_marker)
+    inner = data[begin_index : end_index]
+
+    pieces = []
+    current_split = 0
+    last_split = 0
+    while inner:
+        if len(inner) < maxlen:
+            pieces.append(inner)
+            break
+
+        current_split = inner.find(" ", last_split + 1)
+        if current_split >= maxlen or current_split == -1:
+            t = inner[:last_split]
+            pieces.append(t)
+            inner = inner[last_split:]
+            current_split = 0
+            last_split = 0
+
+        else:
+            last_split = current_split
+
+    return pieces, begin_index, end_index
+
+def legacy_assembly(geometry, basis_names, comments):
+    """Assemble the HF deck head the way make_hf_job used to.
+
+    :param geometry: input from create_geometry
+    :type geometry : str
+    :param basis_names: per-atom basis aliases
+    :type basis_names : list
+    :param comments: per-atom basis comments
+    :type comments : list
+    :return: deck
+    :rtype : str
+    """
+
+    bn = " $BASIS basnam(1)={0} $END".format(", ".join(basis_names))
+    pieces, begin, end = legacy_reformat_long_line(bn, " $BASIS", "$END")
+    basis = "\n ".join(pieces)
+
+    contrl = "SCFTYP=RHF RUNTYP=ENERGY ICHARG=0 ISPHER=0 MULT=1 MAXIT=200 "
+    deck = geometry.replace("$CONTRL ", "$CONTRL " + contrl)
+    pieces, begin, end = legacy_reformat_long_line(deck, " $CONTRL", "$END")
+    deck = deck[:begin] + "\n ".join(pieces) + deck[end:]
+
+    lines = deck.split("\n")
+    joblines = []
+    inserted = False
+    for line in lines:
+        joblines.append(line)
+        if "$END" in line and not inserted:
+            inserted = True
+            joblines.append(basis)
+
+    deck = "\n".join(joblines)
+    deck += "\n!Basis set assignments:\n"
+    deck += "\n".join(["!\t" + x for x in comments]) + "\n\n"
+    return deck
+
+def current_assembly(calculator, geometry, basis_names, comments):
+    """Assemble the HF deck head the way make_hf_job does now.
+
+    :param calculator: GAMESS-US calculator
+    :type calculator : gamess_us.GAMESSUS
+    :param geometry: input from create_geometry
+    :type geometry : str
+    :param basis_names: per-atom basis aliases
+    :type basis_names : list
+    :param comments: per-atom basis comments
+    :type comments : list
+    :return: deck
+    :rtype : str
+    """
+
+    basis = gamess_us.Namelist("BASIS", [("basnam(1)", basis_names)])
+    controls = [("SCFTYP", "RHF"), ("RUNTYP", "ENERGY"), ("ICHARG", 0),
+                ("ISPHER", 0), ("MULT", 1), ("MAXIT", 200)]
+    deck = calculator.assemble_deck(geometry, controls, [basis])
+    parts = [deck, "\n!Basis set assignments:\n"]
+    parts += ["!\t" + x + "\n" for x in comments]
+    parts.append("\n")
+    return "".join(parts)
+
+def best_time(f, repeat):
+    """:param f: function to time
+    :type f : function
+    :param repeat: number of timed repetitions
+    :type repeat : int
+    :return: best elapsed time in seconds
+    :rtype : float
+    """
+
+    best = None
+    for k in range(repeat):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[100, 1000, 10000],
+                        help="approximate numbers of atoms to test")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed repetitions per size")
+    parser.add_argument("--basis", default="3-21G",
+                        help="basis set for complete HF decks")
+    options = parser.parse_args()
+
+    G = geoprep.Geotool()
+    C = gamess_us.GAMESSUS()
+
+    print ("{0:>8} {1:>12} {2:>12} {3:>12} {4:>12}".format("atoms",
+                                                          "before (s)",
+                                                          "after (s)",
+                                                          "pm3 deck (s)",
+                                                          "hf deck (s)"))
+    for size in options.sizes:
+        nwaters = max(1, size / 3)
+        handle = StringIO.StringIO(water_box_xyz(nwaters))
+        box = G.read_fragment(handle=handle, fmt="xyz")
+        box.set_basis_name(options.basis)
+        s = geoprep.System([box])
+        geometry = C.create_geometry(s)
+        basis_names = ["O0", "H0", "H0"] * nwaters
+        comments = ["O 3-21G", "H 3-21G", "H 3-21G"] * nwaters
+
+        before = best_time(lambda: legacy_assembly(geometry, basis_names,
+                                                   comments), options.repeat)
+        after = best_time(lambda: current_assembly(C, geometry, basis_names,
+                                                   comments), options.repeat)
+        pm3 = best_time(lambda: C.make_energy_job(s, "semiempirical:pm3"),
+                        options.repeat)
+
+        #complete HF decks need ebsel for basis set data
+        try:
+            hf = best_time(lambda: C.make_energy_job(s, "hf:rhf"),
+                           options.repeat)
+            hf = "{0:>12.5f}".format(hf)
+        except Exception, e:
+            hf = "{0:>12}".format("n/a")
+
+        print ("{0:>8} {1:>12.5f} {2:>12.5f} {3:>12.5f} {4}".format(3 * nwaters,
+                                                                   before,
+                                                                   after, pm3,
+                                                                   hf))
+
+if __name__ == "__main__":
+    main()
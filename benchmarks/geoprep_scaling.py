@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 mode:python; tab-width:4; indent-tabs-mode:nil; py-indent-offset:4 -*-
+##
+
+"""
+    geoprep_scaling
+    ~~~~~~~~~~~~~~
+
+    Measure how common geoprep operations scale with system size: wall
+    time and peak memory for each operation at each size, plus a fitted
+    scaling exponent (slope of log time against log atoms) per operation.
+
+    Every timed run of an operation at a size happens in its own forked
+    process, with fixtures built fresh in that process. No run reuses the
+    selections, property lists, or merged molecules cached by an earlier
+    one, so each time is for a cold operation rather than a cache hit,
+    and peak resident memory reflects one setup and one operation alone.
+    "peak_kb" is the child's peak resident set size and "added_kb" is how
+    much the operation raised it above the setup it needed, both from the
+    first run.
+
+    Results are written as JSON, to stdout or to --output, e.g.
+    python -m benchmarks.geoprep_scaling --sizes 10 1000 100000 --output scaling.json
+"""
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy
+
+import geoprep
+from benchmarks.fragment_construction import water_box_xyz
+
+def peak_kb():
+    """Get peak resident set size of this process, in kilobytes (Linux
+    reports ru_maxrss in kilobytes, OS X in bytes).
+
+    :return: peak resident set size
+    :rtype : int
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin":
+        peak /= 1024
+
+    return peak
+
+class Fixtures(object):
+    """Inputs for operations at one size, written to a scratch directory
+    and built only as operations ask for them.
+    """
+
+    def __init__(self, natoms, workdir):
+        """:param natoms: approximate number of atoms wanted
+        :type natoms : int
+        :param workdir: scratch directory for input files
+        :type workdir : str
+        """
+
+        self.G = geoprep.Geotool()
+        self.nwaters = max(1, natoms / 3)
+        self.natoms = 3 * self.nwaters
+        self.workdir = workdir
+        self._fragment = None
+        self._system = None
+
+    def xyz_file(self):
+        """:return: name of an XYZ file holding a water box
+        :rtype : str
+        """
+
+        name = os.path.join(self.workdir, "box{0}.xyz".format(self.natoms))
+        if not os.path.exists(name):
+            with open(name, "w") as outfile:
+                outfile.write(water_box_xyz(self.nwaters))
+
+        return name
+
+    def pdb_file(self):
+        """:return: name of a PDB file holding a water box
+        :rtype : str
+        """
+
+        name = os.path.join(self.workdir, "box{0}.pdb".format(self.natoms))
+        if not os.path.exists(name):
+            self.fragment().write_fragment(name)
+
+        return name
+
+    def fragment(self):
+        """:return: water box as a single fragment
+        :rtype : geoprep.Fragment
+        """
+
+        if self._fragment is None:
+            self._fragment = self.G.read_fragment(self.xyz_file())
+
+        return self._fragment
+
+    def system(self):
+        """:return: system holding the water box fragment
+        :rtype : geoprep.System
+        """
+
+        if self._system is None:
+            self._system = geoprep.System([self.fragment()])
+
+        return self._system
+
+    def smiles(self):
+        """:return: SMILES for a linear alkane of about natoms atoms
+        :rtype : str
+        """
+
+        return "C" * max(1, (self.natoms - 2) / 3)
+
+#each operation takes fixtures and returns a function to time; anything
+#built before returning counts as setup, not as part of the measurement
+def op_make_fragment(fx):
+    smiles = fx.smiles()
+    return lambda: fx.G.make_fragment(smiles)
+
+def op_read_xyz(fx):
+    name = fx.xyz_file()
+    return lambda: fx.G.read_fragment(name)
+
+def op_read_pdb(fx):
+    name = fx.pdb_file()
+    return lambda: fx.G.read_fragment(name)
+
+def op_write_xyz(fx):
+    s = fx.system()
+    return lambda: s.write("xyz")
+
+def op_write_pdb(fx):
+    s = fx.system()
+    return lambda: s.write("pdb")
+
+def op_select(fx):
+    s = fx.system()
+    return lambda: s.select("[O]", hydrogen="include")
+
+def op_atom_properties(fx):
+    s = fx.system()
+    return lambda: s.atom_properties("symbols")
+
+def op_set_basis_name(fx):
+    f = fx.fragment()
+    oxygens = f.select("[O]", hydrogen="exclude")
+
+    def run():
+        f.set_basis_name("cc-pVDZ")
+        f.set_basis_name("cc-pVTZ", selection=oxygens)
+
+    return run
+
+def op_deepcopy(fx):
+    s = fx.system()
+    return lambda: copy.deepcopy(s)
+
+def op_align(fx):
+    reference = fx.fragment()
+    target = reference.clone()
+    theta = 0.3
+    rotation = [[numpy.cos(theta), -numpy.sin(theta), 0.0],
+                [numpy.sin(theta), numpy.cos(theta), 0.0],
+                [0.0, 0.0, 1.0]]
+    target.rotate(rotation)
+    return lambda: fx.G.align(reference, target, symmetry=False)
+
+operations = [("make_fragment", op_make_fragment),
+              ("read_fragment_xyz", op_read_xyz),
+              ("read_fragment_pdb", op_read_pdb),
+              ("write_xyz", op_write_xyz),
+              ("write_pdb", op_write_pdb),
+              ("select", op_select),
+              ("atom_properties", op_atom_properties),
+              ("set_basis_name", op_set_basis_name),
+              ("deepcopy", op_deepcopy),
+              ("align", op_align)]
+
+def measure(name, size, workdir, results):
+    """Set up and time one run of one operation at one size, in a child
+    process.
+
+    :param name: operation name
+    :type name : str
+    :param size: approximate number of atoms
+    :type size : int
+    :param workdir: scratch directory for input files
+    :type workdir : str
+    :param results: queue to put the run on
+    :type results : multiprocessing.Queue
+    """
+
+    try:
+        fx = Fixtures(size, workdir)
+        run = dict(operations)[name](fx)
+        before = peak_kb()
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        after = peak_kb()
+        r = {"natoms" : fx.natoms, "seconds" : elapsed, "peak_kb" : after,
+             "added_kb" : after - before, "error" : None}
+    except Exception, e:
+        r = {"error" : repr(e)}
+
+    results.put(r)
+
+def measure_runs(name, size, repeat, workdir, timeout):
+    """Time repeated runs of one operation at one size, each in a new
+    child process.
+
+    :param name: operation name
+    :type name : str
+    :param size: approximate number of atoms
+    :type size : int
+    :param repeat: number of timed runs
+    :type repeat : int
+    :param workdir: scratch directory for input files
+    :type workdir : str
+    :param timeout: seconds allowed per run
+    :type timeout : float
+    :return: measurement
+    :rtype : dict
+    """
+
+    runs = []
+    for k in range(repeat):
+        results = multiprocessing.Queue()
+        p = multiprocessing.Process(target=measure,
+                                    args=(name, size, workdir, results))
+        p.start()
+        try:
+            r = results.get(timeout=timeout)
+        except Exception:
+            p.terminate()
+            r = {"error" : "timed out"}
+        p.join()
+
+        if r["error"] is not None:
+            return {"operation" : name, "natoms" : size, "error" : r["error"]}
+        runs.append(r)
+
+    times = [r["seconds"] for r in runs]
+    return {"operation" : name, "natoms" : runs[0]["natoms"],
+            "seconds" : min(times), "mean_seconds" : sum(times) / len(times),
+            "peak_kb" : runs[0]["peak_kb"], "added_kb" : runs[0]["added_kb"],
+            "error" : None}
+
+def scaling_exponent(measurements):
+    """Fit time ~ natoms ** k by least squares on a log-log scale.
+
+    :param measurements: successful measurements of one operation
+    :type measurements : list
+    :return: fitted exponent k, or None with fewer than two sizes
+    :rtype : float | None
+    """
+
+    points = [(m["natoms"], m["seconds"]) for m in measurements
+              if m["seconds"] > 0]
+    if len(set([p[0] for p in points])) < 2:
+        return None
+
+    natoms, seconds = zip(*points)
+    slope, intercept = numpy.polyfit(numpy.log(natoms), numpy.log(seconds), 1)
+    return float(slope)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10, 100, 1000, 10000, 100000],
+                        help="approximate numbers of atoms to test")
+    parser.add_argument("--operations", nargs="+",
+                        default=[o[0] for o in operations],
+                        help="operations to measure")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed runs per measurement, each in its own process")
+    parser.add_argument("--embed-limit", type=int, default=1000,
+                        help="largest size for make_fragment, which embeds in 3D")
+    parser.add_argument("--timeout", type=float, default=1800.0,
+                        help="seconds allowed per timed run")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    measurements = []
+    try:
+        for name in options.operations:
+            for size in options.sizes:
+                if name == "make_fragment" and size > options.embed_limit:
+                    continue
+
+                measurements.append(measure_runs(name, size, options.repeat,
+                                                 workdir, options.timeout))
+    finally:
+        shutil.rmtree(workdir)
+
+    exponents = {}
+    for name in options.operations:
+        done = [m for m in measurements
+                if m["operation"] == name and m["error"] is None]
+        exponents[name] = scaling_exponent(done)
+
+    report = {"python" : platform.python_version(),
+              "platform" : platform.platform(),
+              "repeat" : options.repeat,
+              "measurements" : measurements,
+              "scaling_exponents" : exponents}
+    text = json.dumps(report, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, "w") as outfile:
+            outfile.write(text + "\n")
+    else:
+        print text
+
+if __name__ == "__main__":
+    main()
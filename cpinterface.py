@@ -12,6 +12,232 @@ except ImportError:
     msg = "Warning! Unable to import ebsel. Attempts to prepare calculations that need basis set data will fail. Make sure ebsel is on your PYTHONPATH to run calculations using basis sets. https://github.com/mattbernst/ebsel\n"
     sys.stderr.write(msg)
 
+#basis set data shared by every calculator in the process, optionally backed
+#by an on-disk cache shared between processes (see set_basis_cache)
+_basis_records = sharedutilities.LRUCache(8192)
+_basis_disk = None
+_basis_libraries = {}
+
+#basis blocks already formatted for a particular back-end
+_formatted_basis = sharedutilities.LRUCache(4096)
+
+#element sets are stored as bitsets, with bit Z set for atomic number Z
+_element_numbers = dict([(e, k + 1)
+                         for k, e in enumerate(sharedutilities.ELEMENTS)])
+_method_masks = {}
+
+#supported elements for methods with no element-specific parameters, e.g.
+#Hartree-Fock, where only the basis set limits which elements can be used
+basis_set_elements = list(sharedutilities.ELEMENTS)
+
+def set_basis_cache(cache):
+    """Keep basis set data in an on-disk cache as well as in memory, so
+    that other processes and later runs can skip the ebsel database.
+    Data loaded with bypass_db is never written to disk, so edited basis
+    files still take effect in new processes.
+
+    :param cache: cache directory or DiskCache, or None to use memory only
+    :type cache : str | sharedutilities.DiskCache | None
+    """
+
+    global _basis_disk
+    if isinstance(cache, basestring):
+        cache = sharedutilities.DiskCache(cache)
+
+    _basis_disk = cache
+
+def _basis_library(basis_format):
+    """Get the ebsel library for a basis set format, opened once per
+    process.
+
+    :param basis_format: "gamess-us", "nwchem", or "g94"
+    :type basis_format : str
+    :return: basis set library
+    :rtype : EMSL_local.EMSL_local
+    """
+
+    try:
+        return _basis_libraries[basis_format]
+    except KeyError:
+        el = EMSL_local.EMSL_local(fmt=basis_format)
+        _basis_libraries[basis_format] = el
+        return el
+
+def _cached_basis_records(keys, fetch, persist=True):
+    """Look up basis set records in memory, then on disk, and fetch the
+    remaining ones together.
+
+    :param keys: record keys, tuples of JSON-serializable parts
+    :type keys : list
+    :param fetch: function taking the missing keys and returning their values in order
+    :type fetch : function
+    :param persist: if False, skip the on-disk cache
+    :type persist : bool
+    :return: values in the order of keys
+    :rtype : list
+    """
+
+    disk = _basis_disk if persist else None
+    values = {}
+    missing = []
+    for key in keys:
+        value = _basis_records.get(key)
+        if value is None and disk is not None:
+            value = disk.get(disk.key(*key))
+            if value is not None:
+                _basis_records.put(key, value)
+
+        if value is None:
+            missing.append(key)
+        else:
+            values[key] = value
+
+    if missing:
+        for key, value in zip(missing, fetch(missing)):
+            _basis_records.put(key, value)
+            if disk is not None:
+                disk.put(disk.key(*key), value)
+            values[key] = value
+
+    return [values[key] for key in keys]
+
+def basis_info(basis_format, basis_names):
+    """Get the elements each basis set provides and whether it uses
+    spherical or cartesian functions.
+
+    :param basis_format: "gamess-us", "nwchem", or "g94"
+    :type basis_format : str
+    :param basis_names: basis set names
+    :type basis_names : list
+    :return: {"elements" : [...], "spherical_or_cartesian" : ...} per name
+    :rtype : list
+    """
+
+    def fetch(keys):
+        el = _basis_library(basis_format)
+        r = []
+        for fmt, name in keys:
+            elements = [str(e) for e in el.get_available_elements(name)]
+            soc = None
+            if elements:
+                soc = el.spherical_or_cartesian(name)
+            r.append({"elements" : elements, "spherical_or_cartesian" : soc})
+        return r
+
+    keys = [(basis_format, name) for name in basis_names]
+    return _cached_basis_records(keys, fetch)
+
+def element_mask(elements):
+    """Pack element symbols into a bitset.
+
+    :param elements: element symbols
+    :type elements : list
+    :return: bitset with bit Z set for each atomic number Z
+    :rtype : int
+    """
+
+    mask = 0
+    for e in elements:
+        mask |= 1 << _element_numbers[e]
+
+    return mask
+
+def composition_mask(obj):
+    """Get the bitset of elements present in a fragment or system.
+
+    :param obj: fragment or system
+    :type obj : geoprep.Fragment | geoprep.System
+    :return: bitset with bit Z set for each atomic number Z present
+    :rtype : int
+    """
+
+    mask = 0
+    for z in set(obj.atomic_numbers.tolist()):
+        mask |= 1 << z
+
+    return mask
+
+def basis_element_masks(basis_format, basis_names):
+    """Get the bitset of elements each basis set provides parameters for.
+
+    :param basis_format: "gamess-us", "nwchem", or "g94"
+    :type basis_format : str
+    :param basis_names: basis set names
+    :type basis_names : list
+    :return: bitset per basis set name
+    :rtype : list
+    """
+
+    infos = basis_info(basis_format, basis_names)
+    return [element_mask(info["elements"]) for info in infos]
+
+def filter_library(calculators, library, basis_names=()):
+    """Find which back-end, method, and basis set combinations can run
+    each molecule of a library, using only element support, before any
+    job is prepared.
+
+    :param calculators: back-end calculators to consider
+    :type calculators : list
+    :param library: fragments or systems
+    :type library : list
+    :param basis_names: basis set names to consider for methods using basis sets, required if any calculator has such methods
+    :type basis_names : list
+    :return: (back-end name, method, basis name or None) tuples per molecule
+    :rtype : list
+    """
+
+    combos = []
+    for calculator in calculators:
+        backend = calculator.__class__.__name__
+        for method, basis_name, allowed in calculator.support_index(basis_names):
+            combos.append(((backend, method, basis_name), allowed))
+
+    #libraries repeat compositions a lot, so check each one only once
+    by_mask = {}
+    results = []
+    for obj in library:
+        mask = composition_mask(obj)
+        try:
+            supported = by_mask[mask]
+        except KeyError:
+            supported = [combo for combo, allowed in combos
+                         if not mask & ~allowed]
+            by_mask[mask] = supported
+
+        results.append(list(supported))
+
+    return results
+
+def basis_blocks(basis_format, requests, convert_from=None, bypass_db=False):
+    """Get basis set data blocks for many (basis name, element) pairs at
+    once. Each block is cached under (basis_format, basis name, element,
+    convert_from, bypass_db).
+
+    :param basis_format: "gamess-us", "nwchem", or "g94"
+    :type basis_format : str
+    :param requests: (basis name, element symbol) pairs
+    :type requests : list
+    :param convert_from: optional source format to convert from
+    :type convert_from : str
+    :param bypass_db: load data from the file system instead of the db
+    :type bypass_db : bool
+    :return: basis data text in the order of requests
+    :rtype : list
+    """
+
+    def fetch(keys):
+        el = _basis_library(basis_format)
+        #ebsel does not promise an order for multi-element results, so
+        #blocks are fetched one element at a time
+        return [el.get_basis(name, [element], convert_from=convert_from,
+                             bypass_db=bypass_db)[0]
+                for fmt, name, element, c, b in keys]
+
+    keys = [(basis_format, name, element, convert_from, bypass_db)
+            for name, element in requests]
+    blocks = _cached_basis_records(keys, fetch, persist=not bypass_db)
+    return [str(b) for b in blocks]
+
 class Messages(object):
     def log(self, msg):
         self.messages.append(msg)
@@ -20,6 +246,145 @@ class Messages(object):
         if not self.messages or self.messages[-1] != msg:
             self.messages.append(msg)
 
+#package directory, so that configuration is found from any working directory
+_here = os.path.dirname(os.path.abspath(__file__))
+
+class RunnerRegistry(object):
+    def __init__(self, config_dir=None):
+        """Hold runner configurations for every host, read from
+        runners.yaml in config_dir, or from runners-default.yaml if there
+        is no runners.yaml. The file is parsed once and parsed again only
+        when it changes (or when runners.yaml appears or disappears).
+
+        :param config_dir: configuration directory (default: config/ in the package)
+        :type config_dir : str
+        """
+
+        if config_dir is None:
+            config_dir = os.path.join(_here, "config")
+
+        self.filenames = [os.path.join(config_dir, "runners.yaml"),
+                          os.path.join(config_dir, "runners-default.yaml")]
+        self.stamp = None
+        self.hosts = {}
+        self.programs = {}
+
+    def _current_file(self):
+        """Find the configuration file in effect.
+
+        :return: file name, modification time, and size
+        :rtype : tuple
+        """
+
+        for fname in self.filenames:
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+
+            return (fname, st.st_mtime, st.st_size)
+
+        raise IOError("Unable to locate config file runners.yaml or runners-default.yaml")
+
+    def refresh(self):
+        """Reload configuration if the file in effect has changed.
+        """
+
+        stamp = self._current_file()
+        if stamp == self.stamp:
+            return
+
+        with open(stamp[0]) as infile:
+            data = yaml.safe_load(infile) or {}
+
+        self._index(data)
+        self.stamp = stamp
+
+    def _index(self, data):
+        """Index enabled back-ends by host and by program.
+
+        :param data: parsed configuration
+        :type data : dict
+        """
+
+        hosts = {}
+        programs = {}
+        for host, configs in data.items():
+            enabled = {}
+            for c in configs or []:
+                eflag = str(c.get("enabled", "")).lower()
+                if eflag in ("y", "yes", "true") and c["program"] not in enabled:
+                    enabled[c["program"]] = c
+
+            hosts[host] = enabled
+            for program, c in enabled.items():
+                entry = (c.get("cores", 1), host)
+                try:
+                    programs[program].append(entry)
+                except KeyError:
+                    programs[program] = [entry]
+
+        #most cores first
+        for entries in programs.values():
+            entries.sort(key=lambda e: -e[0])
+
+        self.hosts = hosts
+        self.programs = programs
+
+    def get(self, host, program):
+        """Get the run configuration of an enabled back-end on a host.
+
+        :param host: name of host to use for job execution
+        :type host : str
+        :param program: back-end name, e.g. "nwchem"
+        :type program : str
+        :return: backend run configuration
+        :rtype : dict
+        """
+
+        self.refresh()
+        try:
+            return dict(self.hosts[host][program])
+        except KeyError:
+            raise KeyError("Could not find enabled backend for {0} on {1}".format(program, host))
+
+    def capacity(self, host):
+        """Get cores and memory (None if not configured) for each enabled
+        back-end on a host.
+
+        :param host: host name
+        :type host : str
+        :return: {program : {"cores" : ..., "memory" : ...}}
+        :rtype : dict
+        """
+
+        self.refresh()
+        capacity = {}
+        for program, c in self.hosts.get(host, {}).items():
+            capacity[program] = {"cores" : c.get("cores", 1),
+                                 "memory" : c.get("memory")}
+
+        return capacity
+
+    def hosts_for(self, program, cores=1):
+        """Find hosts where a back-end is enabled with at least the given
+        number of cores.
+
+        :param program: back-end name, e.g. "nwchem"
+        :type program : str
+        :param cores: minimum number of cores
+        :type cores : int
+        :return: host names, those with the most cores first
+        :rtype : list
+        """
+
+        self.refresh()
+        return [host for n, host in self.programs.get(program, [])
+                if n >= cores]
+
+#runner configuration shared by every job in the process
+runners = RunnerRegistry()
+
 class Job(sharedutilities.Utility, Messages):
     def __init__(self, deck="", system=None, runstate="begin", tmpdir="/tmp",
                  extras={}):
@@ -37,14 +402,15 @@ class Job(sharedutilities.Utility, Messages):
         self.messages = []
         self.extras = extras
         #use location of script to find location of configs 
-        self.here = os.path.dirname(__file__)
+        self.here = _here
         #2 days
         self.timeout = 86400 * 2
 
     def get_run_config(self, host):
         """Get the run configuration for the backend used by this job.
         If config/runners.yaml is present it will take precedence over
-        the default config/runners-default.yaml.
+        the default config/runners-default.yaml. Configuration comes from
+        the process-wide runner registry (see RunnerRegistry).
 
         :param host: name of host to use for job execution
         :type host : str
@@ -52,30 +418,7 @@ class Job(sharedutilities.Utility, Messages):
         :rtype : dict
         """
 
-        data = None
-        
-        for fname in ["config/runners.yaml", "config/runners-default.yaml"]:
-            try:
-                with open(fname) as infile:
-                    data = yaml.safe_load(infile)
-                    break
-            except IOError:
-                continue
-
-        if data is None:
-            raise IOError("Unable to locate config file runners.yaml or runners-default.yaml")
-        configs = data[host]
-        config = None
-        for c in configs:
-            eflag = c["enabled"].lower()
-            if c["program"] == self.backend and eflag in ("y", "true"):
-                config = c
-                break
-
-        if config is None:
-            raise KeyError("Could not find enabled backend for {0} on {1}".format(self.backend, host))
-            
-        return config
+        return runners.get(host, self.backend)
 
     def run(self, host="localhost", options={}):
         raise NotImplementedError
@@ -329,7 +672,29 @@ class Job(sharedutilities.Utility, Messages):
 
         self.geometry = self.geometry_history[-1]
 
+    def geometry_fragments(self):
+        """Convert every geometry in self.geometry_history to a fragment,
+        e.g. to post-process the steps of an optimization.
+
+        :return: fragments in history order
+        :rtype : list
+        """
+
+        G = geoprep.Geotool()
+        return G.geolists_to_fragments(self.geometry_history)
+
 class MolecularCalculator(Messages):
+    #elements parameterized for each method; every method in self.methods
+    #needs an entry, using basis_set_elements for methods without
+    #element-specific parameters
+    supported_elements = {}
+
+    #ebsel format for basis set data, or None for back-ends without basis sets
+    basis_format = None
+
+    #methods that need a basis set, e.g. Hartree-Fock
+    basis_set_methods = ()
+
     def __init__(self, *args, **kw):
         self.messages = []
         
@@ -367,6 +732,10 @@ class MolecularCalculator(Messages):
          force_conversion_from: "gamess-us", "nwchem", or "g94"
          bypass_db: force data to be loaded from file system instead of db
 
+        Basis set data is cached for the whole process (and on disk if
+        set_basis_cache has been called), so repeated jobs using the same
+        basis sets do not go back to the ebsel database.
+
         When the force_conversion_from option is enabled, the ebsel code
         will use the specified format as the original source and force a
         conversion to a standardized version of the basis_format.
@@ -414,9 +783,10 @@ class MolecularCalculator(Messages):
             except KeyError:
                 groups[name] = set([symbol])
 
-        el = EMSL_local.EMSL_local(fmt=basis_format)
-        for basis_set_name in groups:
-            provided_elements = set(el.get_available_elements(basis_set_name))
+        names = sorted(groups)
+        requests = []
+        for basis_set_name, info in zip(names, basis_info(basis_format, names)):
+            provided_elements = set(info["elements"])
 
             #no provided elements at all means unknown basis set name
             if not provided_elements:
@@ -428,21 +798,23 @@ class MolecularCalculator(Messages):
             if missing_elements:
                 raise ValueError("Basis set {0} missing parameters for elements {1}".format(repr(basis_set_name), list(missing_elements)))
 
-            basis_data = {}
-            for element in elements:
-                bd = el.get_basis(basis_set_name, [element],
-                                  convert_from=conversion_from,
-                                  bypass_db=bypass_db)[0]
-                basis_data[element] = bd
-                
-            basis_groups[basis_set_name] = basis_data
+            requests += [(basis_set_name, element) for element in elements]
 
-            soc = el.spherical_or_cartesian(basis_set_name)
+            soc = str(info["spherical_or_cartesian"])
             try:
                 function_types[soc].append(basis_set_name)
             except KeyError:
                 function_types[soc] = [basis_set_name]
 
+        blocks = basis_blocks(basis_format, requests,
+                              convert_from=conversion_from,
+                              bypass_db=bypass_db)
+        for (basis_set_name, element), bd in zip(requests, blocks):
+            try:
+                basis_groups[basis_set_name][element] = bd
+            except KeyError:
+                basis_groups[basis_set_name] = {element : bd}
+
         #can't mix spherical and cartesian basis sets in a single system
         if len(function_types) > 1:
             raise ValueError("Attempted mixing spherical and cartesian basis sets: {0}".format(function_types))
@@ -453,9 +825,147 @@ class MolecularCalculator(Messages):
         
         return d
 
-    def check_element_support(self, system, options={}):
+    def basis_aliases(self, system):
+        """Name each distinct (basis set, element) pair in a system with an
+        alias made of the element symbol and a per-element count in order
+        of first appearance, e.g. Cl0 and Cl1 for chlorines carrying two
+        different basis sets.
+
+        :param system: molecular system with basis names assigned
+        :type system : geoprep.System
+        :return: per-atom aliases, and (alias, basis name, element) for each pair
+        :rtype : tuple
+        """
+
+        aliases = {}
+        counts = {}
+        pairs = []
+        names = []
+        symbols = system.atom_properties("symbols")
+        basis_names = system.atom_properties("basis_name")
+        for basis_name, element in zip(basis_names, symbols):
+            try:
+                alias = aliases[(basis_name, element)]
+            except KeyError:
+                index = counts.get(element, 0)
+                counts[element] = index + 1
+                alias = "{0}{1}".format(element, index)
+                aliases[(basis_name, element)] = alias
+                pairs.append((alias, basis_name, element))
+
+            names.append(alias)
+
+        return names, pairs
+
+    def basis_block(self, alias, basis_name, element, basis_text, form):
+        """Get basis data for one aliased element formatted for this
+        back-end, reusing blocks already formatted in this process.
+
+        :param alias: basis alias from basis_aliases, e.g. Cl0
+        :type alias : str
+        :param basis_name: basis set name
+        :type basis_name : str
+        :param element: element symbol
+        :type element : str
+        :param basis_text: basis data from get_basis_data
+        :type basis_text : str
+        :param form: "spherical" or "cartesian"
+        :type form : str
+        :return: formatted basis block
+        """
+
+        key = (self.__class__.__name__, alias, basis_name, element, form,
+               basis_text)
+        block = _formatted_basis.get(key)
+        if block is None:
+            block = self.format_basis_block(alias, basis_name, element,
+                                            basis_text, form)
+            _formatted_basis.put(key, block)
+
+        return block
+
+    def format_basis_block(self, alias, basis_name, element, basis_text,
+                           form):
         raise NotImplementedError
 
+    def method_element_mask(self, method):
+        """Get the bitset of elements a method is parameterized for. Methods
+        that are not supported, or that have no supported_elements entry,
+        raise an exception.
+
+        :param method: name of method
+        :type method : str
+        :return: bitset with bit Z set for each supported atomic number Z
+        :rtype : int
+        """
+
+        key = (self.__class__, method)
+        try:
+            return _method_masks[key]
+        except KeyError:
+            pass
+
+        self.check_method(method)
+        try:
+            mask = element_mask(self.supported_elements[method])
+        except KeyError:
+            raise ValueError("No supported elements listed for {0}".format(repr(method)))
+
+        _method_masks[key] = mask
+        return mask
+
+    def check_element_support(self, system, method):
+        """Check that the chosen method is parameterized for all the
+        elements in the system. Unsupported elements will raise an
+        exception.
+
+        :param system: molecular system
+        :type system : geoprep.System
+        :param method: name of method
+        :type method : str
+        :return: elements from system
+        """
+
+        elements = system.elements
+        unsupported = element_mask(elements) & ~self.method_element_mask(method)
+        if unsupported:
+            for e in elements:
+                if unsupported & element_mask([e]):
+                    raise ValueError("Element {0} not parameterized for {1}".format(repr(e), repr(method)))
+
+        return elements
+
+    def support_index(self, basis_names=()):
+        """Get the elements supported by each method, and by each method and
+        basis set combination for methods in basis_set_methods. If any
+        method needs a basis set, basis_names must not be empty.
+
+        :param basis_names: basis set names to combine with methods
+        :type basis_names : list
+        :return: (method, basis name or None, element bitset) tuples
+        :rtype : list
+        """
+
+        needs_basis = [m for m in self.methods if m in self.basis_set_methods]
+        basis_masks = []
+        if needs_basis:
+            if not basis_names:
+                raise ValueError("No basis set names given for {0} methods {1}".format(self.__class__.__name__, needs_basis))
+
+            masks = basis_element_masks(self.basis_format, basis_names)
+            basis_masks = zip(basis_names, masks)
+
+        index = []
+        for method in self.methods:
+            allowed = self.method_element_mask(method)
+            if method in self.basis_set_methods:
+                for basis_name, mask in basis_masks:
+                    index.append((method, basis_name, allowed & mask))
+            else:
+                index.append((method, None, allowed))
+
+        return index
+
     def check_electronic_reference(self, reference):
         """Check that electronic reference is supported for calculation to
         be attempted. Raise an exception on unsupported reference.
@@ -1,9 +1,1430 @@
 # -*- coding:utf-8 mode:python; tab-width:4; indent-tabs-mode:nil; py-indent-offset:4 -*-
-import copy
-import cStringIO as StringIO
+import collections
+import cPickle as pickle
+import hashlib
+import itertools
+import json
+import multiprocessing
+import struct
+import time
+
+import numpy
 
 from cinfony import pybel, webel
-from sharedutilities import ELEMENTS
+from sharedutilities import ELEMENTS, DiskCache, LRUCache
+
+#Source of revision stamps. Fragments and systems take a fresh stamp every
+#time their geometry, topology, or properties change, so derived data can be
+#cached under a tuple of stamps and invalidated by comparing tuples.
+_revisions = itertools.count(1)
+
+#SMARTS patterns compiled once per process and reused for every fragment
+_smarts_patterns = LRUCache(512)
+
+def _compiled_smarts(smarts):
+    """Get a compiled SMARTS pattern, compiling it on first use.
+
+    :param smarts: a SMARTS pattern
+    :type smarts : str
+    :return: compiled pattern
+    :rtype : cinfony.pybel.Smarts
+    """
+
+    finder = _smarts_patterns.get(smarts)
+    if finder is None:
+        finder = pybel.Smarts(smarts)
+        _smarts_patterns.put(smarts, finder)
+
+    return finder
+
+def _build_obmol(atomic_numbers, coordinates, bonds=()):
+    """Assemble an OBMol directly from per-atom data instead of writing
+    and re-parsing a text format.
+
+    :param atomic_numbers: atomic number of each atom
+    :type atomic_numbers : list | numpy.ndarray
+    :param coordinates: atom coordinates, shape (N, 3)
+    :type coordinates : numpy.ndarray
+    :param bonds: (begin, end, order) with 0-based atom indexes
+    :type bonds : list
+    :return: new molecule
+    :rtype : openbabel.OBMol
+    """
+
+    obmol = pybel.ob.OBMol()
+    obmol.BeginModify()
+    for z, xyz in zip(atomic_numbers, coordinates.tolist()):
+        atom = obmol.NewAtom()
+        atom.SetAtomicNum(int(z))
+        atom.SetVector(*xyz)
+
+    #OBMol atom indexes are 1-based
+    for begin, end, order in bonds:
+        obmol.AddBond(int(begin) + 1, int(end) + 1, int(order))
+
+    obmol.EndModify()
+    return obmol
+
+#atomic number for each element symbol
+_element_numbers = dict([(symbol, k + 1) for k, symbol in enumerate(ELEMENTS)])
+
+def _to_atomic_numbers(elements):
+    """Convert element symbols or atomic numbers to an atomic number array.
+
+    :param elements: element symbols or atomic numbers
+    :type elements : list | numpy.ndarray
+    :return: atomic numbers
+    :rtype : numpy.ndarray
+    """
+
+    elements = numpy.asarray(elements)
+    if elements.dtype.kind in "iu":
+        return elements.astype(numpy.int32)
+
+    try:
+        numbers = [_element_numbers[e] for e in elements.tolist()]
+    except KeyError as e:
+        raise ValueError("Unknown element symbol {0}".format(repr(e.args[0])))
+
+    return numpy.array(numbers, dtype=numpy.int32)
+
+def _geometry_digest(atomic_numbers, coordinates, bonds, charge, spin,
+                     properties, tolerance):
+    """Hash molecular content independent of atom order. Atoms are put in a
+    canonical order by atomic number and then coordinates rounded to a
+    grid of the given tolerance; bonds and per-atom properties are hashed
+    in that order.
+
+    N.B.: Coordinates that straddle a grid boundary can round differently
+    for geometries that differ by much less than the tolerance.
+
+    :param atomic_numbers: atomic numbers
+    :type atomic_numbers : numpy.ndarray
+    :param coordinates: atom coordinates, shape (N, 3)
+    :type coordinates : numpy.ndarray
+    :param bonds: (begin, end, order) with 0-based atom indexes
+    :type bonds : list
+    :param charge: total charge
+    :type charge : int
+    :param spin: spin multiplicity
+    :type spin : int
+    :param properties: per-atom property values by group name
+    :type properties : dict
+    :param tolerance: coordinate grid spacing in Angstroms
+    :type tolerance : float
+    :return: hex digest
+    :rtype : str
+    """
+
+    grid = numpy.round(numpy.asarray(coordinates) / tolerance).astype(numpy.int64)
+    order = numpy.lexsort((grid[:, 2], grid[:, 1], grid[:, 0],
+                           atomic_numbers))
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+
+    digest = hashlib.sha1()
+    digest.update(repr((len(order), charge, spin, tolerance)))
+    numbers = numpy.asarray(atomic_numbers, dtype="<i4")[order]
+    digest.update(numbers.tostring())
+    digest.update(numpy.ascontiguousarray(grid[order], dtype="<i8").tostring())
+
+    if bonds:
+        b = numpy.array(bonds, dtype=numpy.int64)
+        ends = numpy.sort(rank[b[:, :2]], axis=1)
+        canonical = numpy.column_stack([ends, b[:, 2]])
+        canonical = canonical[numpy.lexsort(canonical.T[::-1])]
+        digest.update(numpy.ascontiguousarray(canonical, dtype="<i8").tostring())
+
+    for name in sorted(properties):
+        values = properties[name][order].tolist()
+        digest.update(repr((name, values)))
+
+    return digest.hexdigest()
+
+def _embedding_data(molecule):
+    """Extract the result of a 3D embedding in a JSON-serializable form.
+
+    :param molecule: embedded molecule
+    :type molecule : cinfony.pybel.Molecule
+    :return: atomic numbers and coordinates
+    :rtype : dict
+    """
+
+    atomic_numbers = []
+    coordinates = []
+    for atom in pybel.ob.OBMolAtomIter(molecule.OBMol):
+        atomic_numbers.append(atom.GetAtomicNum())
+        coordinates.append([atom.GetX(), atom.GetY(), atom.GetZ()])
+
+    return {"atomic_numbers" : atomic_numbers, "coordinates" : coordinates}
+
+def _restore_embedding(molecule, embedding):
+    """Apply a previously computed 3D embedding to a freshly read molecule.
+    Hydrogens are added the same way make3D adds them, so atom order
+    matches the original embedding.
+
+    :param molecule: molecule as read from its linear representation
+    :type molecule : cinfony.pybel.Molecule
+    :param embedding: output of _embedding_data for the same input
+    :type embedding : dict
+    :return: molecule with 3D coordinates, or None if atoms do not match
+    :rtype : cinfony.pybel.Molecule
+    """
+
+    molecule.addh()
+    obmol = molecule.OBMol
+    atoms = list(pybel.ob.OBMolAtomIter(obmol))
+    atomic_numbers = [a.GetAtomicNum() for a in atoms]
+    if atomic_numbers != embedding["atomic_numbers"]:
+        return None
+
+    for atom, xyz in zip(atoms, embedding["coordinates"]):
+        atom.SetVector(*xyz)
+
+    obmol.SetDimension(3)
+    return molecule
+
+def _embed_worker(args):
+    """Generate a 3D embedding in a worker process. Errors are returned
+    rather than raised so that one bad item does not stop a batch.
+
+    :param args: linear representation, format, and make3D settings
+    :type args : tuple
+    :return: (embedding, None) on success or (None, error message)
+    :rtype : tuple
+    """
+
+    representation, fmt, settings = args
+    try:
+        molecule = pybel.readstring(fmt, representation)
+        molecule.make3D(**settings)
+        return (_embedding_data(molecule), None)
+    except Exception as e:
+        return (None, "{0}: {1}".format(type(e).__name__, e))
+
+def _value_kind(values):
+    """Classify property values for columnar storage, ignoring None.
+
+    :param values: property values
+    :type values : list | numpy.ndarray
+    :return: "category", "numeric" (all bools, all integers, or all
+    floats), "object", or None if all values are None
+    :rtype : str
+    """
+
+    if isinstance(values, numpy.ndarray):
+        if values.dtype.kind in "biuf":
+            return "numeric"
+        elif values.dtype.kind in "SU":
+            return "category"
+        values = values.tolist()
+
+    #bools, integers, and floats are told apart so that a group mixing
+    #them is kept as objects and each value reads back with its own type
+    kinds = set()
+    for v in values:
+        if v is None:
+            continue
+        elif isinstance(v, basestring):
+            kinds.add("category")
+        elif isinstance(v, (bool, numpy.bool_)):
+            kinds.add("bool")
+        elif isinstance(v, (int, long, numpy.integer)):
+            kinds.add("int")
+        elif isinstance(v, (float, numpy.floating)):
+            kinds.add("float")
+        else:
+            return "object"
+
+    if not kinds:
+        return None
+    elif len(kinds) > 1:
+        return "object"
+
+    kind = kinds.pop()
+    if kind == "category":
+        return kind
+    return "numeric"
+
+def _is_scalar(value):
+    """Decide whether a property value should be broadcast to a selection.
+
+    :param value: property value or sequence of values
+    :return: True if value is a single value
+    :rtype : bool
+    """
+
+    return isinstance(value, basestring) or not hasattr(value, "__len__")
+
+class PropertyColumn(object):
+    def __init__(self, kind, natoms, dtype=None):
+        """Create an empty column of per-atom property values. Values are
+        stored by kind:
+
+        "category": strings, as int32 codes into a list of categories
+        "numeric": numbers of one type, in a typed array (bool, int, or
+        float); storing another type converts the column to "object"
+        "object": anything else, in an object array
+
+        Missing values have code -1 (categories) or a False entry in the
+        validity mask (other kinds).
+
+        :param kind: "category", "numeric", or "object"
+        :type kind : str
+        :param natoms: number of atoms
+        :type natoms : int
+        :param dtype: array type for numeric columns
+        :type dtype : numpy.dtype
+        """
+
+        self.kind = kind
+        self.categories = []
+        self.lookup = {}
+        if kind == "category":
+            self.values = numpy.empty(natoms, dtype=numpy.int32)
+            self.values.fill(-1)
+        elif kind == "numeric":
+            self.values = numpy.zeros(natoms, dtype=dtype)
+        else:
+            self.values = numpy.empty(natoms, dtype=object)
+
+        self.mask = numpy.zeros(natoms, dtype=bool)
+
+    def __len__(self):
+        return len(self.values)
+
+    def copy(self):
+        """Return an independent copy of the column.
+
+        :return: copied column
+        :rtype : PropertyColumn
+        """
+
+        result = PropertyColumn.__new__(PropertyColumn)
+        result.kind = self.kind
+        result.categories = list(self.categories)
+        result.lookup = dict(self.lookup)
+        result.values = self.values.copy()
+        result.mask = self.mask.copy()
+        return result
+
+    def resize(self, natoms):
+        """Grow or shrink the column, filling any new entries as missing.
+
+        :param natoms: new number of atoms
+        :type natoms : int
+        """
+
+        n = min(natoms, len(self.values))
+        values = PropertyColumn(self.kind, natoms, self.values.dtype).values
+        mask = numpy.zeros(natoms, dtype=bool)
+        values[:n] = self.values[:n]
+        mask[:n] = self.mask[:n]
+        self.values = values
+        self.mask = mask
+
+    def take(self, source):
+        """Rearrange the column so that entry k holds the value that was at
+        entry source[k], or is missing where source[k] is -1.
+
+        :param source: old index for each new entry, -1 for none
+        :type source : list | numpy.ndarray
+        """
+
+        source = numpy.asarray(source, dtype=numpy.intp)
+        present = source >= 0
+        picked = source[present]
+        values = PropertyColumn(self.kind, len(source), self.values.dtype).values
+        mask = numpy.zeros(len(source), dtype=bool)
+        values[present] = self.values[picked]
+        mask[present] = self.mask[picked]
+        self.values = values
+        self.mask = mask
+
+    def to_object(self):
+        """Get the column as an object array with None for missing values.
+
+        :return: per-atom values
+        :rtype : numpy.ndarray
+        """
+
+        if self.kind == "category":
+            #code -1 selects the trailing None
+            categories = numpy.empty(len(self.categories) + 1, dtype=object)
+            categories[:-1] = self.categories
+            return categories[self.values]
+
+        expanded = self.values.astype(object)
+        expanded[~self.mask] = None
+        return expanded
+
+    def tolist(self):
+        """Get the column as a list of Python values, None for missing.
+
+        :return: per-atom values
+        :rtype : list
+        """
+
+        return self.to_object().tolist()
+
+    def _convert(self, kind, dtype=None):
+        """Change storage kind in place, keeping all values.
+
+        :param kind: "numeric" or "object"
+        :type kind : str
+        :param dtype: array type for numeric columns
+        :type dtype : numpy.dtype
+        """
+
+        if kind == "numeric":
+            self.values = self.values.astype(dtype)
+        else:
+            values = self.to_object()
+            self.mask = numpy.array([v is not None for v in values.tolist()],
+                                    dtype=bool)
+            self.values = values
+            self.categories = []
+            self.lookup = {}
+
+        self.kind = kind
+
+    def _codes(self, values):
+        """Get category codes for values, adding any new categories.
+
+        :param values: strings
+        :type values : list
+        :return: codes
+        :rtype : numpy.ndarray
+        """
+
+        lookup = self.lookup
+        codes = []
+        for v in values:
+            c = lookup.get(v)
+            if c is None:
+                c = len(self.categories)
+                self.categories.append(v)
+                lookup[v] = c
+            codes.append(c)
+
+        return numpy.array(codes, dtype=numpy.int32)
+
+    def assign(self, indices, values):
+        """Assign values to the atoms at indices. A single value is assigned
+        to every index. None marks an atom's value as missing.
+
+        :param indices: atom indexes
+        :type indices : list | numpy.ndarray
+        :param values: one value, or one value per index
+        :type values : list | numpy.ndarray
+        """
+
+        indices = numpy.asarray(indices, dtype=numpy.intp)
+        if _is_scalar(values):
+            values = [values]
+            broadcast = True
+        else:
+            broadcast = False
+
+        if isinstance(values, numpy.ndarray) and values.dtype.kind != "O":
+            missing = None
+        else:
+            values = list(values)
+            missing = numpy.array([v is None for v in values], dtype=bool)
+            if not missing.any():
+                missing = None
+
+        kind = _value_kind(values)
+        if kind is not None and kind != self.kind:
+            self._convert("object")
+
+        if missing is not None:
+            if broadcast:
+                self._set_missing(indices)
+                return
+
+            self._set_missing(indices[missing])
+            indices = indices[~missing]
+            values = [v for v in values if v is not None]
+
+        if self.kind == "category":
+            if isinstance(values, numpy.ndarray):
+                values = values.tolist()
+            stored = self._codes(values)
+        elif self.kind == "numeric":
+            stored = numpy.asarray(values)
+            if stored.dtype.kind == self.values.dtype.kind:
+                dtype = numpy.result_type(self.values.dtype, stored.dtype)
+                if dtype != self.values.dtype:
+                    self._convert("numeric", dtype)
+            else:
+                #e.g. ints into a bool column: keep both as they were given
+                self._convert("object")
+
+        if self.kind == "object":
+            stored = numpy.empty(len(values), dtype=object)
+            stored[:] = values
+
+        if broadcast:
+            stored = stored[0]
+
+        self.values[indices] = stored
+        self.mask[indices] = True
+
+    def _set_missing(self, indices):
+        """Mark the values at indices as missing.
+
+        :param indices: atom indexes
+        :type indices : numpy.ndarray
+        """
+
+        if self.kind == "category":
+            self.values[indices] = -1
+        elif self.kind == "object":
+            self.values[indices] = None
+
+        self.mask[indices] = False
+
+class PropertyTable(collections.Mapping):
+    def __init__(self, natoms):
+        """Create a table of per-atom property groups stored as typed columns
+        (see PropertyColumn). Looking up a group by name gives a new plain
+        list with None for missing values, copied from one kept until the
+        group changes. Use assign() for bulk updates.
+
+        Copies made with copy() share columns copy-on-write.
+
+        :param natoms: number of atoms
+        :type natoms : int
+        """
+
+        self.natoms = natoms
+        self.columns = {}
+        self._lists = {}
+        self._shared = set()
+
+    def __getitem__(self, name):
+        try:
+            values = self._lists[name]
+        except KeyError:
+            values = self.columns[name].tolist()
+            self._lists[name] = values
+
+        return list(values)
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def copy(self):
+        """Return a copy that shares columns with this table until either
+        table changes them.
+
+        :return: copied table
+        :rtype : PropertyTable
+        """
+
+        result = PropertyTable(self.natoms)
+        result.columns = dict(self.columns)
+        result._lists = dict(self._lists)
+        result._shared = set(self.columns)
+        self._shared |= result._shared
+        return result
+
+    def resize(self, natoms):
+        """Grow or shrink every column, filling new entries as missing.
+
+        :param natoms: new number of atoms
+        :type natoms : int
+        """
+
+        for name in list(self.columns):
+            self._writable(name).resize(natoms)
+
+        self.natoms = natoms
+
+    def take(self, source):
+        """Rearrange every column so that atom k gets the values of old atom
+        source[k], or missing values where source[k] is -1.
+
+        :param source: old atom index for each new atom, -1 for new atoms
+        :type source : list | numpy.ndarray
+        """
+
+        for name in list(self.columns):
+            self._writable(name).take(source)
+
+        self.natoms = len(source)
+
+    def _writable(self, name):
+        """Get a column for writing, copying it first if it is shared.
+
+        :param name: property group name
+        :type name : str
+        :return: column
+        :rtype : PropertyColumn
+        """
+
+        column = self.columns[name]
+        if name in self._shared:
+            column = column.copy()
+            self.columns[name] = column
+            self._shared.discard(name)
+
+        self._lists.pop(name, None)
+        return column
+
+    def assign(self, name, indices, values):
+        """Assign values in the named property group to the atoms at
+        indices, creating the group if needed.
+
+        :param name: name of property group, e.g. "basis_name"
+        :type name : str
+        :param indices: atom indexes
+        :type indices : list | numpy.ndarray
+        :param values: one value, or one value per index
+        :type values : list | numpy.ndarray
+        """
+
+        if name not in self.columns:
+            if _is_scalar(values):
+                kind = _value_kind([values])
+            else:
+                kind = _value_kind(values)
+
+            dtype = None
+            if kind == "numeric":
+                dtype = numpy.asarray(values).dtype
+                if dtype.kind not in "biuf":
+                    #e.g. integers too large for any integer array
+                    kind = "object"
+                    dtype = None
+            self.columns[name] = PropertyColumn(kind or "object", self.natoms,
+                                                dtype)
+
+        self._writable(name).assign(indices, values)
+
+    def set_categories(self, name, categories, codes):
+        """Replace the named property group with precomputed category codes.
+
+        :param name: name of property group
+        :type name : str
+        :param categories: category strings
+        :type categories : list
+        :param codes: per-atom codes into categories, -1 for missing
+        :type codes : numpy.ndarray
+        """
+
+        column = PropertyColumn("category", 0)
+        column.categories = list(categories)
+        column.lookup = dict((c, k) for k, c in enumerate(column.categories))
+        column.values = numpy.asarray(codes, dtype=numpy.int32)
+        column.mask = column.values >= 0
+        self.columns[name] = column
+        self._shared.discard(name)
+        self._lists.pop(name, None)
+
+    def assign_categories(self, name, indices, categories, codes):
+        """Assign string values given as codes into a list of categories to
+        the atoms at indices, without looking at each value separately.
+
+        :param name: name of property group
+        :type name : str
+        :param indices: atom indexes
+        :type indices : list | numpy.ndarray
+        :param categories: category strings
+        :type categories : list
+        :param codes: one code into categories per index
+        :type codes : numpy.ndarray
+        """
+
+        if name not in self.columns:
+            self.columns[name] = PropertyColumn("category", self.natoms)
+
+        column = self._writable(name)
+        if column.kind != "category":
+            values = numpy.empty(len(categories), dtype=object)
+            values[:] = categories
+            column.assign(indices, values[codes])
+            return
+
+        remap = column._codes(categories)
+        indices = numpy.asarray(indices, dtype=numpy.intp)
+        column.values[indices] = remap[codes]
+        column.mask[indices] = True
+
+    def to_object(self, name):
+        """Get the named property group as an object array with None for
+        missing values, or all None if the group does not exist.
+
+        :param name: name of property group
+        :type name : str
+        :return: per-atom values
+        :rtype : numpy.ndarray
+        """
+
+        try:
+            return self.columns[name].to_object()
+        except KeyError:
+            return numpy.empty(self.natoms, dtype=object)
+
+def _kabsch(reference, targets):
+    """Find the optimal superposition of each target onto reference, with
+    atoms already in corresponding order (Kabsch algorithm, done for all
+    targets at once).
+
+    :param reference: reference coordinates, shape (N, 3)
+    :type reference : numpy.ndarray
+    :param targets: target coordinates, shape (M, N, 3)
+    :type targets : numpy.ndarray
+    :return: RMSD per target, rotation matrices (M, 3, 3), target centroids (M, 3), and reference centroid
+    :rtype : tuple
+    """
+
+    ref_center = reference.mean(axis=0)
+    ref = reference - ref_center
+    centers = targets.mean(axis=1)
+    tgt = targets - centers[:, None, :]
+
+    covariance = numpy.einsum("mni,nj->mij", tgt, ref)
+    U, S, Vt = numpy.linalg.svd(covariance)
+
+    #flip the smallest axis where needed to get proper rotations
+    d = numpy.sign(numpy.linalg.det(U) * numpy.linalg.det(Vt))
+    U[:, :, 2] *= d[:, None]
+    S[:, 2] *= d
+    rotations = numpy.einsum("mij,mjk->mik", U, Vt)
+
+    e0 = (ref * ref).sum() + (tgt * tgt).sum(axis=(1, 2))
+    msd = (e0 - 2.0 * S.sum(axis=1)) / len(reference)
+    rmsd = numpy.sqrt(numpy.maximum(msd, 0.0))
+
+    return rmsd, rotations, centers, ref_center
+
+#per-process alignment state, set up once per worker by _alignment_init
+_alignment = {}
+
+def _alignment_init(payloads, includeH, symmetry):
+    """Set up alignment state for a batch of molecules. The Kabsch path is
+    used when symmetry is not requested and all molecules have the same
+    atoms in the same order; otherwise OBAlign is used.
+
+    :param payloads: (atomic numbers, coordinates, bonds) per molecule
+    :type payloads : list
+    :param includeH: if False, fit only heavy atoms
+    :type includeH : bool
+    :param symmetry: if True, allow for symmetry-equivalent atoms (OBAlign)
+    :type symmetry : bool
+    """
+
+    _alignment.clear()
+    _alignment["payloads"] = payloads
+    _alignment["includeH"] = includeH
+    _alignment["symmetry"] = symmetry
+
+    first = payloads[0][0]
+    kabsch = not symmetry and all([numpy.array_equal(first, p[0])
+                                   for p in payloads])
+    _alignment["kabsch"] = kabsch
+    if kabsch:
+        coordinates = numpy.array([p[1] for p in payloads], dtype=float)
+        if includeH:
+            fitted = coordinates
+        else:
+            fitted = coordinates[:, numpy.asarray(first) != 1, :]
+
+        _alignment["coordinates"] = coordinates
+        _alignment["fitted"] = fitted
+    else:
+        _alignment["molecules"] = {}
+        _alignment["aligner"] = pybel.ob.OBAlign(includeH, symmetry)
+
+def _alignment_molecule(k):
+    """Get OBMol for molecule k of the current batch, built on first use.
+
+    :param k: molecule index
+    :type k : int
+    :return: molecule
+    :rtype : openbabel.OBMol
+    """
+
+    molecules = _alignment["molecules"]
+    if k not in molecules:
+        atomic_numbers, coordinates, bonds = _alignment["payloads"][k]
+        molecules[k] = _build_obmol(atomic_numbers, coordinates, bonds)
+
+    return molecules[k]
+
+def _rmsd_row_worker(i):
+    """Get RMSD of molecule i to every later molecule in the batch.
+
+    :param i: molecule index
+    :type i : int
+    :return: i and RMSD values for molecules i + 1 onward
+    :rtype : tuple
+    """
+
+    if _alignment["kabsch"]:
+        fitted = _alignment["fitted"]
+        rmsd = _kabsch(fitted[i], fitted[i + 1:])[0]
+        return i, rmsd
+
+    aligner = _alignment["aligner"]
+    aligner.SetRefMol(_alignment_molecule(i))
+    rmsd = []
+    for j in range(i + 1, len(_alignment["payloads"])):
+        aligner.SetTargetMol(_alignment_molecule(j))
+        aligner.Align()
+        rmsd.append(aligner.GetRMSD())
+
+    return i, numpy.array(rmsd)
+
+def _align_worker(j):
+    """Align molecule j of the batch onto molecule 0.
+
+    :param j: molecule index
+    :type j : int
+    :return: j, RMSD, and aligned coordinates of all atoms
+    :rtype : tuple
+    """
+
+    if _alignment["kabsch"]:
+        fitted = _alignment["fitted"]
+        rmsd, rotations, centers, ref_center = _kabsch(fitted[0],
+                                                       fitted[j:j + 1])
+        coordinates = _alignment["coordinates"][j]
+        aligned = numpy.dot(coordinates - centers[0], rotations[0]) + ref_center
+        return j, float(rmsd[0]), aligned
+
+    aligner = _alignment["aligner"]
+    aligner.SetRefMol(_alignment_molecule(0))
+    aligner.SetTargetMol(_alignment_molecule(j))
+    aligner.Align()
+
+    copied = pybel.ob.OBMol(_alignment_molecule(j))
+    aligner.UpdateCoords(copied)
+    aligned = numpy.array([[a.GetX(), a.GetY(), a.GetZ()]
+                           for a in pybel.ob.OBMolAtomIter(copied)])
+    return j, aligner.GetRMSD(), aligned
+
+def _run_alignment(payloads, includeH, symmetry, worker, tasks, workers):
+    """Run alignment tasks over a batch of molecules, in a pool of worker
+    processes if workers > 1.
+
+    :param payloads: (atomic numbers, coordinates, bonds) per molecule
+    :type payloads : list
+    :param includeH: if False, fit only heavy atoms
+    :type includeH : bool
+    :param symmetry: if True, allow for symmetry-equivalent atoms (OBAlign)
+    :type symmetry : bool
+    :param worker: task function
+    :type worker : function
+    :param tasks: task arguments
+    :type tasks : list
+    :param workers: number of worker processes
+    :type workers : int
+    :return: task results, in completion order
+    :rtype : list
+    """
+
+    #nothing to align, e.g. fewer than two fragments
+    if not tasks:
+        return []
+
+    initargs = (payloads, includeH, symmetry)
+    if workers <= 1 or len(tasks) < 2:
+        _alignment_init(*initargs)
+        try:
+            results = [worker(t) for t in tasks]
+        finally:
+            _alignment.clear()
+
+        return results
+
+    chunksize = max(1, len(tasks) // (4 * workers))
+    pool = multiprocessing.Pool(workers, _alignment_init, initargs)
+    try:
+        results = list(pool.imap_unordered(worker, tasks, chunksize))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return results
+
+class MCSMatch(collections.namedtuple("MCSMatch",
+                                      ["numAtoms", "numBonds", "smarts",
+                                       "completed"])):
+    """Maximum common substructure result, as returned by Geotool.mcs. It
+    has the attributes of rdkit.Chem.MCS.MCSResult (numAtoms, numBonds,
+    smarts, and completed) and, like it, is false if no common
+    substructure was found. Unlike it, it is an immutable tuple that can
+    be pickled, since results are shared through the MCS cache and sent
+    back from worker processes.
+    """
+
+    __slots__ = ()
+
+    def __nonzero__(self):
+        return self.smarts is not None
+
+#MCS results keyed by the set of canonical SMILES searched and the search
+#options; each entry also records the time budget it was found with
+_mcs_results = LRUCache(1024)
+
+def _find_mcs(smiles, timeout, options):
+    """Run an RDKit maximum common substructure search over molecules given
+    as SMILES.
+
+    :param smiles: SMILES representations
+    :type smiles : list
+    :param timeout: time budget in seconds, or None for no limit
+    :type timeout : float
+    :param options: additional keyword arguments for rdkit.Chem.MCS.FindMCS
+    :type options : dict
+    :return: search result
+    :rtype : MCSMatch
+    """
+
+    try:
+        global MCS
+        global rdk
+        MCS
+    except NameError:
+        from rdkit.Chem import MCS
+        from cinfony import rdk
+
+    rf = [rdk.readstring("smi", s).Mol for s in smiles]
+    cs = MCS.FindMCS(rf, timeout=timeout, **options)
+
+    return MCSMatch(cs.numAtoms, cs.numBonds, cs.smarts, cs.completed)
+
+def _mcs_worker(args):
+    """Find maximum common substructure in a worker process.
+
+    :param args: cache key, SMILES, timeout, and FindMCS options
+    :type args : tuple
+    :return: cache key and search result
+    :rtype : tuple
+    """
+
+    key, smiles, timeout, options = args
+    return key, _find_mcs(smiles, timeout, options)
+
+def _lines(handle):
+    """Generate lines from a file handle along with the byte offset where
+    each line starts. Uses readline() so offsets stay exact.
+
+    :param handle: file handle
+    :type handle : file
+    :return: (offset, line) pairs
+    :rtype : generator
+    """
+
+    try:
+        offset = handle.tell()
+    except (AttributeError, IOError):
+        offset = 0
+
+    while True:
+        line = handle.readline()
+        if not line:
+            break
+
+        yield offset, line
+        offset += len(line)
+
+def _sdf_records(handle):
+    """Split SDF/MOL data into records terminated by $$$$.
+
+    :param handle: file handle
+    :type handle : file
+    :return: (offset, record text) pairs
+    :rtype : generator
+    """
+
+    start = None
+    lines = []
+    for offset, line in _lines(handle):
+        if start is None:
+            start = offset
+        lines.append(line)
+        if line.strip() == "$$$$":
+            yield start, "".join(lines)
+            start = None
+            lines = []
+
+    if "".join(lines).strip():
+        yield start, "".join(lines)
+
+def _xyz_records(handle):
+    """Split multi-frame XYZ data into records, each an atom count line,
+    a comment line, and one line per atom.
+
+    :param handle: file handle
+    :type handle : file
+    :return: (offset, record text) pairs
+    :rtype : generator
+    """
+
+    lines = _lines(handle)
+    for start, line in lines:
+        if not line.strip():
+            continue
+
+        try:
+            count = int(line.split()[0])
+        except ValueError:
+            raise ValueError("Expected XYZ atom count at byte {0}, got {1}".format(start, repr(line)))
+
+        record = [line]
+        for offset, line in itertools.islice(lines, count + 1):
+            record.append(line)
+
+        yield start, "".join(record)
+
+def _mol2_records(handle):
+    """Split MOL2 data into records, each starting at @<TRIPOS>MOLECULE.
+
+    :param handle: file handle
+    :type handle : file
+    :return: (offset, record text) pairs
+    :rtype : generator
+    """
+
+    start = None
+    lines = []
+    for offset, line in _lines(handle):
+        if line.startswith("@<TRIPOS>MOLECULE"):
+            #comments before the first molecule belong to it
+            if start is not None:
+                yield start, "".join(lines)
+                lines = []
+            start = offset
+        lines.append(line)
+
+    if start is not None:
+        yield start, "".join(lines)
+
+#formats that can be split into records without parsing them
+_record_splitters = {"sdf" : _sdf_records, "sd" : _sdf_records,
+                     "mol" : _sdf_records, "mdl" : _sdf_records,
+                     "xyz" : _xyz_records, "mol2" : _mol2_records}
+
+def _file_format(name, fmt):
+    """Get explicit fmt, or guess it from the extension of file name.
+
+    :param name: file name
+    :type name : str
+    :param fmt: optional OpenBabel format code e.g. "xyz"
+    :type fmt : str
+    :return: format code
+    :rtype : str
+    """
+
+    if not fmt:
+        try:
+            fmt = name.rsplit(".", 1)[1]
+        except (IndexError, AttributeError):
+            msg = "No fmt given for {0} and unable to guess from file extension".format(repr(name))
+            raise ValueError(msg)
+
+    return fmt.lower()
+
+def _conformer_worker(args):
+    """Generate conformers by random rotor search in a worker process.
+
+    :param args: (atomic numbers, coordinates, bonds), force field name, number of conformers to generate, and optimization steps per conformer
+    :type args : tuple
+    :return: energy and coordinates of each conformer
+    :rtype : list
+    """
+
+    (atomic_numbers, coordinates, bonds), forcefield, count, steps = args
+    obmol = _build_obmol(atomic_numbers, coordinates, bonds)
+    ff = pybel.ob.OBForceField.FindForceField(forcefield)
+    if ff is None or not ff.Setup(obmol):
+        raise ValueError("Unable to set up force field {0}".format(repr(forcefield)))
+
+    ff.RandomRotorSearch(count, steps)
+    ff.GetConformers(obmol)
+
+    conformers = []
+    for k in range(obmol.NumConformers()):
+        obmol.SetConformer(k)
+        ff.SetCoordinates(obmol)
+        xyz = numpy.array([[a.GetX(), a.GetY(), a.GetZ()]
+                           for a in pybel.ob.OBMolAtomIter(obmol)])
+        conformers.append((ff.Energy(False), xyz))
+
+    return conformers
+
+class ConformerEnsemble(object):
+    def __init__(self, energy_window=10.0, rmsd_threshold=0.5,
+                 energy_tolerance=None, fitted=None):
+        """Create an ensemble of conformers that rejects near-duplicates as
+        they are added. A conformer is kept only if its energy is within
+        energy_window of the lowest energy seen and it is not within
+        rmsd_threshold of a kept conformer, so no two kept conformers are
+        duplicates. If energy_tolerance is given, only conformers with
+        energies within energy_tolerance of each other are compared, and
+        only those pairs are guaranteed distinct.
+
+        Atoms must be in the same order in every conformer.
+
+        :param energy_window: energy window above the minimum
+        :type energy_window : float
+        :param rmsd_threshold: RMSD (Angstroms) below which conformers are duplicates
+        :type rmsd_threshold : float
+        :param energy_tolerance: optional energy difference beyond which conformers are never duplicates
+        :type energy_tolerance : float
+        :param fitted: optional mask of atoms to use for RMSD, e.g. heavy atoms
+        :type fitted : numpy.ndarray
+        """
+
+        self.energy_window = energy_window
+        self.rmsd_threshold = rmsd_threshold
+        self.energy_tolerance = energy_tolerance
+        self.fitted = fitted
+        self.minimum = None
+        self.members = {}
+        self._ids = itertools.count()
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, energy, coordinates):
+        """Add a conformer unless it is out of the energy window or
+        duplicates a kept conformer with lower or equal energy. Otherwise
+        it replaces every kept conformer it duplicates.
+
+        :param energy: conformer energy
+        :type energy : float
+        :param coordinates: conformer coordinates, shape (N, 3)
+        :type coordinates : numpy.ndarray
+        :return: True if conformer was kept
+        :rtype : bool
+        """
+
+        if self.minimum is not None and energy > self.minimum + self.energy_window:
+            return False
+
+        coordinates = numpy.asarray(coordinates, dtype=numpy.float64)
+        fitted = self.fitted
+        if fitted is None:
+            fitted = slice(None)
+
+        #ensembles are small, so compare against every kept conformer
+        nearby = self.members.keys()
+        if self.energy_tolerance is not None:
+            nearby = [k for k in nearby
+                      if abs(self.members[k][0] - energy) <= self.energy_tolerance]
+
+        if nearby:
+            stack = numpy.array([self.members[k][1][fitted] for k in nearby])
+            rmsd = _kabsch(coordinates[fitted], stack)[0]
+            duplicates = [k for k, r in zip(nearby, rmsd.tolist())
+                          if r < self.rmsd_threshold]
+            if any(energy >= self.members[k][0] for k in duplicates):
+                return False
+
+            for k in duplicates:
+                del self.members[k]
+
+        k = next(self._ids)
+        self.members[k] = (energy, coordinates)
+
+        if self.minimum is None or energy < self.minimum:
+            self.minimum = energy
+            limit = energy + self.energy_window
+            for k in [k for k, m in self.members.items() if m[0] > limit]:
+                del self.members[k]
+
+        return True
+
+    @property
+    def energies(self):
+        """Energies of kept conformers in increasing order.
+
+        :return: energies
+        :rtype : numpy.ndarray
+        """
+
+        return numpy.array(sorted([m[0] for m in self.members.values()]))
+
+    @property
+    def coordinates(self):
+        """Coordinates of kept conformers in order of increasing energy.
+
+        :return: coordinates, shape (M, N, 3)
+        :rtype : numpy.ndarray
+        """
+
+        ordered = sorted(self.members.values(), key=lambda m: m[0])
+        return numpy.array([m[1] for m in ordered])
+
+def _within_distance(coordinates, centers, cutoff, chunk=256):
+    """Find points within cutoff of any center by comparing against every
+    center, a chunk of centers at a time to bound memory use.
+
+    :param coordinates: point coordinates, shape (N, 3)
+    :type coordinates : numpy.ndarray
+    :param centers: center coordinates, shape (M, 3)
+    :type centers : numpy.ndarray
+    :param cutoff: distance in Angstroms
+    :type cutoff : float
+    :param chunk: number of centers compared at a time
+    :type chunk : int
+    :return: mask of points within cutoff
+    :rtype : numpy.ndarray
+    """
+
+    within = numpy.zeros(len(coordinates), dtype=bool)
+    limit = cutoff * cutoff
+    for start in range(0, len(centers), chunk):
+        block = centers[start:start + chunk]
+        deltas = coordinates[:, None, :] - block[None, :, :]
+        d2 = (deltas * deltas).sum(axis=2)
+        within |= (d2 <= limit).any(axis=1)
+
+    return within
+
+class NeighborIndex(object):
+    #cell coordinates are offset and packed into one int64 key per cell
+    cell_bias = 2 ** 20
+    cell_span = 2 ** 21
+
+    def __init__(self, cell_size=4.0):
+        """Create a cell list index for finding atoms near points in space.
+        Atoms are binned into cubic cells of cell_size Angstroms; a query
+        only measures distances to atoms in cells that can be in range.
+
+        Coordinates are given in blocks (one per fragment) with a revision
+        key per block. Updating the index only re-bins blocks whose key
+        changed.
+
+        :param cell_size: cell edge length in Angstroms
+        :type cell_size : float
+        """
+
+        self.cell_size = float(cell_size)
+        self.block_keys = []
+        self.offsets = [0]
+        self.coordinates = numpy.zeros((0, 3))
+        self.keys = numpy.zeros(0, dtype=numpy.int64)
+        self.order = numpy.zeros(0, dtype=numpy.intp)
+        self.sorted_keys = self.keys
+        self.occupied = self.keys
+        self.occupied_cells = numpy.zeros((0, 3), dtype=numpy.int64)
+        self.low_cell = numpy.zeros(3, dtype=numpy.int64)
+        self.high_cell = numpy.zeros(3, dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def cells(self, coordinates):
+        """Get integer cell coordinates of points.
+
+        :param coordinates: point coordinates, shape (N, 3)
+        :type coordinates : numpy.ndarray
+        :return: cell coordinates, shape (N, 3)
+        :rtype : numpy.ndarray
+        """
+
+        return numpy.floor(coordinates / self.cell_size).astype(numpy.int64)
+
+    def cell_keys(self, cells):
+        """Pack integer cell coordinates into one key per cell.
+
+        :param cells: cell coordinates, shape (N, 3)
+        :type cells : numpy.ndarray
+        :return: cell keys
+        :rtype : numpy.ndarray
+        """
+
+        biased = cells + self.cell_bias
+        span = self.cell_span
+        return (biased[:, 0] * span + biased[:, 1]) * span + biased[:, 2]
+
+    def update(self, blocks):
+        """Bring the index up to date with blocks of coordinates. Blocks with
+        an unchanged key are skipped; if the number or sizes of blocks
+        changed, everything is re-binned.
+
+        :param blocks: (revision key, coordinates) per block
+        :type blocks : list
+        """
+
+        sizes = [len(c) for k, c in blocks]
+        offsets = [0]
+        for size in sizes:
+            offsets.append(offsets[-1] + size)
+
+        if offsets != self.offsets:
+            self.offsets = offsets
+            self.block_keys = [None] * len(blocks)
+            self.coordinates = numpy.zeros((offsets[-1], 3))
+            self.keys = numpy.zeros(offsets[-1], dtype=numpy.int64)
+
+        changed = False
+        for j, (key, coordinates) in enumerate(blocks):
+            if key is not None and key == self.block_keys[j]:
+                continue
+
+            start, stop = offsets[j], offsets[j + 1]
+            self.coordinates[start:stop] = coordinates
+            self.keys[start:stop] = self.cell_keys(self.cells(coordinates))
+            self.block_keys[j] = key
+            changed = True
+
+        if changed:
+            self.order = numpy.argsort(self.keys, kind="mergesort")
+            self.sorted_keys = self.keys[self.order]
+
+            #distinct occupied cells and the box holding them bound every
+            #search, however far it reaches
+            first = numpy.ones(len(self.sorted_keys), dtype=bool)
+            first[1:] = self.sorted_keys[1:] != self.sorted_keys[:-1]
+            self.occupied = self.sorted_keys[first]
+            self.occupied_cells = self._unpack(self.occupied)
+            if len(self.occupied):
+                self.low_cell = self.occupied_cells.min(axis=0)
+                self.high_cell = self.occupied_cells.max(axis=0)
+
+    def candidates(self, centers, reach):
+        """Get indexes of atoms in all cells within reach cells of the cell
+        of any center.
+
+        :param centers: center coordinates, shape (M, 3)
+        :type centers : numpy.ndarray
+        :param reach: search distance in cells
+        :type reach : int
+        :return: atom indexes
+        :rtype : numpy.ndarray
+        """
+
+        empty = numpy.zeros(0, dtype=numpy.intp)
+        if not len(self.occupied):
+            return empty
+
+        center_cells = numpy.unique(self.cell_keys(self.cells(centers)))
+        center_cells = self._unpack(center_cells)
+
+        #shifts that land outside the box of occupied cells for every
+        #center can never find an atom
+        lower = numpy.maximum(-reach, self.low_cell - center_cells.max(axis=0))
+        upper = numpy.minimum(reach, self.high_cell - center_cells.min(axis=0))
+        if (upper < lower).any():
+            return empty
+
+        widths = upper - lower + 1
+        if widths.prod() > len(self.occupied):
+            #more cells to visit around each center than there are occupied
+            #cells: test occupied cells against the centers instead
+            keep = numpy.zeros(len(self.occupied), dtype=bool)
+            step = max(1, 2 ** 20 // len(self.occupied))
+            for start in range(0, len(center_cells), step):
+                block = center_cells[start:start + step]
+                gaps = numpy.abs(self.occupied_cells[None, :, :] -
+                                 block[:, None, :]).max(axis=2)
+                keep |= (gaps <= reach).any(axis=0)
+            keys = self.occupied[keep]
+        else:
+            shifts = numpy.indices(widths).reshape(3, -1).T + lower
+            nearby = (center_cells[:, None, :] +
+                      shifts[None, :, :]).reshape(-1, 3)
+            keys = numpy.unique(self.cell_keys(nearby))
+
+        left = numpy.searchsorted(self.sorted_keys, keys, side="left")
+        right = numpy.searchsorted(self.sorted_keys, keys, side="right")
+        present = right > left
+        slices = [self.order[l:r] for l, r in zip(left[present].tolist(),
+                                                  right[present].tolist())]
+        if not slices:
+            return empty
+
+        return numpy.concatenate(slices)
+
+    def _unpack(self, keys):
+        """Unpack cell keys to integer cell coordinates.
+
+        :param keys: cell keys
+        :type keys : numpy.ndarray
+        :return: cell coordinates, shape (N, 3)
+        :rtype : numpy.ndarray
+        """
+
+        span = self.cell_span
+        cells = numpy.column_stack([keys // (span * span),
+                                    (keys // span) % span,
+                                    keys % span])
+        return cells - self.cell_bias
+
+    def within(self, centers, radius):
+        """Find atoms within radius of any center.
+
+        :param centers: center coordinates, shape (M, 3)
+        :type centers : numpy.ndarray
+        :param radius: distance in Angstroms
+        :type radius : float
+        :return: sorted atom indexes
+        :rtype : numpy.ndarray
+        """
+
+        centers = numpy.asarray(centers, dtype=numpy.float64).reshape(-1, 3)
+        if not len(centers) or not len(self):
+            return numpy.zeros(0, dtype=numpy.intp)
+
+        reach = int(numpy.ceil(radius / self.cell_size))
+        candidates = self.candidates(centers, reach)
+        near = _within_distance(self.coordinates[candidates], centers, radius)
+        return numpy.sort(candidates[near])
+
+    def nearest(self, point, k):
+        """Find the k atoms nearest to a point. The search starts at the
+        first cells that hold any atoms and doubles its reach until the k
+        nearest atoms are certain.
+
+        :param point: point coordinates
+        :type point : numpy.ndarray
+        :param k: number of atoms to find
+        :type k : int
+        :return: atom indexes in order of increasing distance
+        :rtype : numpy.ndarray
+        """
+
+        point = numpy.asarray(point, dtype=numpy.float64).reshape(1, 3)
+        k = min(k, len(self))
+        if k <= 0:
+            return numpy.zeros(0, dtype=numpy.intp)
+
+        #past this reach, every atom is a candidate
+        cell = self.cells(point)[0]
+        low, high = self.low_cell, self.high_cell
+        farthest = max(numpy.abs(cell - low).max(), numpy.abs(high - cell).max())
+
+        #no atom is closer than the box of occupied cells
+        gap = numpy.maximum(low - cell, cell - high).max()
+        reach = max(1, int(gap))
+        while True:
+            if reach >= farthest:
+                candidates = numpy.arange(len(self))
+            else:
+                candidates = self.candidates(point, reach)
+
+            if len(candidates) >= k:
+                deltas = self.coordinates[candidates] - point
+                d2 = (deltas * deltas).sum(axis=1)
+                nearest = numpy.argsort(d2, kind="mergesort")[:k]
+
+                #every atom closer than the searched reach has been seen
+                covered = reach * self.cell_size
+                if reach >= farthest or d2[nearest[-1]] <= covered * covered:
+                    return candidates[nearest]
+
+            reach *= 2
 
 class System(object):
     def __init__(self, fragment_or_fragments, spin=None, title=None):
@@ -26,7 +1447,96 @@ class System(object):
 
         self.explicit_spin = spin
         self.explicit_title = title
-        self.explicit_atom_properties = {}
+        self._property_revision = next(_revisions)
+        self._cache = {}
+        self._neighbors = None
+        self.explicit_atom_properties = PropertyTable(self.natoms)
+
+    def __getstate__(self):
+        """Drop cached derived data when copying or pickling a system.
+
+        :return: instance state without caches
+        :rtype : dict
+        """
+
+        state = self.__dict__.copy()
+        state["_cache"] = {}
+        state["_neighbors"] = None
+        return state
+
+    def to_bytes(self):
+        """Serialize the system, including all fragments and explicit
+        system-level values, in a compact binary form. See from_bytes.
+
+        :return: serialized system
+        :rtype : str
+        """
+
+        packer = _Packer()
+        meta = {"fragments" : [_pack_fragment(f, packer)
+                               for f in self.fragments],
+                "spin" : self.explicit_spin,
+                "title" : self.explicit_title,
+                "natoms" : self.natoms,
+                "properties" : _pack_properties(self._explicit_properties(),
+                                                packer)}
+        return _pack(1, meta, packer)
+
+    def _cached(self, name, key, build):
+        """Return a derived value from the system cache if it was built
+        under the same key, otherwise build and cache it.
+
+        :param name: name of the cached value
+        :type name : str | tuple
+        :param key: revision key the value must match to be reused
+        :type key : tuple
+        :param build: function of no arguments that builds the value
+        :type build : function
+        :return: cached or freshly built value
+        """
+
+        try:
+            cached_key, value = self._cache[name]
+            if cached_key == key:
+                return value
+        except KeyError:
+            pass
+
+        value = build()
+        self._cache[name] = (key, value)
+        return value
+
+    def _topology_key(self):
+        """Key that changes whenever fragments are added, removed,
+        reordered, or change their atoms.
+
+        :return: revision key
+        :rtype : tuple
+        """
+
+        return tuple([(id(f), f._topology_revision) for f in self.fragments])
+
+    def _geometry_key(self):
+        """Key that changes whenever the topology key changes or any
+        fragment's coordinates change.
+
+        :return: revision key
+        :rtype : tuple
+        """
+
+        return tuple([(id(f), f._geometry_revision) for f in self.fragments])
+
+    def _property_key(self):
+        """Key that changes whenever the topology key changes or any
+        system-level or fragment-level atom properties change.
+
+        :return: revision key
+        :rtype : tuple
+        """
+
+        fragment_key = tuple([(id(f), f._topology_revision,
+                               f._property_revision) for f in self.fragments])
+        return (self._property_revision, fragment_key)
 
     @property
     def charge(self):
@@ -107,54 +1617,140 @@ class System(object):
         
         self.explicit_spin = s
 
+    @property
+    def offsets(self):
+        """Get the index of the first atom of each fragment in the flat
+        system atom numbering, followed by the total number of atoms. Atoms
+        of fragment k are numbered offsets[k] through offsets[k + 1] - 1.
+
+        :return: fragment offset table, one longer than the fragment list
+        :rtype : list
+        """
+
+        def build():
+            offsets = [0]
+            for f in self.fragments:
+                offsets.append(offsets[-1] + f.natoms)
+
+            return offsets
+
+        return self._cached("offsets", self._topology_key(), build)
+
+    @property
+    def natoms(self):
+        """Return number of atoms in system
+
+        :return: number of atoms
+        :rtype : int
+        """
+
+        return self.offsets[-1]
+
     @property
     def atoms(self):
         """Get all atoms in a system as a concatenated list of atoms in each
-        fragment in the system.
+        fragment in the system. The list is cached until fragments change,
+        so do not modify it.
 
         :return: all system atoms
         :rtype : list
         """
 
-        atoms = []
-        for f in self.fragments:
-            atoms += f.atoms
+        def build():
+            atoms = []
+            for f in self.fragments:
+                atoms += f.atoms
+
+            return atoms
+
+        return self._cached("atoms", self._topology_key(), build)
+
+    @property
+    def coordinates(self):
+        """Get coordinates of all atoms in a system as one read-only (N, 3)
+        array, cached until any fragment geometry changes.
+
+        :return: all system atom coordinates
+        :rtype : numpy.ndarray
+        """
+
+        def build():
+            coordinates = numpy.concatenate([f.coordinates for f in self.fragments])
+            coordinates.flags.writeable = False
+            return coordinates
+
+        return self._cached("coordinates", self._geometry_key(), build)
+
+    @property
+    def atomic_numbers(self):
+        """Get atomic numbers of all atoms in system order.
+
+        :return: atomic numbers
+        :rtype : numpy.ndarray
+        """
+
+        def build():
+            numbers = numpy.concatenate([f.atomic_numbers
+                                         for f in self.fragments])
+            numbers.flags.writeable = False
+            return numbers
 
-        return atoms
+        return self._cached("atomic_numbers", self._topology_key(), build)
 
     def atom_properties(self, name):
         """Get named atom properties from explicit system properties or from
-        the underlying fragments in the system.
+        the underlying fragments in the system. The merged values are cached
+        until properties or fragments change; each call returns a new list.
 
         :return: per-atom properties across all atoms
         :rtype : list
         """
 
-        fragment_props = []
-        for f in self.fragments:
-            try:
-                p = f.atom_properties[name]
-            except KeyError:
-                p = [None] * len(f.atoms)
-                
-            fragment_props += p
-
-        e_props = self.explicit_atom_properties.get(name,
-                                                    [None] * len(self.atoms))
-        properties = []
-
-        #try to get properties from explicit system-level values first, then
-        #attempt to fill in from fragment properties if explicit data absent
-        for k in range(len(e_props)):
-            e_p = e_props[k]
-            if e_p is not None:
-                properties.append(e_p)
-            else:
-                f_p = fragment_props[k]
-                properties.append(f_p)
+        def build():
+            return self._property_array(name).tolist()
+
+        key = self._property_key()
+        return list(self._cached(("atom_properties", name), key, build))
+
+    def _property_array(self, name):
+        """Merge named atom properties from explicit system properties and
+        fragment properties into one object array.
+
+        :param name: name of property group
+        :type name : str
+        :return: per-atom properties across all atoms
+        :rtype : numpy.ndarray
+        """
+
+        fragment_props = [f.atom_properties.to_object(name)
+                          for f in self.fragments]
+        properties = numpy.concatenate(fragment_props)
+
+        explicit = self._explicit_properties()
+        if name in explicit:
+            #try to get properties from explicit system-level values first,
+            #then fill in from fragment properties if explicit data absent
+            column = explicit.columns[name]
+            properties = numpy.where(column.mask, column.to_object(),
+                                     properties)
 
         return properties
 
+    def _explicit_properties(self):
+        """Get the table of explicit system-level atom properties, resized
+        first if fragments were added or removed since it was created.
+
+        :return: explicit atom properties
+        :rtype : PropertyTable
+        """
+
+        explicit = self.explicit_atom_properties
+        natoms = self.natoms
+        if explicit.natoms != natoms:
+            explicit.resize(natoms)
+
+        return explicit
+
     def set_properties(self, name, selection, properties):
         """Assign properties grouped by name to selected atoms. Any unselected
         atoms will get a None property.
@@ -162,24 +1758,119 @@ class System(object):
         :param name: name of property group, e.g. "basis_name", "fukui_mu_n(+)"
         :type name : str
         :param selection: atom indices
-        :type selection : list
-        :param properties: any sequence of values, length same as selection
-        :type properties : list
+        :type selection : list | numpy.ndarray
+        :param properties: sequence of values, length same as selection, or one value for every selected atom
+        :type properties : list | numpy.ndarray | object
+        """
+
+        if not _is_scalar(properties):
+            slen = len(selection)
+            plen = len(properties)
+            if slen != plen:
+                raise ValueError("Got selection of {0} atoms but {1} properties: {2} {3}".format(slen, plen, selection, properties))
+
+        self._explicit_properties().assign(name, selection, properties)
+        self._property_revision = next(_revisions)
+
+    def geometry_hash(self, tolerance=0.00001):
+        """Get a content hash of the system that is the same for any system
+        with the same atoms, bonds, coordinates (to within tolerance),
+        charge, spin, and atom properties, regardless of atom order or how
+        atoms are divided into fragments. The hash is cached until the
+        system or its fragments change.
+
+        :param tolerance: coordinate grid spacing in Angstroms
+        :type tolerance : float
+        :return: hex digest
+        :rtype : str
+        """
+
+        charge = self.charge
+        spin = self.spin
+
+        def build():
+            offsets = self.offsets
+            bonds = []
+            names = set(self._explicit_properties())
+            for k, f in enumerate(self.fragments):
+                o = offsets[k]
+                bonds += [(b + o, e + o, order) for b, e, order in f.bonds]
+                names |= set(f.atom_properties)
+
+            properties = dict([(name, self._property_array(name))
+                               for name in names - set(["symbols"])])
+
+            return _geometry_digest(self.atomic_numbers, self.coordinates,
+                                    bonds, charge, spin, properties,
+                                    tolerance)
+
+        key = (self._geometry_key(), self._property_key(), charge, spin)
+        return self._cached(("geometry_hash", tolerance), key, build)
+
+    def neighbor_index(self, cell_size=4.0):
+        """Get a spatial index of all atom coordinates (see NeighborIndex).
+        The index is kept between calls and only fragments whose
+        coordinates changed since the last call are re-binned.
+
+        :param cell_size: cell edge length in Angstroms
+        :type cell_size : float
+        :return: neighbor index
+        :rtype : NeighborIndex
+        """
+
+        index = self._neighbors
+        if index is None or index.cell_size != cell_size:
+            index = NeighborIndex(cell_size)
+            self._neighbors = index
+
+        index.update([((id(f), f._geometry_revision), f.coordinates)
+                      for f in self.fragments])
+        return index
+
+    def select_within(self, selection, radius):
+        """Select all atoms within radius of any selected atom, including
+        the selected atoms themselves.
+
+        :param selection: atom indices
+        :type selection : list | numpy.ndarray
+        :param radius: distance in Angstroms
+        :type radius : float
+        :return: indexes of atoms in range
+        :rtype : list
+        """
+
+        index = self.neighbor_index()
+        centers = index.coordinates[numpy.asarray(selection, dtype=numpy.intp)]
+        return index.within(centers, radius).tolist()
+
+    def select_nearest(self, point, k):
+        """Select the k atoms nearest to a point.
+
+        :param point: x, y, z coordinates
+        :type point : list | numpy.ndarray
+        :param k: number of atoms to select
+        :type k : int
+        :return: indexes of atoms in order of increasing distance
+        :rtype : list
         """
 
-        slen = len(selection)
-        plen = len(properties)
-        if slen != plen:
-            raise ValueError("Got selection of {0} atoms but {1} properties: {2} {3}".format(slen, plen, selection, properties))
+        return self.neighbor_index().nearest(point, k).tolist()
 
-        #initialize property group with a list of None
-        if name not in self.explicit_atom_properties:
-            self.explicit_atom_properties[name] = [None] * len(self.atoms)
+    def fragments_within(self, selection, radius):
+        """Find fragments that have any atom within radius of any selected
+        atom, e.g. to pick whole solvent molecules around an active site.
+
+        :param selection: atom indices
+        :type selection : list | numpy.ndarray
+        :param radius: distance in Angstroms
+        :type radius : float
+        :return: indexes of fragments in range
+        :rtype : list
+        """
 
-        for j in range(slen):
-            k = selection[j]
-            value = properties[j]
-            self.explicit_atom_properties[name][k] = value
+        atoms = self.select_within(selection, radius)
+        owners = numpy.searchsorted(self.offsets, atoms, side="right") - 1
+        return numpy.unique(owners).tolist()
 
     def select(self, smarts, hydrogen="include"):
         """Select atoms matching a SMARTS pattern with different treatments
@@ -194,12 +1885,10 @@ class System(object):
         """
 
         selected = []
-        natoms_last = 0
-        for f in self.fragments:
+        offsets = self.offsets
+        for k, f in enumerate(self.fragments):
             s = f.select(smarts, hydrogen=hydrogen)
-            s = [k + natoms_last for k in s]
-            selected += s
-            natoms_last += len(f.atoms)
+            selected += [j + offsets[k] for j in s]
 
         return selected
 
@@ -220,11 +1909,35 @@ class System(object):
         finals = [e[1] for e in indexed]
         return finals
 
-    def write(self, fmt):
-        """Write all fragments into a single molecular system, by way of an
-        intermediate fused xyz. There might be a better way to do this,
-        but it's not obvious.
-
+    @property
+    def merged_molecule(self):
+        """Get all fragments merged into a single molecule, assembled
+        directly from fragment atoms, coordinates, and bonds. The merged
+        molecule carries geometry and connectivity only; charge and spin
+        come from the system. It is cached until any fragment geometry
+        changes, so do not modify it.
+
+        :return: merged molecule
+        :rtype : cinfony.pybel.Molecule
+        """
+
+        def build():
+            offsets = self.offsets
+            atomic_numbers = numpy.concatenate([f.atomic_numbers for f in self.fragments])
+            bonds = []
+            for k, f in enumerate(self.fragments):
+                o = offsets[k]
+                bonds += [(b + o, e + o, order) for b, e, order in f.bonds]
+
+            obmol = _build_obmol(atomic_numbers, self.coordinates, bonds)
+            return pybel.Molecule(obmol)
+
+        return self._cached("merged_molecule", self._geometry_key(), build)
+
+    def write(self, fmt):
+        """Write all fragments into a single molecular system, by way of
+        the merged molecule.
+
         There may be strange results trying to write systems containing
         multiple fragments as a linear format like SMILES or InChI
 
@@ -232,52 +1945,149 @@ class System(object):
         :type fmt : str
         """
 
-        natoms = len(self.atoms)
-        xyzs = []
-        for f in self.fragments:
-            #clip header and get right to the atom geometry
-            xyz = f.write("xyz").strip().split("\n")[2:]
-            xyzs.append("\n".join(xyz))
+        merged = self.merged_molecule
+        merged.title = self.title
 
-        geoblock = "\n".join(xyzs)
-        fused = "{0}\n\n{1}\n".format(natoms, geoblock)
-        reread = pybel.readstring("xyz", fused)
-        reread.title = self.title
-
-        written = reread.write(fmt)
+        written = merged.write(fmt)
 
         return written
 
 
 class Fragment(object):
+    #attributes/methods of the underlying molecule that are passed through
+    #as attributes/methods of the fragment, looked up on each access
+    bridged_attrs = ['addh', 'calcdesc', 'calcfp', 'conformers', 'data',
+                     'dim', 'draw', 'energy', 'exactmass', 'formula',
+                     'localopt', 'make3D', 'molwt', 'removeh', 'sssr', 'write']
+
+    #bridged methods that add, remove, or move atoms in the underlying
+    #molecule; the coordinate array is refreshed after each call
+    geometry_mutators = ['addh', 'localopt', 'make3D', 'removeh']
+
     def __init__(self, molecule):
         """Create a Fragment which is a wrapper around one of the cinfony
         Molecule types (currently pybel only tested) with extra convenience
         methods.
 
+        Only coordinates and element symbols are read up front. Derived
+        values such as the SMILES representation and the title are computed
+        on first access and remembered.
+
         :param molecule: underlying cinfony molecule
         :type molecule : cinfony.*.Molecule
         """
 
-        self.bridged_attrs = ['addh', 'atoms', 'calcdesc', 'calcfp', 'charge',
-                              'conformers', 'data', 'dim', 'draw', 'energy',
-                              'exactmass', 'formula', 'localopt', 'make3D',
-                              'molwt', 'removeh', 'sssr', 'write']
-        self.molecule = molecule
-        self.atom_properties = {}
-        
-        #keep a "universal SMILES" representation of the fragment handy
-        m = pybel.Molecule(molecule)
-        self.smiles = m.write("smi", opt={"U" : True}).strip()
-
-        self._bind_bridged_attrs()
-        self.add_title()
+        self._molecule = molecule
+        self._template = None
+        self._shared_template = None
+        self._property_revision = next(_revisions)
+        self._title = None
+        self._coordinates = None
+        self._hash = None
+        self._neighbors = None
+        self._refresh_coordinates()
+        self.atom_properties = PropertyTable(self.natoms)
         self.assign_elements()
 
+    @property
+    def molecule(self):
+        """Get the underlying molecule. An instance fragment (see instance)
+        gets its own copy of the template's molecule here, on first use.
+
+        :return: underlying molecule
+        :rtype : cinfony.pybel.Molecule
+        """
+
+        if self._molecule is None:
+            obmol = pybel.ob.OBMol(self._template.molecule.OBMol)
+            self._molecule = pybel.Molecule(obmol)
+            self._write_coordinates()
+
+        return self._molecule
+
+    @molecule.setter
+    def molecule(self, molecule):
+        """Replace the underlying molecule. Call _refresh_coordinates
+        afterwards to pick up its atoms.
+
+        :param molecule: underlying cinfony molecule
+        :type molecule : cinfony.*.Molecule
+        """
+
+        self._molecule = molecule
+
+    def instance(self, coordinates=None):
+        """Create a lightweight fragment for another copy of the same
+        molecule, e.g. one water of many in a solvent box. The instance
+        shares topology, element symbols, bonds, SMILES, SMARTS matches,
+        and title with this fragment, shares atom properties copy-on-write,
+        and stores only its own coordinates. An OBMol is made for it only
+        if something needs one, such as writing or pybel atom access.
+
+        :param coordinates: coordinates of the instance, shape (N, 3) (default: same as this fragment)
+        :type coordinates : numpy.ndarray | list
+        :return: instance fragment
+        :rtype : Fragment
+        """
+
+        template = self._template
+        if template is None:
+            #instances read from a private copy, so later changes to this
+            #fragment's molecule cannot leak into them
+            if self._shared_template is None:
+                self._shared_template = self.clone()
+            template = self._shared_template
+
+        #compute shared topology data once, for every instance
+        template.bonds
+        template.formal_charges
+
+        result = Fragment.__new__(Fragment)
+        result.__dict__.update(self.__dict__)
+        result._molecule = None
+        result._template = template
+        result._shared_template = None
+        result._matches = {}
+        result._atoms = None
+        result._neighbors = None
+        result._hash = None
+        result.atom_properties = self.atom_properties.copy()
+
+        if coordinates is None:
+            coordinates = self._coordinates
+        else:
+            coordinates = numpy.array(coordinates, dtype=numpy.float64)
+            if coordinates.shape != self._coordinates.shape:
+                raise ValueError("Expected coordinates with shape {0} but got {1}".format(self._coordinates.shape, coordinates.shape))
+            coordinates.flags.writeable = False
+
+        result._coordinates = coordinates
+        result._geometry_revision = next(_revisions)
+        return result
+
+    def __getattr__(self, name):
+        """Pass through attributes/methods of the underlying molecule as
+        attributes/methods of the fragment. Only called when normal
+        attribute lookup fails.
+
+        :param name: attribute name
+        :type name : str
+        :return: attribute of the underlying molecule
+        """
+
+        if name in Fragment.bridged_attrs and "_molecule" in self.__dict__:
+            p = getattr(self.molecule, name)
+            if name in Fragment.geometry_mutators:
+                p = self._refreshing(p)
+
+            return p
+
+        raise AttributeError("{0} object has no attribute {1}".format(repr(type(self).__name__), repr(name)))
+
     def __deepcopy__(self, memo):
-        """Create a deep copy of the fragment. The main issue is that the
-        underlying molecule is not pure Python and needs special handling
-        to duplicate.
+        """Create a deep copy of the fragment by way of clone(). Atom property
+        values themselves are shared with the original, so they should be
+        immutable values such as strings or numbers.
 
         :param memo: memoization dictionary
         :type memo : dict
@@ -285,29 +2095,62 @@ class Fragment(object):
         :rtype : Fragment
         """
 
-        #create a new fragment and then replace the details using self
-        result = Geotool().make_fragment("O")
+        result = self.clone()
         memo[id(self)] = result
-        
-        for k, v in self.__dict__.items():
-            if k == "molecule":
-                result.molecule = pybel.Molecule(self.molecule)
-                #atom coordinates lose precision above, and need manual copy
-                result.set_coordinates(self.geometry_list)
-
-            elif k in self.bridged_attrs:
-                pass
-                
-            else:
-                setattr(result, k, copy.deepcopy(v, memo))
-
-        result._bind_bridged_attrs()
             
         return result
 
+    def __reduce__(self):
+        """Pickle through the binary form from to_bytes, since the
+        underlying molecule cannot be pickled.
+
+        :return: reconstructor and arguments
+        :rtype : tuple
+        """
+
+        return (from_bytes, (self.to_bytes(),))
+
+    def to_bytes(self):
+        """Serialize the fragment (atoms, coordinates, bonds, charges, spin,
+        atom properties, and explicit title) in a compact binary form. See
+        from_bytes.
+
+        :return: serialized fragment
+        :rtype : str
+        """
+
+        packer = _Packer()
+        meta = _pack_fragment(self, packer)
+        return _pack(0, meta, packer)
+
+    def clone(self):
+        """Create an independent copy of the fragment. The underlying OBMol
+        is duplicated directly, so coordinates keep full precision. Arrays
+        that are never modified in place are shared, and atom property
+        columns are shared copy-on-write until either fragment changes them.
+
+        :return: fragment duplicate
+        :rtype : Fragment
+        """
+
+        if self._molecule is None:
+            return self.instance()
+
+        result = Fragment.__new__(Fragment)
+        result.__dict__.update(self.__dict__)
+        result.molecule = pybel.Molecule(pybel.ob.OBMol(self.molecule.OBMol))
+        result._atoms = None
+        result._neighbors = None
+        result._shared_template = None
+
+        result.atom_properties = self.atom_properties.copy()
+
+        return result
+
     def __eq__(self, other):
         """Equality comparison. To be equal, two fragments must compare equal
-        across all key attributes.
+        across all key attributes. Use geometry_hash instead to match
+        fragments to within a tolerance.
 
         :param other: other fragment to compare to
         :type other : Fragment
@@ -315,9 +2158,15 @@ class Fragment(object):
         :rtype : bool
         """
 
+        #different (cached) hashes rule out equality without comparing
+        #every atom; the same hash still needs the exact comparison
+        if isinstance(other, Fragment):
+            if self.geometry_hash() != other.geometry_hash():
+                return False
+
         key_attrs = ["spin", "charge", "geometry_list", "atom_properties",
                      "title", "smiles"]
-        
+
         for k in key_attrs:
             s = getattr(self, k, None)
             o = getattr(other, k, None)
@@ -332,17 +2181,249 @@ class Fragment(object):
 
         return not (self == other)
 
-    def _bind_bridged_attrs(self):
-        """Try to pass through attributes/methods of the underlying molecule
-        as attributes/methods of the fragment.
+    @property
+    def atoms(self):
+        """Get the atoms of the underlying molecule. The list is kept until
+        the molecule's atoms change, so do not modify it.
+
+        :return: fragment atoms
+        :rtype : list
         """
 
-        for attr in self.bridged_attrs:
-            try:
-                p = getattr(self.molecule, attr)
-                setattr(self, attr, p)
-            except AttributeError:
-                pass
+        if self._atoms is None:
+            self._atoms = self.molecule.atoms
+
+        return self._atoms
+
+    @property
+    def smiles(self):
+        """Get a "universal SMILES" representation of the fragment, computed
+        on first access.
+
+        :return: universal SMILES
+        :rtype : str
+        """
+
+        if self._smiles is None:
+            if self._molecule is None:
+                self._smiles = self._template.smiles
+            else:
+                m = pybel.Molecule(self.molecule)
+                self._smiles = m.write("smi", opt={"U" : True}).strip()
+
+        return self._smiles
+
+    @property
+    def title(self):
+        """Get the explicitly set title, if present, or a title generated
+        from the SMILES representation otherwise.
+
+        :return: title
+        :rtype : str
+        """
+
+        if self._title is None:
+            self.add_title()
+
+        return self._title
+
+    @title.setter
+    def title(self, title):
+        """Set the explicit title.
+
+        :param title: new title to set
+        :type title : str
+        """
+
+        self._title = title
+
+    def geometry_hash(self, tolerance=0.00001):
+        """Get a content hash of the fragment that is the same for any
+        fragment with the same atoms, bonds, coordinates (to within
+        tolerance), charge, spin, and atom properties, regardless of atom
+        order. The hash is remembered until the fragment changes.
+
+        :param tolerance: coordinate grid spacing in Angstroms
+        :type tolerance : float
+        :return: hex digest
+        :rtype : str
+        """
+
+        charge = self.charge
+        spin = self.spin
+        key = (tolerance, self._topology_revision, self._geometry_revision,
+               self._property_revision, charge, spin)
+        if self._hash is not None and self._hash[0] == key:
+            return self._hash[1]
+
+        table = self.atom_properties
+        properties = dict([(name, table.to_object(name)) for name in table
+                           if name != "symbols"])
+        digest = _geometry_digest(self._atomic_numbers, self._coordinates,
+                                  self.bonds, charge, spin, properties,
+                                  tolerance)
+        self._hash = (key, digest)
+        return digest
+
+    def _refreshing(self, method):
+        """Wrap a bridged method that changes the underlying molecule's
+        atoms so that the coordinate array is re-read after each call. If
+        atoms were added or removed, atom properties follow the surviving
+        atoms (matched by OBAtom id), added atoms get missing values, and
+        element symbols are reassigned.
+
+        :param method: bound method of the underlying molecule
+        :type method : method
+        :return: wrapped method
+        :rtype : function
+        """
+
+        def refreshed(*args, **kw):
+            before = self._atom_ids()
+            result = method(*args, **kw)
+            self._refresh_coordinates()
+            after = self._atom_ids()
+            if after != before:
+                position = dict((a, k) for k, a in enumerate(before))
+                source = [position.get(a, -1) for a in after]
+                self.atom_properties.take(source)
+                self.assign_elements()
+
+            return result
+
+        return refreshed
+
+    def _atom_ids(self):
+        """:return: unique ids of the underlying OBMol's atoms, in order
+        :rtype : list
+        """
+
+        return [atom.GetId()
+                for atom in pybel.ob.OBMolAtomIter(self.molecule.OBMol)]
+
+    def _refresh_coordinates(self):
+        """Re-read all atom coordinates from the underlying OBMol in one
+        pass. Use this after anything modifies the OBMol directly.
+        """
+
+        flat = []
+        atomic_numbers = []
+        for atom in pybel.ob.OBMolAtomIter(self.molecule.OBMol):
+            flat += [atom.GetX(), atom.GetY(), atom.GetZ()]
+            atomic_numbers.append(atom.GetAtomicNum())
+
+        coordinates = numpy.array(flat, dtype=numpy.float64).reshape(-1, 3)
+        coordinates.flags.writeable = False
+        self._coordinates = coordinates
+        self._atomic_numbers = numpy.array(atomic_numbers, dtype=numpy.int32)
+        self._atomic_numbers.flags.writeable = False
+        self._bonds = None
+        self._formal_charges = None
+        self._atoms = None
+        self._smiles = None
+        self._hydrogen_index = None
+        self._matches = {}
+
+        #atoms may differ from any template from here on
+        self._template = None
+        self._shared_template = None
+
+        #the OBMol may have gained or lost atoms, so treat this as a change
+        #in topology as well as in geometry
+        self._topology_revision = next(_revisions)
+        self._geometry_revision = self._topology_revision
+
+    def _write_coordinates(self):
+        """Push the coordinate array into the underlying OBMol in one pass.
+        """
+
+        if self._molecule is None:
+            return
+
+        obmol = self._molecule.OBMol
+        atoms = pybel.ob.OBMolAtomIter(obmol)
+        for atom, xyz in zip(atoms, self._coordinates.tolist()):
+            atom.SetVector(*xyz)
+
+    def _store_coordinates(self, coordinates):
+        """Replace the authoritative coordinate array and synchronize the
+        underlying OBMol with it.
+
+        :param coordinates: new coordinates, shape (N, 3)
+        :type coordinates : numpy.ndarray
+        """
+
+        coordinates = numpy.array(coordinates, dtype=numpy.float64)
+        if coordinates.shape != self._coordinates.shape:
+            raise ValueError("Expected coordinates with shape {0} but got {1}".format(self._coordinates.shape, coordinates.shape))
+
+        coordinates.flags.writeable = False
+        self._coordinates = coordinates
+        self._geometry_revision = next(_revisions)
+        self._write_coordinates()
+
+    @property
+    def coordinates(self):
+        """Atom coordinates as an (N, 3) float64 array. This array is the
+        authoritative store for fragment geometry; the underlying molecule
+        is kept in sync with it. The returned array is read-only.
+
+        :return: atom coordinates
+        :rtype : numpy.ndarray
+        """
+
+        return self._coordinates
+
+    @coordinates.setter
+    def coordinates(self, coordinates):
+        """Replace all atom coordinates at once.
+
+        :param coordinates: new coordinates, shape (N, 3)
+        :type coordinates : numpy.ndarray | list
+        """
+
+        self._store_coordinates(coordinates)
+
+    @property
+    def atomic_numbers(self):
+        """Get atomic numbers of all atoms.
+
+        :return: read-only atomic numbers
+        :rtype : numpy.ndarray
+        """
+
+        return self._atomic_numbers
+
+    @property
+    def natoms(self):
+        """Return number of atoms in fragment
+
+        :return: number of atoms
+        :rtype : int
+        """
+
+        return len(self._atomic_numbers)
+
+    @property
+    def bonds(self):
+        """Get bonds as (begin, end, order) tuples with 0-based atom
+        indexes. Read from the underlying OBMol on first access and
+        remembered until atoms change.
+
+        :return: bonds
+        :rtype : list
+        """
+
+        if self._bonds is None:
+            if self._molecule is None:
+                self._bonds = self._template.bonds
+            else:
+                obmol = self._molecule.OBMol
+                self._bonds = [(b.GetBeginAtomIdx() - 1,
+                                b.GetEndAtomIdx() - 1, b.GetBondOrder())
+                               for b in pybel.ob.OBMolBondIter(obmol)]
+
+        return self._bonds
 
     def add_title(self):
         """Generate a title for the fragment with an IUPAC name (if we can
@@ -359,8 +2440,11 @@ class Fragment(object):
         """Assign element symbols to all atoms as atom_properties["symbols"]
         """
 
-        symbols = [ELEMENTS[atom.atomicnum - 1] for atom in self.atoms]
-        self.set_properties("symbols", range(len(symbols)), symbols)
+        numbers, codes = numpy.unique(self._atomic_numbers,
+                                      return_inverse=True)
+        symbols = [ELEMENTS[z - 1] for z in numbers.tolist()]
+        self.atom_properties.set_categories("symbols", symbols, codes)
+        self._property_revision = next(_revisions)
 
     def set_coordinates(self, geolist):
         """Use coordinates from geolist for atoms in self.molecule. This is
@@ -376,9 +2460,7 @@ class Fragment(object):
         if self_elements != other_elements:
             raise ValueError("Trying to set coordinates with mismatched geometry list: {0} {1}".format(self_elements, other_elements))
 
-        for j, entry in enumerate(geolist):
-            coords = entry[1:]
-            self.molecule.atoms[j].OBAtom.SetVector(*coords)
+        self._store_coordinates([entry[1:] for entry in geolist])
 
     @property
     def nelec(self):
@@ -388,12 +2470,46 @@ class Fragment(object):
         :rtype : int
         """
 
-        total = sum([a.atomicnum for a in self.atoms]) - self.charge
+        total = int(self._atomic_numbers.sum()) - self.charge
         return total
 
+    @property
+    def charge(self):
+        """Get total charge of the fragment.
+
+        :return: total charge
+        :rtype : int
+        """
+
+        if self._molecule is None:
+            return self._template.charge
+
+        return self._molecule.charge
+
+    @property
+    def formal_charges(self):
+        """Get formal charge of each atom, read on first access and
+        remembered until atoms change.
+
+        :return: formal charges
+        :rtype : list
+        """
+
+        if self._formal_charges is None:
+            if self._molecule is None:
+                self._formal_charges = self._template.formal_charges
+            else:
+                atoms = pybel.ob.OBMolAtomIter(self._molecule.OBMol)
+                self._formal_charges = [a.GetFormalCharge() for a in atoms]
+
+        return self._formal_charges
+
     @property
     def spin(self):
-        return self.molecule.spin
+        if self._molecule is None:
+            return self._template.spin
+
+        return self._molecule.spin
 
     @spin.setter
     def spin(self, s):
@@ -404,6 +2520,7 @@ class Fragment(object):
         """
         
         self.molecule.OBMol.SetTotalSpinMultiplicity(s)
+        self._shared_template = None
 
     def set_zero_to_origin(self):
         """Set coordinates of atom 0 to the origin coordinates: 0, 0, 0
@@ -412,9 +2529,7 @@ class Fragment(object):
         This may make Mopac7 a little less finicky with linear molecules.
         """
 
-        base = self.molecule.atoms[0].coords
-        neg = [a * -1 for a in base]
-        self.translate(neg)
+        self.translate(-self._coordinates[0])
 
     @property
     def geometry_list(self):
@@ -426,36 +2541,45 @@ class Fragment(object):
         """
 
         symbols = self.atom_properties["symbols"]
-        g = []
-        for k in range(len(self.molecule.atoms)):
-            coords = list(self.molecule.atoms[k].coords)
-            entry = [symbols[k]] + coords
-            g.append(entry)
+        coordinates = self._coordinates.tolist()
+        g = [[symbol] + xyz for symbol, xyz in zip(symbols, coordinates)]
 
         return g
 
     def translate(self, vec):
         """Translate every atom in molecule by the coordinates in vec.
 
-        It seems like it should be possible to call the underlying
-        molecule.OBMol.Translate method directly, but unable to pass correct
-        data type from python.
-
-        :param molecule: molecule to be translated
-        :type molecule : cinfony.pybel.Molecule
         :param vec: x, y, z coordinates
-        :type vec : list
+        :type vec : list | numpy.ndarray
+        """
+
+        vec = numpy.asarray(vec, dtype=numpy.float64)
+        self._store_coordinates(self._coordinates + vec)
+
+    def rotate(self, matrix, center=None):
+        """Rotate every atom in molecule by a 3x3 rotation matrix, about
+        center if given or about the coordinate origin otherwise.
+
+        :param matrix: rotation matrix, applied as matrix * xyz
+        :type matrix : list | numpy.ndarray
+        :param center: optional x, y, z coordinates of rotation center
+        :type center : list | numpy.ndarray
         """
 
-        geolist = self.geometry_list
-        for k in range(len(geolist)):
-            coords = geolist[k][1:]
-            translated = []
-            for j in range(3):
-                t = coords[j] + vec[j]
-                translated.append(t)
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        if matrix.shape != (3, 3):
+            raise ValueError("Expected a 3x3 rotation matrix but got shape {0}".format(matrix.shape))
+
+        coordinates = self._coordinates
+        if center is not None:
+            center = numpy.asarray(center, dtype=numpy.float64)
+            coordinates = coordinates - center
 
-            self.molecule.atoms[k].OBAtom.SetVector(*translated)
+        rotated = coordinates.dot(matrix.T)
+        if center is not None:
+            rotated += center
+
+        self._store_coordinates(rotated)
 
     def write_fragment(self, name=None, fmt=None, handle=None):
         """Write fragment contents to named file. If fmt is not provided
@@ -502,17 +2626,9 @@ class Fragment(object):
         :rtype : list
         """
 
-        finder = pybel.Smarts(smarts)
-        h = finder.findall(self.molecule)
-        heavies = []
+        heavies = [list(g) for g in self.smarts_matches(smarts)]
         results = []
 
-        #shift indexes of initial heavy atom match to compensate for
-        #0-based indexing in cinfony.pybel
-        for group in h:
-            g = [i - 1 for i in group]
-            heavies.append(g)
-
         if hydrogen == "exclude":
             results = heavies
 
@@ -531,40 +2647,125 @@ class Fragment(object):
             raise ValueError("Unrecognized option for hydrogen selection")
 
         if flatten:
-            results = sum(results, [])
+            results = [k for group in results for k in group]
             
         return results
 
+    def neighbor_index(self, cell_size=4.0):
+        """Get a spatial index of atom coordinates (see NeighborIndex),
+        rebuilt only when coordinates change.
+
+        :param cell_size: cell edge length in Angstroms
+        :type cell_size : float
+        :return: neighbor index
+        :rtype : NeighborIndex
+        """
+
+        index = self._neighbors
+        if index is None or index.cell_size != cell_size:
+            index = NeighborIndex(cell_size)
+            self._neighbors = index
+
+        index.update([(self._geometry_revision, self._coordinates)])
+        return index
+
+    def select_within(self, selection, radius):
+        """Select all atoms within radius of any selected atom, including
+        the selected atoms themselves.
+
+        :param selection: atom indices
+        :type selection : list | numpy.ndarray
+        :param radius: distance in Angstroms
+        :type radius : float
+        :return: indexes of atoms in range
+        :rtype : list
+        """
+
+        centers = self._coordinates[numpy.asarray(selection, dtype=numpy.intp)]
+        return self.neighbor_index().within(centers, radius).tolist()
+
+    def select_nearest(self, point, k):
+        """Select the k atoms nearest to a point.
+
+        :param point: x, y, z coordinates
+        :type point : list | numpy.ndarray
+        :param k: number of atoms to select
+        :type k : int
+        :return: indexes of atoms in order of increasing distance
+        :rtype : list
+        """
+
+        return self.neighbor_index().nearest(point, k).tolist()
+
+    def smarts_matches(self, smarts):
+        """Get all matches of a SMARTS pattern as tuples of 0-based atom
+        indexes. Matches are remembered per pattern until the molecule's
+        atoms change, so do not modify the result.
+
+        :param smarts: a SMARTS pattern
+        :type smarts : str
+        :return: matched atom index groups
+        :rtype : list
+        """
+
+        try:
+            return self._matches[smarts]
+        except KeyError:
+            pass
+
+        if self._molecule is None:
+            #matches depend only on topology, which instances share
+            matches = self._template.smarts_matches(smarts)
+            self._matches[smarts] = matches
+            return matches
+
+        #shift indexes of matches to compensate for 1-based indexing in
+        #the underlying OBMol
+        finder = _compiled_smarts(smarts)
+        matches = [tuple([i - 1 for i in group])
+                   for group in finder.findall(self.molecule)]
+        self._matches[smarts] = matches
+
+        return matches
+
+    @property
+    def hydrogen_index(self):
+        """For each atom, the indexes of hydrogen atoms among the endpoints
+        of its bonds. Built once from the bond table and kept until the
+        molecule's atoms change.
+
+        :return: per-atom tuples of hydrogen atom indexes
+        :rtype : list
+        """
+
+        if self._hydrogen_index is None:
+            is_hydrogen = (self._atomic_numbers == 1).tolist()
+            index = [[] for k in range(self.natoms)]
+            for begin, end, order in self.bonds:
+                hydrogens = [a for a in (begin, end) if is_hydrogen[a]]
+                if hydrogens:
+                    index[begin] += hydrogens
+                    index[end] += hydrogens
+
+            self._hydrogen_index = [tuple(h) for h in index]
+
+        return self._hydrogen_index
+
     def select_hydrogens(self, atoms):
         """Get indexes of any hydrogen atoms attached to input atom indexes.
 
-        N.B.: Internal pybel indexes use 1-based indexing and cinfony.pybel
-        uses 0-based indexing, so indexes of target atoms need to be reduced
-        by 1
-
         :param atoms: indexes of atoms that may have hydrogen attached
         :type atoms : list
         :return: indexes of attached hydrogen atoms
         :rtype : list
         """
 
+        index = self.hydrogen_index
         hydrogens = set()
-        
         for j in atoms:
-            atom = self.molecule.atoms[j].OBAtom
-            for neighbor in pybel.ob.OBAtomAtomIter(atom):
-                bond = atom.GetBond(neighbor)
-                a_i = bond.GetBeginAtomIdx() - 1
-                a_n = bond.GetBeginAtom().GetAtomicNum()
-                b_i = bond.GetEndAtomIdx() - 1
-                b_n = bond.GetEndAtom().GetAtomicNum()
-
-                if a_n == 1:
-                    hydrogens.add(a_i)
-                if b_n == 1:
-                    hydrogens.add(b_i)
-
-        h = sorted(list(hydrogens))
+            hydrogens.update(index[j])
+
+        h = sorted(hydrogens)
         return h
 
     def set_properties(self, name, selection, properties):
@@ -574,24 +2775,19 @@ class Fragment(object):
         :param name: name of property group, e.g. "basis_name", "fukui_mu_n(+)"
         :type name : str
         :param selection: atom indices
-        :type selection : list
-        :param properties: any sequence of values, length same as selection
-        :type properties : list
+        :type selection : list | numpy.ndarray
+        :param properties: sequence of values, length same as selection, or one value for every selected atom
+        :type properties : list | numpy.ndarray | object
         """
 
-        slen = len(selection)
-        plen = len(properties)
-        if slen != plen:
-            raise ValueError("Got selection of {0} atoms but {1} properties: {2} {3}".format(slen, plen, selection, properties))
-
-        #initialize property group with a list of None
-        if name not in self.atom_properties:
-            self.atom_properties[name] = [None] * len(self.atoms)
+        if not _is_scalar(properties):
+            slen = len(selection)
+            plen = len(properties)
+            if slen != plen:
+                raise ValueError("Got selection of {0} atoms but {1} properties: {2} {3}".format(slen, plen, selection, properties))
 
-        for j in range(slen):
-            k = selection[j]
-            value = properties[j]
-            self.atom_properties[name][k] = value
+        self.atom_properties.assign(name, selection, properties)
+        self._property_revision = next(_revisions)
 
     def set_basis_name_general(self, selection, mapfn, **kw):
         """Assign basis set names to selected atoms.
@@ -608,8 +2804,8 @@ class Fragment(object):
         values = []
 
         #no selection is equivalent to selecting everything
-        if not selection:
-            selection = range(len(self.atoms))
+        if len(selection) == 0:
+            selection = range(self.natoms)
 
         atoms = self.atoms
         for index in selection:
@@ -629,14 +2825,573 @@ class Fragment(object):
         :type selection : list
         """
 
-        def namer(atom, **kw):
-            basis_name = kw["basis_name"]
-            return basis_name
+        #no selection is equivalent to selecting everything
+        if len(selection) == 0:
+            selection = numpy.arange(self.natoms)
+
+        self.set_properties("basis_name", selection, basis_name)
+
+#compiled rule tables, shared by every BasisRules built from the same rules
+_compiled_rules = LRUCache(128)
+
+class BasisRules(object):
+    rule_kinds = ["element", "smarts", "distance"]
+
+    def __init__(self, rules=(), default=None):
+        """Create a declarative table of basis set assignment rules. Each rule
+        is a tuple:
+
+        ("element", symbol, basis_name)
+        ("smarts", smarts, basis_name)
+        ("distance", smarts, cutoff, basis_name)
+
+        where a distance rule matches every atom within cutoff Angstroms of
+        any atom matching smarts. SMARTS rules match only the atoms in the
+        pattern: hydrogens attached to matched atoms are not included unless
+        the pattern itself matches them, e.g. "[#8][#1]" rather than "[#8]"
+        for a hydroxyl group with its hydrogen. Later rules override earlier
+        ones. Atoms
+        matched by no rule get the default basis name, if any, or keep the
+        basis names they already have.
+
+        :param rules: sequence of rule tuples
+        :type rules : list
+        :param default: basis name for atoms not matched by any rule
+        :type default : str
+        """
 
-        kw = {"basis_name" : basis_name}
-        self.set_basis_name_general(selection, namer, **kw)
+        self.rules = [tuple(r) for r in rules]
+        self.default = default
+
+    def add_element(self, symbol, basis_name):
+        """Add a rule assigning basis_name to every atom of an element.
+
+        :param symbol: element symbol
+        :type symbol : str
+        :param basis_name: basis set name
+        :type basis_name : str
+        """
+
+        self.rules.append(("element", symbol, basis_name))
+
+    def add_smarts(self, smarts, basis_name):
+        """Add a rule assigning basis_name to every atom matching smarts.
+        Attached hydrogens are not included unless smarts matches them.
+
+        :param smarts: a SMARTS pattern
+        :type smarts : str
+        :param basis_name: basis set name
+        :type basis_name : str
+        """
+
+        self.rules.append(("smarts", smarts, basis_name))
+
+    def add_distance(self, smarts, cutoff, basis_name):
+        """Add a rule assigning basis_name to every atom within cutoff of an
+        atom matching smarts, including the matching atoms themselves.
+
+        :param smarts: a SMARTS pattern
+        :type smarts : str
+        :param cutoff: distance in Angstroms
+        :type cutoff : float
+        :param basis_name: basis set name
+        :type basis_name : str
+        """
+
+        self.rules.append(("distance", smarts, cutoff, basis_name))
+
+    def compile(self):
+        """Compile the rules into assignment steps. Consecutive element
+        rules collapse into one lookup array indexed by atomic number.
+        Compiled tables are cached and shared between equal rule sets.
+
+        :return: basis names and assignment steps
+        :rtype : tuple
+        """
+
+        key = (tuple(self.rules), self.default)
+        compiled = _compiled_rules.get(key)
+        if compiled is not None:
+            return compiled
+
+        names = []
+        codes = {}
+        def code(basis_name):
+            if basis_name not in codes:
+                codes[basis_name] = len(names)
+                names.append(basis_name)
+
+            return codes[basis_name]
+
+        steps = []
+        if self.default is not None:
+            steps.append(("default", code(self.default)))
+
+        for rule in self.rules:
+            kind = rule[0]
+            if kind not in self.rule_kinds:
+                raise ValueError("Unknown basis rule type {0} in {1}".format(repr(kind), rule))
+
+            if kind == "element":
+                symbol, basis_name = rule[1:]
+                try:
+                    z = ELEMENTS.index(symbol) + 1
+                except ValueError:
+                    raise ValueError("Unknown element {0} in basis rule".format(repr(symbol)))
+
+                if not steps or steps[-1][0] != "element":
+                    lookup = numpy.empty(len(ELEMENTS) + 1, dtype=numpy.int32)
+                    lookup.fill(-1)
+                    steps.append(("element", lookup))
+
+                steps[-1][1][z] = code(basis_name)
+
+            elif kind == "smarts":
+                smarts, basis_name = rule[1:]
+                _compiled_smarts(smarts)
+                steps.append(("smarts", smarts, code(basis_name)))
+
+            else:
+                smarts, cutoff, basis_name = rule[1:]
+                _compiled_smarts(smarts)
+                steps.append(("distance", smarts, float(cutoff),
+                              code(basis_name)))
+
+        compiled = (names, steps)
+        _compiled_rules.put(key, compiled)
+        return compiled
+
+    def codes(self, target):
+        """Work out the basis name code of every atom in target, -1 where no
+        rule applies.
+
+        :param target: system or fragment to assign basis names to
+        :type target : System | Fragment
+        :return: basis names and per-atom codes into basis names
+        :rtype : tuple
+        """
+
+        names, steps = self.compile()
+        atomic_numbers = target.atomic_numbers
+        codes = numpy.empty(len(atomic_numbers), dtype=numpy.int32)
+        codes.fill(-1)
+
+        for step in steps:
+            kind = step[0]
+            if kind == "default":
+                codes.fill(step[1])
+
+            elif kind == "element":
+                assigned = step[1][atomic_numbers]
+                matched = assigned >= 0
+                codes[matched] = assigned[matched]
+
+            elif kind == "smarts":
+                selected = target.select(step[1], hydrogen="exclude")
+                codes[selected] = step[2]
+
+            else:
+                smarts, cutoff, code = step[1:]
+                selected = target.select(smarts, hydrogen="exclude")
+                codes[target.select_within(selected, cutoff)] = code
+
+        return names, codes
+
+    def apply(self, target, name="basis_name"):
+        """Assign basis names to every atom in target in one pass. For a
+        System the names are set as system-level atom properties, leaving
+        fragment properties untouched.
+
+        :param target: system or fragment to assign basis names to
+        :type target : System | Fragment
+        :param name: name of property group to assign
+        :type name : str
+        """
+
+        names, codes = self.codes(target)
+        selected = numpy.flatnonzero(codes >= 0)
+
+        if isinstance(target, System):
+            table = target._explicit_properties()
+        else:
+            table = target.atom_properties
+
+        table.assign_categories(name, selected, names, codes[selected])
+        target._property_revision = next(_revisions)
+
+#binary format: header (magic, version, kind, metadata length), JSON
+#metadata describing each array, then raw array data, 8-byte aligned
+_format_magic = "GEOP"
+_format_version = 1
+_format_header = struct.Struct("<4sHHI")
+_format_kinds = {0 : "fragment", 1 : "system"}
+
+class _Packer(object):
+    def __init__(self):
+        """Collect arrays into one aligned data block.
+        """
+
+        self.chunks = []
+        self.size = 0
+
+    def add(self, array):
+        """Append an array to the data block.
+
+        :param array: array to store
+        :type array : numpy.ndarray
+        :return: reference to stored array: offset, dtype, shape
+        :rtype : list
+        """
+
+        array = numpy.ascontiguousarray(array)
+        data = array.tostring()
+        ref = [self.size, array.dtype.str, list(array.shape)]
+        padding = "\0" * (-len(data) % 8)
+        self.chunks.append(data + padding)
+        self.size += len(data) + len(padding)
+        return ref
+
+def _native(text):
+    """Convert text decoded from JSON back to a native str where possible.
+
+    :param text: decoded text or None
+    :type text : unicode
+    :return: text as str, or unchanged if not unicode
+    :rtype : str
+    """
+
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+
+    return text
+
+def _pack_properties(table, packer):
+    """Describe a PropertyTable and add its columns to packer.
+
+    :param table: atom properties
+    :type table : PropertyTable
+    :param packer: data block
+    :type packer : _Packer
+    :return: property metadata
+    :rtype : list
+    """
+
+    properties = []
+    for name in sorted(table):
+        column = table.columns[name]
+        entry = {"name" : name, "kind" : column.kind,
+                 "mask" : packer.add(column.mask)}
+        if column.kind == "category":
+            entry["categories"] = column.categories
+            entry["values"] = packer.add(column.values)
+        elif column.kind == "numeric":
+            entry["values"] = packer.add(column.values)
+        else:
+            data = pickle.dumps(column.values.tolist(), 2)
+            entry["values"] = packer.add(numpy.frombuffer(data, dtype=numpy.uint8))
+        properties.append(entry)
+
+    return properties
+
+def _pack_fragment(fragment, packer):
+    """Describe a fragment and add its arrays to packer.
+
+    :param fragment: fragment to store
+    :type fragment : Fragment
+    :param packer: data block
+    :type packer : _Packer
+    :return: fragment metadata
+    :rtype : dict
+    """
+
+    bonds = numpy.array(fragment.bonds, dtype=numpy.int32).reshape(-1, 3)
+    formal_charges = numpy.array(fragment.formal_charges, dtype=numpy.int8)
+
+    meta = {"charge" : fragment.charge,
+            "spin" : fragment.spin,
+            "title" : fragment._title,
+            "atomic_numbers" : packer.add(fragment.atomic_numbers),
+            "coordinates" : packer.add(fragment.coordinates),
+            "bonds" : packer.add(bonds),
+            "formal_charges" : packer.add(formal_charges),
+            "properties" : _pack_properties(fragment.atom_properties,
+                                            packer)}
+    return meta
+
+def _pack(kind, meta, packer):
+    """Assemble header, metadata, and data block.
+
+    :param kind: 0 for a fragment, 1 for a system
+    :type kind : int
+    :param meta: metadata
+    :type meta : dict
+    :param packer: data block
+    :type packer : _Packer
+    :return: serialized data
+    :rtype : str
+    """
+
+    encoded = json.dumps(meta, separators=(",", ":"))
+    size = _format_header.size + len(encoded)
+    padding = "\0" * (-size % 8)
+    header = _format_header.pack(_format_magic, _format_version, kind,
+                                 len(encoded))
+    return "".join([header, encoded, padding] + packer.chunks)
+
+def _section(data, start, ref):
+    """Get a stored array as a read-only view of the underlying buffer.
+
+    :param data: whole buffer as bytes
+    :type data : numpy.ndarray
+    :param start: offset of the data block
+    :type start : int
+    :param ref: offset, dtype, and shape of the array
+    :type ref : list
+    :return: array view
+    :rtype : numpy.ndarray
+    """
+
+    offset, dtype, shape = ref
+    dtype = numpy.dtype(str(dtype))
+    nbytes = dtype.itemsize * int(numpy.prod(shape))
+    begin = start + offset
+    view = data[begin:begin + nbytes].view(dtype).reshape(shape)
+    view.flags.writeable = False
+    return view
+
+def _unpack_properties(properties, data, start, natoms):
+    """Rebuild a PropertyTable from its metadata. Category and numeric
+    columns are views of the buffer, shared copy-on-write (see
+    PropertyTable.copy) so that the first change copies them.
+
+    :param properties: property metadata
+    :type properties : list
+    :param data: whole buffer as bytes
+    :type data : numpy.ndarray
+    :param start: offset of the data block
+    :type start : int
+    :param natoms: number of atoms
+    :type natoms : int
+    :return: atom properties
+    :rtype : PropertyTable
+    """
+
+    table = PropertyTable(natoms)
+    for entry in properties:
+        name = _native(entry["name"])
+        column = PropertyColumn.__new__(PropertyColumn)
+        column.kind = entry["kind"]
+        column.mask = _section(data, start, entry["mask"])
+        values = _section(data, start, entry["values"])
+        if column.kind == "category":
+            column.categories = [_native(c) for c in entry["categories"]]
+            column.values = values
+            table._shared.add(name)
+        elif column.kind == "numeric":
+            column.categories = []
+            column.values = values
+            table._shared.add(name)
+        else:
+            column.mask = column.mask.copy()
+            column.categories = []
+            column.values = numpy.empty(natoms, dtype=object)
+            for k, v in enumerate(pickle.loads(values.tostring())):
+                column.values[k] = v
+
+        column.lookup = dict([(c, k) for k, c in enumerate(column.categories)])
+        table.columns[name] = column
+
+    return table
+
+def _unpack_fragment(meta, data, start):
+    """Rebuild a fragment from its metadata. The OBMol is built from the
+    stored arrays, and the fragment then keeps the buffer's arrays as its
+    read-only coordinates and atomic numbers instead of copies.
+
+    :param meta: fragment metadata
+    :type meta : dict
+    :param data: whole buffer as bytes
+    :type data : numpy.ndarray
+    :param start: offset of the data block
+    :type start : int
+    :return: fragment
+    :rtype : Fragment
+    """
+
+    atomic_numbers = _section(data, start, meta["atomic_numbers"])
+    coordinates = _section(data, start, meta["coordinates"])
+    bonds = _section(data, start, meta["bonds"]).tolist()
+    formal_charges = _section(data, start, meta["formal_charges"]).tolist()
+
+    obmol = _build_obmol(atomic_numbers, coordinates, bonds)
+    for atom, charge in zip(pybel.ob.OBMolAtomIter(obmol), formal_charges):
+        if charge:
+            atom.SetFormalCharge(charge)
+    obmol.SetTotalCharge(meta["charge"])
+    obmol.SetTotalSpinMultiplicity(meta["spin"])
+    obmol.SetDimension(3)
+
+    fragment = Fragment(pybel.Molecule(obmol))
+    fragment._coordinates = coordinates
+    fragment._atomic_numbers = atomic_numbers
+    fragment._title = _native(meta["title"])
+    fragment.atom_properties = _unpack_properties(meta["properties"], data,
+                                                  start, len(atomic_numbers))
+    return fragment
+
+def from_bytes(buffer):
+    """Rebuild a Fragment or System serialized with to_bytes. Any object
+    with the buffer interface can be read, including shared memory from
+    to_shared. Coordinates, atomic numbers, and category and numeric
+    property columns are read-only views of the buffer, not copies;
+    property columns are copied only when first changed, and setting new
+    coordinates replaces the view. Object property columns are unpickled,
+    and each fragment's OBMol is built from the arrays, since OpenBabel
+    keeps its own atoms. The buffer stays alive while the result uses it,
+    and must not be modified meanwhile.
+
+    :param buffer: serialized data
+    :type buffer : str | buffer | multiprocessing.RawArray
+    :return: fragment or system
+    :rtype : Fragment | System
+    """
+
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    header = data[:_format_header.size].tostring()
+    if len(header) < _format_header.size:
+        raise ValueError("Serialized data is truncated")
+
+    magic, version, kind, size = _format_header.unpack(header)
+    if magic != _format_magic:
+        raise ValueError("Not serialized geoprep data: bad magic {0}".format(repr(magic)))
+    if version < 1 or version > _format_version:
+        raise ValueError("Unsupported serialization version {0}, expected 1 to {1}".format(version, _format_version))
+    if kind not in _format_kinds:
+        raise ValueError("Unknown serialized object kind {0}".format(kind))
+
+    begin = _format_header.size
+    meta = json.loads(data[begin:begin + size].tostring())
+    start = begin + size
+    start += -start % 8
+
+    if _format_kinds[kind] == "fragment":
+        return _unpack_fragment(meta, data, start)
+
+    fragments = [_unpack_fragment(m, data, start) for m in meta["fragments"]]
+    system = System(fragments, spin=meta["spin"], title=_native(meta["title"]))
+    system.explicit_atom_properties = _unpack_properties(meta["properties"],
+                                                         data, start,
+                                                         meta["natoms"])
+    return system
+
+def to_shared(obj):
+    """Serialize a Fragment or System into shared memory that worker
+    processes can inherit and read with from_bytes.
+
+    :param obj: fragment or system
+    :type obj : Fragment | System
+    :return: shared memory holding serialized data
+    :rtype : multiprocessing.RawArray
+    """
+
+    data = obj.to_bytes()
+    shared = multiprocessing.RawArray("c", len(data))
+    shared[:] = data
+    return shared
 
 class Geotool(object):
+    def __init__(self, embedding_cache=None, forcefield="mmff94", steps=50):
+        """Create a Geotool. 3D embeddings produced by make_fragment can be
+        kept in an on-disk cache shared across runs and processes.
+
+        :param embedding_cache: optional cache directory or DiskCache
+        :type embedding_cache : str | sharedutilities.DiskCache
+        :param forcefield: force field used to clean up 3D embeddings
+        :type forcefield : str
+        :param steps: number of force field optimization steps
+        :type steps : int
+        """
+
+        if isinstance(embedding_cache, basestring):
+            embedding_cache = DiskCache(embedding_cache)
+
+        self.embedding_cache = embedding_cache
+        self.embedding_settings = {"forcefield" : forcefield, "steps" : steps}
+
+    def embedding_key(self, representation, fmt):
+        """Make the embedding cache key for a linear representation. Atoms
+        of a restored embedding are matched to coordinates by index, and
+        atom order follows the input text, so the key is built from the
+        exact input rather than a canonical SMILES.
+
+        :param representation: linear molecule encoding
+        :type representation : str
+        :param fmt: smiles, inchi, etc.
+        :type fmt : str
+        :return: cache key
+        :rtype : str
+        """
+
+        version = pybel.ob.OBReleaseVersion()
+        return self.embedding_cache.key(representation.strip(), fmt,
+                                        self.embedding_settings, version)
+
+    def cached_embedding(self, representation, fmt):
+        """Look up a stored embedding for a linear representation.
+
+        :param representation: linear molecule encoding
+        :type representation : str
+        :param fmt: smiles, inchi, etc.
+        :type fmt : str
+        :return: stored embedding, or None if absent or caching is off
+        :rtype : dict
+        """
+
+        if self.embedding_cache is None:
+            return None
+
+        key = self.embedding_key(representation, fmt)
+        return self.embedding_cache.get(key)
+
+    def store_embedding(self, representation, fmt, embedding):
+        """Store an embedding for a linear representation, if caching is on.
+
+        :param representation: linear molecule encoding
+        :type representation : str
+        :param fmt: smiles, inchi, etc.
+        :type fmt : str
+        :param embedding: atomic numbers and coordinates
+        :type embedding : dict
+        """
+
+        if self.embedding_cache is not None:
+            key = self.embedding_key(representation, fmt)
+            self.embedding_cache.put(key, embedding)
+
+    def embed(self, representation, fmt):
+        """Read a linear representation and generate 3D coordinates for it,
+        reusing a cached embedding when one is available.
+
+        :param representation: linear molecule encoding
+        :type representation : str
+        :param fmt: smiles, inchi, etc.
+        :type fmt : str
+        :return: 3D molecule
+        :rtype : cinfony.pybel.Molecule
+        """
+
+        embedding = self.cached_embedding(representation, fmt)
+        if embedding is not None:
+            molecule = pybel.readstring(fmt, representation)
+            restored = _restore_embedding(molecule, embedding)
+            if restored is not None:
+                return restored
+
+        molecule = pybel.readstring(fmt, representation)
+        molecule.make3D(**self.embedding_settings)
+        self.store_embedding(representation, fmt, _embedding_data(molecule))
+        return molecule
+
     def make_fragment(self, representation, fmt="smiles"):
         """Take a linear representation of a molecule and add a title with
         IUPAC and SMILES designations. Convert a linear molecular specification
@@ -650,20 +3405,228 @@ class Geotool(object):
         :rtype: Fragment
         """
 
-        molecule = pybel.readstring(fmt, representation)
-
-        molecule.make3D()
+        molecule = self.embed(representation, fmt)
         fragment = Fragment(molecule)
         fragment.set_zero_to_origin()
         
         return fragment
 
-    def make_system(self, items, fmt="smiles"):
+    def _embedded_fragment(self, index, representation, fmt, outcome):
+        """Turn the outcome of a worker embedding into a batch result,
+        capturing any error instead of raising it.
+
+        :param index: position of the item in the input sequence
+        :type index : int
+        :param representation: linear molecule encoding
+        :type representation : str
+        :param fmt: smiles, inchi, etc.
+        :type fmt : str
+        :param outcome: (embedding, error message) from _embed_worker
+        :type outcome : tuple
+        :return: index, input, fragment, and error message
+        :rtype : dict
+        """
+
+        r = {"index" : index, "input" : representation, "fragment" : None,
+             "error" : None}
+        embedding, error = outcome
+        if error is not None:
+            r["error"] = error
+            return r
+
+        try:
+            self.store_embedding(representation, fmt, embedding)
+            molecule = pybel.readstring(fmt, representation)
+            restored = _restore_embedding(molecule, embedding)
+            if restored is None:
+                raise ValueError("Embedded atoms do not match input {0}".format(repr(representation)))
+
+            fragment = Fragment(restored)
+            fragment.set_zero_to_origin()
+            r["fragment"] = fragment
+        except Exception as e:
+            r["error"] = "{0}: {1}".format(type(e).__name__, e)
+
+        return r
+
+    def make_fragments(self, items, fmt="smiles", workers=None, ordered=True,
+                       max_pending=None, timeout=None):
+        """Make fragments from many linear representations, spreading the
+        3D embedding work across a pool of worker processes. Cached
+        embeddings are used directly without going through the pool.
+
+        Results are generated one per input item as dicts with keys
+        "index" (position in items), "input", "fragment", and "error".
+        A failed item has fragment None and an error message; it does not
+        stop the batch. That includes items whose results cannot be sent
+        back from a worker, and, with a timeout, items that do not finish
+        in time (e.g. because their worker was killed).
+
+        N.B.: Fragments cannot be sent between processes, so workers return
+        atomic numbers and coordinates and the fragment itself is
+        rebuilt in this process without re-embedding.
+
+        :param items: linear molecule representations
+        :type items : iterable
+        :param fmt: smiles, inchi, etc. (default smiles)
+        :type fmt : str
+        :param workers: number of worker processes (default: CPU count)
+        :type workers : int
+        :param ordered: generate results in input order if True, otherwise in completion order
+        :type ordered : bool
+        :param max_pending: maximum number of items in flight (default 4 * workers)
+        :type max_pending : int
+        :param timeout: seconds allowed per item from submission to a worker (default: no limit)
+        :type timeout : float
+        :return: batch results
+        :rtype : generator
+        """
+
+        if isinstance(items, basestring):
+            items = [items]
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        if workers <= 1:
+            for k, item in enumerate(items):
+                embedding = self.cached_embedding(item, fmt)
+                if embedding is None:
+                    outcome = _embed_worker((item, fmt, self.embedding_settings))
+                else:
+                    outcome = (embedding, None)
+                yield self._embedded_fragment(k, item, fmt, outcome)
+
+            return
+
+        if max_pending is None:
+            max_pending = 4 * workers
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            if ordered:
+                results = self._make_fragments_ordered(pool, items, fmt,
+                                                       max_pending, timeout)
+            else:
+                results = self._make_fragments_unordered(pool, items, fmt,
+                                                         max_pending, timeout)
+            for r in results:
+                yield r
+
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _submit_embedding(self, pool, item, fmt, timeout):
+        """Submit one embedding to pool unless it is cached.
+
+        :return: cached embedding or None, and job (None if cached) with its deadline
+        :rtype : tuple
+        """
+
+        embedding = self.cached_embedding(item, fmt)
+        if embedding is not None:
+            return embedding, None, None
+
+        job = pool.apply_async(_embed_worker,
+                               ((item, fmt, self.embedding_settings),))
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        return None, job, deadline
+
+    def _job_outcome(self, embedding, job, deadline):
+        """Get the outcome of a submitted embedding, with failures to return
+        a result, or to return it before deadline, as errors.
+
+        :return: embedding data and error message
+        :rtype : tuple
+        """
+
+        if job is None:
+            return (embedding, None)
+
+        try:
+            if deadline is None:
+                return job.get()
+            return job.get(max(0.0, deadline - time.time()))
+        except multiprocessing.TimeoutError:
+            return (None, "TimeoutError: embedding did not finish in time")
+        except Exception as e:
+            return (None, "{0}: {1}".format(type(e).__name__, e))
+
+    def _make_fragments_ordered(self, pool, items, fmt, max_pending, timeout):
+        """Submit embeddings to pool and generate results in input order.
+        """
+
+        pending = collections.deque()
+        for k, item in enumerate(items):
+            submitted = self._submit_embedding(pool, item, fmt, timeout)
+            pending.append((k, item) + submitted)
+
+            while len(pending) >= max_pending:
+                yield self._collect(pending.popleft(), fmt)
+
+        while pending:
+            yield self._collect(pending.popleft(), fmt)
+
+    def _collect(self, entry, fmt):
+        """Wait for one submitted embedding and turn it into a result.
+        """
+
+        k, item, embedding, job, deadline = entry
+        outcome = self._job_outcome(embedding, job, deadline)
+        return self._embedded_fragment(k, item, fmt, outcome)
+
+    def _make_fragments_unordered(self, pool, items, fmt, max_pending,
+                                  timeout):
+        """Submit embeddings to pool and generate results as they finish.
+        Submitted jobs are polled rather than reported through callbacks,
+        so a job that fails or runs out of time still produces a result.
+        """
+
+        pending = []
+
+        def finished():
+            while True:
+                now = time.time()
+                for j, entry in enumerate(pending):
+                    embedding, job, deadline = entry[2:]
+                    if (job is None or job.ready() or
+                        (deadline is not None and now >= deadline)):
+                        return pending.pop(j)
+
+                pending[0][3].wait(0.01)
+
+        for k, item in enumerate(items):
+            submitted = self._submit_embedding(pool, item, fmt, timeout)
+            pending.append((k, item) + submitted)
+
+            while len(pending) >= max_pending:
+                yield self._collect(finished(), fmt)
+
+        while pending:
+            yield self._collect(finished(), fmt)
+
+    def make_system(self, items, fmt="smiles", workers=1,
+                    share_identical=False):
         """Make a system out of one or more linear representations of
         molecules that will become fragments.
 
+        With share_identical, each distinct representation is embedded
+        once and repeats become lightweight instances of that fragment
+        (see Fragment.instance), so e.g. 10000 waters need one OBMol rather
+        than 10000. Instances start with the same coordinates as the
+        fragment they copy; move them into place afterwards.
+
         :param items: one or more linear molecule representations
         :type items : str | list
+        :param workers: number of worker processes for 3D embedding
+        :type workers : int
+        :param share_identical: make repeated items instances of one fragment (default False: independent fragments)
+        :type share_identical : bool
         :return: a system containing one or more fragments
         :rtype : System
         """
@@ -672,13 +3635,158 @@ class Geotool(object):
         if type(items) == str:
             items = [items]
 
-        for item in items:
-            fragment = self.make_fragment(item, fmt=fmt)
-            fragments.append(fragment)
+        if share_identical:
+            distinct = list(collections.OrderedDict.fromkeys(items))
+        else:
+            distinct = items
+
+        made = []
+        if workers <= 1:
+            for item in distinct:
+                fragment = self.make_fragment(item, fmt=fmt)
+                made.append(fragment)
+
+        else:
+            for r in self.make_fragments(distinct, fmt=fmt, workers=workers):
+                if r["error"] is not None:
+                    raise ValueError("Unable to make fragment from {0}: {1}".format(repr(r["input"]), r["error"]))
+                made.append(r["fragment"])
+
+        if share_identical:
+            by_item = {}
+            for item, fragment in zip(distinct, made):
+                by_item[item] = fragment
+
+            seen = set()
+            for item in items:
+                fragment = by_item[item]
+                if item in seen:
+                    fragment = fragment.instance()
+                seen.add(item)
+                fragments.append(fragment)
+
+        else:
+            fragments = made
 
         s = System(fragments)
         return s
 
+    def make_conformers(self, representation, n=50, fmt="smiles",
+                        energy_window=10.0, rmsd_threshold=0.5,
+                        includeH=False, workers=None, energy_tolerance=None):
+        """Generate a conformer ensemble for a molecule. Candidates come from
+        force field random rotor searches spread across worker processes,
+        and near-duplicates are pruned as results arrive (see
+        ConformerEnsemble).
+
+        Energies are in the units of the force field used for embedding,
+        given as "energy_unit" in the result. The embedded geometry is
+        always added first, so the ensemble is never empty. The returned
+        fragment has the geometry of the lowest energy conformer.
+
+        :param representation: linear molecule encoding
+        :type representation : str
+        :param n: number of candidate conformers to generate, at least 1
+        :type n : int
+        :param fmt: smiles, inchi, etc. (default smiles)
+        :type fmt : str
+        :param energy_window: keep conformers within this energy of the minimum
+        :type energy_window : float
+        :param rmsd_threshold: RMSD (Angstroms) below which conformers are duplicates
+        :type rmsd_threshold : float
+        :param includeH: if False, consider only heavy atoms for RMSD
+        :type includeH : bool
+        :param workers: number of worker processes (default: CPU count)
+        :type workers : int
+        :param energy_tolerance: optional energy difference beyond which conformers are never duplicates (default: compare all)
+        :type energy_tolerance : float
+        :return: fragment, coordinates (M, N, 3), energies (M,), energy_unit
+        :rtype : dict
+        """
+
+        if n < 1:
+            raise ValueError("Need at least one candidate conformer, got n={0}".format(n))
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        fragment = self.make_fragment(representation, fmt)
+        payload = (fragment.atomic_numbers, fragment.coordinates,
+                   fragment.bonds)
+        forcefield = self.embedding_settings["forcefield"]
+        steps = self.embedding_settings["steps"]
+        ff = pybel.ob.OBForceField.FindForceField(forcefield)
+        if ff is None or not ff.Setup(fragment.molecule.OBMol):
+            raise ValueError("Unable to set up force field {0}".format(repr(forcefield)))
+
+        #several smaller searches per worker keep results arriving steadily
+        tasks = []
+        chunk = max(1, n // (4 * max(1, workers)))
+        for start in range(0, n, chunk):
+            tasks.append((payload, forcefield, min(chunk, n - start), steps))
+
+        fitted = None
+        if not includeH:
+            fitted = fragment.atomic_numbers != 1
+        ensemble = ConformerEnsemble(energy_window, rmsd_threshold,
+                                     energy_tolerance, fitted)
+        ensemble.add(ff.Energy(False), fragment.coordinates)
+
+        if workers <= 1 or len(tasks) < 2:
+            batches = itertools.imap(_conformer_worker, tasks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(workers)
+            batches = pool.imap_unordered(_conformer_worker, tasks)
+
+        try:
+            for batch in batches:
+                for energy, coordinates in batch:
+                    ensemble.add(energy, coordinates)
+
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        coordinates = ensemble.coordinates
+        fragment.coordinates = coordinates[0]
+
+        r = {"fragment" : fragment, "coordinates" : coordinates,
+             "energies" : ensemble.energies, "energy_unit" : ff.GetUnit()}
+        return r
+
+    def array_to_fragment(self, elements, coordinates, bonds=None):
+        """Build a fragment directly from per-atom arrays, exactly preserving
+        the given geometry (no translation to origin). Unless bonds are
+        given, connectivity and bond orders are perceived from the geometry
+        as when reading an XYZ file.
+
+        :param elements: element symbols or atomic numbers
+        :type elements : list | numpy.ndarray
+        :param coordinates: atom coordinates, shape (N, 3)
+        :type coordinates : list | numpy.ndarray
+        :param bonds: optional (begin, end, order) with 0-based atom indexes
+        :type bonds : list
+        :return: fragment matching given geometry
+        :rtype : Fragment
+        """
+
+        atomic_numbers = _to_atomic_numbers(elements)
+        coordinates = numpy.array(coordinates, dtype=numpy.float64)
+        if coordinates.shape != (len(atomic_numbers), 3):
+            raise ValueError("Expected coordinates with shape {0} but got {1}".format((len(atomic_numbers), 3), coordinates.shape))
+
+        obmol = _build_obmol(atomic_numbers, coordinates, bonds or ())
+        if bonds is None:
+            obmol.ConnectTheDots()
+            obmol.PerceiveBondOrders()
+        obmol.SetDimension(3)
+
+        return Fragment(pybel.Molecule(obmol))
+
     def geolist_to_fragment(self, geolist):
         """Convert a geometry list into a fragment, exactly preserving the
         original geometry (no translation to origin).
@@ -689,23 +3797,47 @@ class Geotool(object):
         :rtype : Fragment
         """
 
-        xyz_head = [str(len(geolist)), '']
-        entries = [" ".join([str(s) for s in e]) for e in geolist]
-        xyz = "\n".join(xyz_head + entries)
-        tmp = StringIO.StringIO(xyz)
+        symbols = [e[0] for e in geolist]
+        coordinates = [e[1:4] for e in geolist]
+        return self.array_to_fragment(symbols, coordinates)
+
+    def geolists_to_fragments(self, geolists):
+        """Convert many geometry lists into fragments at once, e.g. the
+        Job.geometry_history of an optimization. Connectivity is perceived
+        only when the elements change from one geometry to the next;
+        otherwise the previous fragment is cloned and given new coordinates.
+
+        :param geolists: geometry lists
+        :type geolists : list
+        :return: fragments matching given geometries, in order
+        :rtype : list
+        """
 
-        tmp.seek(0)
-        f = self.read_fragment(fmt="xyz", handle=tmp, zero_to_origin=False)
-        tmp.close()
+        fragments = []
+        template = None
+        template_symbols = None
+        for geolist in geolists:
+            symbols = [e[0] for e in geolist]
+            coordinates = [e[1:4] for e in geolist]
+            if symbols == template_symbols:
+                fragment = template.clone()
+                fragment.coordinates = coordinates
+            else:
+                fragment = self.array_to_fragment(symbols, coordinates)
+                template = fragment
+                template_symbols = symbols
 
-        f.set_coordinates(geolist)
-        return f
+            fragments.append(fragment)
+
+        return fragments
 
     def read_fragment(self, name=None, fmt=None, handle=None,
                       zero_to_origin=True):
         """Read a molecular structure from a file. Guess at the file type from
         extension if caller does not supply explicit fmt. If file handle is
         provided, read data from it. Otherwise open file name for reading.
+        Only the first record of a multi-record file is read; see
+        iter_fragments to read them all.
 
         :param name: file to open
         :type name : str
@@ -717,51 +3849,232 @@ class Geotool(object):
         :rtype : Fragment
         """
 
-        if not fmt:
-            try:
-                fmt = name.rsplit(".", 1)[-1]
-            except (IndexError, AttributeError):
-                msg = "No fmt given for {0} and unable to guess from file extension".format(repr(name))
+        fragments = self.iter_fragments(name=name, fmt=fmt, handle=handle,
+                                        stop=1, zero_to_origin=zero_to_origin)
+        try:
+            return fragments.next()
+        except StopIteration:
+            raise ValueError("No molecule found in {0}".format(repr(name or handle)))
+        finally:
+            fragments.close()
 
-        if handle is None:
-            molecule = pybel.readfile(fmt, name).next()
-        else:
-            data = handle.read()
-            molecule = pybel.readstring(fmt, data)
-            
-        fragment = Fragment(molecule)
-        
-        if zero_to_origin:
-            fragment.set_zero_to_origin()
-        
-        return fragment
+    def iter_fragments(self, name=None, fmt=None, handle=None, start=0,
+                       stop=None, step=1, offsets=None, zero_to_origin=True):
+        """Generate a fragment for each record of a multi-record file (e.g.
+        SDF, multi-frame XYZ, MOL2), reading one record at a time. Records
+        can be sliced as with itertools.islice; skipped records are not
+        parsed.
 
-    def mcs(self, fragments):
-        """Find the maximum common substructure from a list of fragments.
+        With record offsets from index_records, reading starts directly at
+        record start, so separate processes can each read a disjoint range
+        of a large file.
+
+        Formats other than SDF/MOL, XYZ, and MOL2 are read through pybel.
+
+        :param name: file to open
+        :type name : str
+        :param fmt: optional OpenBabel format code e.g. "sdf"
+        :type fmt : str
+        :param handle: optional file handle to read from instead of name
+        :type handle : file
+        :param start: index of first record to read
+        :type start : int
+        :param stop: index to stop reading at, or None to read to the end
+        :type stop : int
+        :param step: read every step-th record
+        :type step : int
+        :param offsets: optional record offsets from index_records
+        :type offsets : list
+        :param zero_to_origin: translate geometry to put atom 0 at origin
+        :type zero_to_origin : bool
+        :return: fragments
+        :rtype : generator
+        """
+
+        fmt = _file_format(name, fmt)
+        splitter = _record_splitters.get(fmt)
+        opened = None
+        if handle is None and splitter is not None:
+            handle = opened = open(name, "rb")
+
+        try:
+            if splitter is None:
+                if handle is None:
+                    molecules = pybel.readfile(fmt, name)
+                else:
+                    molecules = iter([pybel.readstring(fmt, handle.read())])
+                records = itertools.islice(molecules, start, stop, step)
+            else:
+                if offsets is not None and start < len(offsets):
+                    handle.seek(offsets[start])
+                    if stop is not None:
+                        stop -= start
+                    start = 0
+
+                records = itertools.islice(splitter(handle), start, stop, step)
+
+            for record in records:
+                if splitter is None:
+                    molecule = record
+                else:
+                    molecule = pybel.readstring(fmt, record[1])
+
+                fragment = Fragment(molecule)
+                if zero_to_origin:
+                    fragment.set_zero_to_origin()
+
+                yield fragment
+
+        finally:
+            if opened is not None:
+                opened.close()
+
+    def index_records(self, name, fmt=None):
+        """Find the byte offset where each record of a multi-record file
+        starts, without parsing any molecules. Offsets can be passed to
+        iter_fragments to read any range of records directly.
 
-        N.B.: Currently does not expose the many options provided by rdkit:
+        :param name: file to index
+        :type name : str
+        :param fmt: optional OpenBabel format code e.g. "sdf"
+        :type fmt : str
+        :return: record offsets
+        :rtype : list
+        """
+
+        fmt = _file_format(name, fmt)
+        try:
+            splitter = _record_splitters[fmt]
+        except KeyError:
+            raise ValueError("Record indexing is not supported for format {0}".format(repr(fmt)))
+
+        with open(name, "rb") as handle:
+            offsets = [offset for offset, text in splitter(handle)]
+
+        return offsets
+
+    def mcs_key(self, fragments, options={}):
+        """Make the cache key for an MCS search: the set of canonical SMILES
+        of the fragments plus the search options.
+
+        :param fragments: fragments to search
+        :type fragments : list
+        :param options: additional keyword arguments for FindMCS
+        :type options : dict
+        :return: cache key
+        :rtype : tuple
+        """
+
+        smiles = frozenset([f.smiles.split()[0] for f in fragments])
+        return (smiles, tuple(sorted(options.items())))
+
+    def cached_mcs(self, key, timeout=None):
+        """Get a cached MCS result, if there is one that is at least as good
+        as a search with the given time budget would find.
+
+        :param key: cache key from mcs_key
+        :type key : tuple
+        :param timeout: time budget in seconds, or None for no limit
+        :type timeout : float
+        :return: cached result or None
+        :rtype : MCSMatch
+        """
+
+        entry = _mcs_results.get(key)
+        if entry is None:
+            return None
+
+        result, budget = entry
+        if result.completed:
+            return result
+        elif timeout is not None and budget is not None and timeout <= budget:
+            return result
+
+        return None
+
+    def mcs(self, fragments, timeout=None, options={}):
+        """Find the maximum common substructure from a list of fragments.
+        Fragments are searched as read from their canonical SMILES, so the
+        search sees only what SMILES records (not coordinates or explicit
+        hydrogens). Results are remembered by the set of canonical SMILES
+        searched, so repeating a search (in any order) is free. The result
+        is an MCSMatch rather than the RDKit result object; it has the same
+        attributes and truth value.
+
+        Additional rdkit options can be passed through options, see
         http://www.rdkit.org/Python_Docs/rdkit.Chem.MCS-module.html
 
         Also, SMARTS match naturally includes heavy atoms only.
 
         :param fragments: two or more fragments containing common substructure
         :type fragments : list
+        :param timeout: time budget in seconds, or None for no limit
+        :type timeout : float
+        :param options: additional keyword arguments for FindMCS
+        :type options : dict
         :return: maximum common substructure result
-        :rtype : MCSResult
+        :rtype : MCSMatch
         """
 
-        try:
-            global MCS
-            global rdk
-            MCS
-        except NameError:
-            from rdkit.Chem import MCS
-            from cinfony import rdk
-
-        rf = [rdk.Molecule(f.molecule).Mol for f in fragments]
-        cs = MCS.FindMCS(rf)
-        
-        return cs
+        key = self.mcs_key(fragments, options)
+        result = self.cached_mcs(key, timeout)
+        if result is None:
+            result = _find_mcs(sorted(key[0]), timeout, options)
+            _mcs_results.put(key, (result, timeout))
+
+        return result
+
+    def mcs_pairs(self, fragments, timeout=None, options={}, workers=None):
+        """Find the maximum common substructure of every pair of fragments,
+        spreading the searches across a pool of worker processes. Pairs with
+        the same canonical SMILES are searched only once, and cached results
+        are reused.
+
+        :param fragments: fragments to compare
+        :type fragments : list
+        :param timeout: time budget per search in seconds, or None for no limit
+        :type timeout : float
+        :param options: additional keyword arguments for FindMCS
+        :type options : dict
+        :param workers: number of worker processes (default: CPU count)
+        :type workers : int
+        :return: results keyed by (i, j) fragment index pairs with i < j
+        :rtype : dict
+        """
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        keys = {}
+        for i, j in itertools.combinations(range(len(fragments)), 2):
+            keys[(i, j)] = self.mcs_key([fragments[i], fragments[j]], options)
+
+        found = {}
+        tasks = []
+        for key in set(keys.values()):
+            result = self.cached_mcs(key, timeout)
+            if result is None:
+                tasks.append((key, sorted(key[0]), timeout, options))
+            else:
+                found[key] = result
+
+        if workers <= 1 or len(tasks) < 2:
+            outcomes = [_mcs_worker(t) for t in tasks]
+        else:
+            pool = multiprocessing.Pool(workers)
+            try:
+                outcomes = list(pool.imap_unordered(_mcs_worker, tasks))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+
+        for key, result in outcomes:
+            _mcs_results.put(key, (result, timeout))
+            found[key] = result
+
+        pairs = dict([(pair, found[key]) for pair, key in keys.items()])
+        return pairs
 
     def align(self, reference, target, includeH=True, symmetry=True):
         """Optimize target fragment alignment to reference. Return a copied
@@ -785,12 +4098,85 @@ class Geotool(object):
         :rtype : dict
         """
 
-        copied = copy.deepcopy(target)
+        copied = target.clone()
         aligner = pybel.ob.OBAlign(includeH, symmetry)
         aligner.SetRefMol(reference.molecule.OBMol) 
         aligner.SetTargetMol(copied.molecule.OBMol) 
         aligner.Align() 
         aligner.UpdateCoords(copied.molecule.OBMol)
+        copied._refresh_coordinates()
 
         r = {"rmsd" : aligner.GetRMSD(), "fragment" : copied}
         return r
+
+    def rmsd_matrix(self, fragments, includeH=True, symmetry=False,
+                    workers=None):
+        """Compute RMSD after optimal alignment between every pair of
+        fragments, e.g. to find duplicates in a conformer ensemble.
+
+        If all fragments have the same atoms in the same order and symmetry
+        is False, alignment is done directly on the coordinate arrays.
+        Otherwise each pair goes through OBAlign, as with align().
+
+        :param fragments: fragments to compare
+        :type fragments : list
+        :param includeH: if False, consider only heavy atoms
+        :type includeH : bool
+        :param symmetry: if True, use symmetry axes (see align)
+        :type symmetry : bool
+        :param workers: number of worker processes (default: CPU count)
+        :type workers : int
+        :return: symmetric RMSD matrix, shape (M, M)
+        :rtype : numpy.ndarray
+        """
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        count = len(fragments)
+        matrix = numpy.zeros((count, count))
+        payloads = [(f.atomic_numbers, f.coordinates, f.bonds)
+                    for f in fragments]
+        rows = _run_alignment(payloads, includeH, symmetry, _rmsd_row_worker,
+                              range(count - 1), workers)
+        for i, rmsd in rows:
+            matrix[i, i + 1:] = rmsd
+            matrix[i + 1:, i] = rmsd
+
+        return matrix
+
+    def align_many(self, reference, targets, includeH=True, symmetry=False,
+                   workers=None):
+        """Optimize alignment of many target fragments to one reference. See
+        rmsd_matrix for when OBAlign is used.
+
+        :param reference: the fragment to align to
+        :type reference : Fragment
+        :param targets: the fragments to be aligned
+        :type targets : list
+        :param includeH: if False, consider only heavy atoms
+        :type includeH : bool
+        :param symmetry: if True, use symmetry axes (see align)
+        :type symmetry : bool
+        :param workers: number of worker processes (default: CPU count)
+        :type workers : int
+        :return: aligned fragment and fit data per target, in target order
+        :rtype : list
+        """
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        fragments = [reference] + list(targets)
+        payloads = [(f.atomic_numbers, f.coordinates, f.bonds)
+                    for f in fragments]
+        results = _run_alignment(payloads, includeH, symmetry, _align_worker,
+                                 range(1, len(fragments)), workers)
+
+        alignments = [None] * len(targets)
+        for j, rmsd, coordinates in results:
+            copied = fragments[j].clone()
+            copied.coordinates = coordinates
+            alignments[j - 1] = {"rmsd" : rmsd, "fragment" : copied}
+
+        return alignments
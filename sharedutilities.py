@@ -1,6 +1,12 @@
 # -*- coding:utf-8 mode:python; tab-width:4; indent-tabs-mode:nil; py-indent-offset:4 -*-
+import collections
+import errno
+import hashlib
+import json
+import os
 import subprocess
 import shlex
+import tempfile
 
 ELEMENTS = ["H", "He", "Li", "Be", "B", "C", "N", "O", "F", "Ne",
             "Na", "Mg", "Al", "Si", "P", "S", "Cl", "Ar", "K", "Ca",
@@ -127,3 +133,196 @@ class Utility(object):
         """
 
         return v * 0.52917721092
+
+class LRUCache(object):
+    def __init__(self, max_size=1024):
+        """Create an in-memory mapping that holds at most max_size entries,
+        discarding the least recently used entry when full.
+
+        :param max_size: maximum number of entries
+        :type max_size : int
+        """
+
+        self.max_size = max_size
+        self.data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        """Get a value and mark it as most recently used.
+
+        :param key: entry key
+        :param default: value to return if key is absent
+        :return: stored value or default
+        """
+
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+
+        self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        """Store a value as most recently used, evicting the least recently
+        used entry if the cache is full.
+
+        :param key: entry key
+        :param value: value to store
+        """
+
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries.
+        """
+
+        self.data.clear()
+
+class DiskCache(object):
+    def __init__(self, path, max_bytes=2**30, check_interval=256):
+        """Create a content-addressed cache of JSON-serializable values stored
+        as one file per entry under path. Entries are written to a temporary
+        file and renamed into place, so several processes can share one
+        cache directory without ever reading a partial entry.
+
+        The cache is bounded by total size on disk. Reading an entry
+        refreshes its modification time, and when the cache grows beyond
+        max_bytes the least recently used entries are evicted.
+
+        :param path: cache directory, created if it does not exist
+        :type path : str
+        :param max_bytes: approximate upper bound on total entry size
+        :type max_bytes : int
+        :param check_interval: number of writes between size checks
+        :type check_interval : int
+        """
+
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.writes = 0
+        self._makedirs(self.path)
+
+    def _makedirs(self, dirname):
+        """Create a directory, tolerating another process creating it first.
+
+        :param dirname: directory to create
+        :type dirname : str
+        """
+
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, *parts):
+        """Make a cache key from any JSON-serializable parts.
+
+        :return: hexadecimal digest of the parts
+        :rtype : str
+        """
+
+        encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(encoded).hexdigest()
+
+    def _entry_name(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """Read a cached value, or None if there is no usable entry.
+
+        :param key: cache key from key()
+        :type key : str
+        :return: cached value
+        """
+
+        name = self._entry_name(key)
+        try:
+            with open(name, "rb") as infile:
+                value = json.load(infile)
+        except (IOError, ValueError):
+            return None
+
+        #mark entry as recently used; it may have just been evicted
+        try:
+            os.utime(name, None)
+        except OSError:
+            pass
+
+        return value
+
+    def put(self, key, value):
+        """Store a value under key, replacing any previous entry.
+
+        :param key: cache key from key()
+        :type key : str
+        :param value: JSON-serializable value
+        """
+
+        name = self._entry_name(key)
+        dirname = os.path.dirname(name)
+        self._makedirs(dirname)
+
+        handle, tmpname = tempfile.mkstemp(prefix=".tmp-", dir=dirname)
+        try:
+            with os.fdopen(handle, "wb") as outfile:
+                json.dump(value, outfile, separators=(",", ":"))
+            os.rename(tmpname, name)
+        except:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+
+        self.writes += 1
+        if self.writes % self.check_interval == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is at most 90%
+        of max_bytes. Entries removed concurrently by another process are
+        skipped.
+        """
+
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.startswith(".tmp-"):
+                    continue
+
+                name = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(name)
+                except OSError:
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        target = int(self.max_bytes * 0.9)
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= target:
+                break
+
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+            total -= size
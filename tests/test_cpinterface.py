@@ -9,10 +9,14 @@
     Test chemical program interface code that is not tied to any one specific
     back-end.
 """
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 import cpinterface
 import geoprep
+from adapters import gamess_us, mopac7, pdynamo
 from tests.common_testcode import runSuite
 
 class CPITestCase(unittest.TestCase):
@@ -84,6 +88,102 @@ class CPITestCase(unittest.TestCase):
         for name in ["HYDROGEN", "CARBON", "ARSENIC"]:
             self.assertTrue(name in dzd)
 
+    def test_basis_cache(self):
+        #repeated retrieval is served from memory, and from disk in a fresh
+        #process (simulated by clearing the in-memory cache)
+        methane = self.G.make_fragment("C")
+        methane.set_basis_name("cc-pVDZ")
+        s = geoprep.System([methane])
+        options = {"basis_format" : "nwchem"}
+
+        cachedir = tempfile.mkdtemp()
+        try:
+            cpinterface.set_basis_cache(cachedir)
+            cpinterface._basis_records.clear()
+            bd = self.C.get_basis_data(s, options)
+            self.assertEqual(bd, self.C.get_basis_data(s, options))
+
+            cpinterface._basis_records.clear()
+            cpinterface._basis_libraries.clear()
+            self.assertEqual(bd, self.C.get_basis_data(s, options))
+            self.assertEqual({}, cpinterface._basis_libraries)
+        finally:
+            cpinterface.set_basis_cache(None)
+            shutil.rmtree(cachedir)
+
+    def test_basis_aliases(self):
+        #each (basis, element) pair gets a per-element alias in order of
+        #first appearance
+        lewisite = self.G.make_fragment("Cl[As](Cl)\C=C\Cl")
+        lewisite.set_basis_name("cc-pVDZ")
+        lewisite.set_basis_name("cc-pVTZ", [2])
+
+        s = geoprep.System([lewisite])
+        names, pairs = self.C.basis_aliases(s)
+        self.assertEqual(["Cl0", "As0", "Cl1", "C0", "C0", "Cl0"], names[:6])
+        self.assertEqual(("Cl1", "cc-pVTZ", "Cl"), pairs[2])
+        self.assertEqual(len(set(names)), len(pairs))
+
+    def test_filter_library(self):
+        #element support for every back-end/method/basis combination is
+        #known without preparing any jobs
+        methane = self.G.make_fragment("C")
+        lewisite = self.G.make_fragment("Cl[As](Cl)\C=C\Cl")
+        calculators = [mopac7.Mopac7(), gamess_us.GAMESSUS()]
+        basis_names = ["cc-pVDZ", "TZ (Dunning)"]
+
+        r = cpinterface.filter_library(calculators, [methane, lewisite],
+                                       basis_names)
+        self.assertTrue(("Mopac7", "semiempirical:am1", None) in r[0])
+        self.assertTrue(("GAMESSUS", "hf:rhf", "TZ (Dunning)") in r[0])
+        self.assertTrue(("Mopac7", "semiempirical:pm3", None) in r[1])
+        self.assertFalse(("Mopac7", "semiempirical:am1", None) in r[1])
+        self.assertTrue(("GAMESSUS", "hf:rhf", "cc-pVDZ") in r[1])
+        self.assertFalse(("GAMESSUS", "hf:rhf", "TZ (Dunning)") in r[1])
+
+        #the index agrees with the per-system check
+        s = geoprep.System([lewisite])
+        self.assertRaises(ValueError, calculators[0].check_element_support,
+                          s, "semiempirical:am1")
+
+        #unknown methods fail instead of being treated as supporting every
+        #element; pDynamo lists its methods but leaves elements to pDynamo
+        self.assertRaises(ValueError, calculators[0].method_element_mask,
+                          "semiempirical:pm33")
+        self.assertRaises(ValueError, calculators[0].method_element_mask,
+                          "hf:rhf")
+        r = cpinterface.filter_library([pdynamo.PDynamo()],
+                                       [methane, lewisite])
+        self.assertTrue(("PDynamo", "semiempirical:pddg/pm3", None) in r[0])
+        self.assertTrue(("PDynamo", "semiempirical:am1", None) in r[1])
+        self.assertRaises(ValueError, pdynamo.PDynamo().method_element_mask,
+                          "semiempirical:pm7")
+
+        #methods needing a basis set are not silently left out
+        self.assertRaises(ValueError, cpinterface.filter_library,
+                          calculators, [methane])
+
+    def test_runner_registry(self):
+        #configuration is indexed by host and program, and an override file
+        #takes effect as soon as it appears
+        configdir = tempfile.mkdtemp()
+        try:
+            shutil.copy(os.path.join(cpinterface._here, "config",
+                                     "runners-default.yaml"), configdir)
+            registry = cpinterface.RunnerRegistry(configdir)
+            nwchem = registry.get("localhost", "nwchem")
+            self.assertTrue("{ncores}" in nwchem["cli"])
+            self.assertTrue("localhost" in registry.hosts_for("nwchem"))
+            self.assertEqual(1, registry.capacity("localhost")["mopac7"]["cores"])
+
+            with open(configdir + "/runners.yaml", "w") as outfile:
+                outfile.write("bighost:\n  - program: psi4\n    cores: 32\n    memory: 128GB\n    enabled: y\n    cli: psi4 {input}\n")
+
+            self.assertEqual(["bighost"], registry.hosts_for("psi4", cores=16))
+            self.assertRaises(KeyError, registry.get, "localhost", "nwchem")
+        finally:
+            shutil.rmtree(configdir)
+
 def runTests():
     try:
         test_name = sys.argv[1]
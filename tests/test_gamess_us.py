@@ -42,15 +42,35 @@ class GAMESSTestCase(adapter.AdapterTestCase):
 
         self.assertEqual("error", job.runstate)
 
-    def test_reformat_long_line(self):
+    def test_wrap_tokens(self):
         #verify splitting of long directives so as to comfortably fit within
         #the 80 character per line limit of GAMESS-US
         maxlen = 50
         line = " $BASIS basnam(1)=Cl0, As0, Cl0, C0, C0, Cl0, H0, Cl1 $END"
-        pieces, begin, end = self.C.reformat_long_line(line, " $BASIS", "$END",
-                                                       maxlen=maxlen)
+        pieces = gamess_us.wrap_tokens(line.split(" "), maxlen=maxlen)
         for piece in pieces:
             self.assertTrue(len(piece) <= maxlen)
+        self.assertEqual(line.split(), " ".join(pieces).split())
+
+    def test_namelist(self):
+        #groups are written wrapped within the line limit and read back
+        names = ["H{0}".format(k % 3) for k in range(1000)]
+        basis = gamess_us.Namelist("BASIS", [("basnam(1)", names)])
+        text = basis.write(maxlen=70)
+        for line in text.split("\n"):
+            self.assertTrue(len(line) <= 70)
+        self.assertEqual(names, gamess_us.Namelist.find(text, "BASIS")[0]["basnam(1)"])
+
+        methane = self.G.make_fragment("C")
+        deck = self.C.make_energy_job(methane, "semiempirical:pm3").deck
+        contrl, begin, end = gamess_us.Namelist.find(deck, "CONTRL")
+        self.assertEqual("PM3", gamess_us.Namelist.find(deck, "BASIS")[0]["GBASIS"])
+        self.assertEqual("UNIQUE", contrl["COORD"])
+        self.assertEqual("RHF", contrl["SCFTYP"])
+
+        #an unterminated group is an error, not a parse of the wrong span
+        self.assertRaises(ValueError, gamess_us.Namelist.find,
+                          " $CONTRL SCFTYP=RHF\n $DATA", "CONTRL")
 
     def test_prepare_basis_data(self):
         #test generation of inline basis set data with hydrogen peroxide
@@ -73,6 +93,7 @@ class GAMESSTestCase(adapter.AdapterTestCase):
 
         basis_tags = s.atom_properties(btag)
         self.assertEqual(expected_tags, basis_tags)
+        self.assertTrue(b["basis_control"].startswith(" $BASIS basnam(1)=O0"))
 
     def test_extract_geometry_from_log(self):
         #read/verify geometry from a specific stored RHF water optimization
@@ -10,10 +10,15 @@
 """
 
 import copy
+import cPickle as pickle
 import cStringIO as StringIO
 import random
+import shutil
+import struct
 import sys
+import tempfile
 import unittest
+import numpy
 import geoprep
 from tests.common_testcode import runSuite
 
@@ -148,6 +153,21 @@ class GTestCase(unittest.TestCase):
             for h in hydrogens:
                 self.assertEqual(1, triethylamine.atoms[h].atomicnum)
 
+    def test_selection_cache(self):
+        #repeated selections reuse cached matches but return fresh lists
+        triethylamine = self.G.make_fragment("CCN(CC)CC")
+        m1 = triethylamine.select("[C][C]", hydrogen="include", flatten=False)
+        m2 = triethylamine.select("[C][C]", hydrogen="include", flatten=False)
+        self.assertEqual(m1, m2)
+        m2[0].append(99)
+        self.assertNotEqual(m1, m2)
+        self.assertEqual(m1, triethylamine.select("[C][C]", flatten=False))
+
+        #nitrogen carries no hydrogens; terminal methyl carbons carry three
+        index = triethylamine.hydrogen_index
+        self.assertEqual((), index[2])
+        self.assertEqual([7, 8, 9], sorted(index[0]))
+
     def test_set_basis_name(self):
         #test basis set assignment: assign one basis set for all atoms and
         #then another for ethyl carbons
@@ -210,6 +230,76 @@ class GTestCase(unittest.TestCase):
         props = s.atom_properties("basis_name")
         self.assertEqual(expected, props)
 
+    def test_system_atom_index(self):
+        #test cached system-level offsets, coordinates, and properties, and
+        #their invalidation when fragments change
+        ethane = self.G.make_fragment("CC")
+        water = self.G.make_fragment("O")
+        s = geoprep.System([ethane, water])
+
+        self.assertEqual([0, 8, 11], s.offsets)
+        self.assertEqual(11, len(s.atoms))
+        self.assertEqual(water.geometry_list[2][1:],
+                         s.coordinates[10].tolist())
+
+        water.translate([0.0, 0.0, 2.5])
+        self.assertEqual(water.geometry_list[2][1:],
+                         s.coordinates[10].tolist())
+
+        self.assertEqual([None] * 11, s.atom_properties("basis_name"))
+        water.set_basis_name("cc-pVDZ")
+        self.assertEqual([None] * 8 + ["cc-pVDZ"] * 3,
+                         s.atom_properties("basis_name"))
+
+        s.fragments.append(water)
+        self.assertEqual([0, 8, 11, 14], s.offsets)
+        self.assertEqual(14, len(s.atom_properties("symbols")))
+
+    def test_neighbor_index(self):
+        #distance queries over a row of waters follow fragment moves
+        waters = [self.G.make_fragment("O") for k in range(5)]
+        for k, w in enumerate(waters):
+            w.translate([10.0 * k, 0.0, 0.0])
+        s = geoprep.System(waters)
+
+        self.assertEqual([0, 1, 2], s.select_within([0], 1.5))
+        self.assertEqual([0], s.fragments_within([0], 5.0))
+        self.assertEqual([3], s.select_nearest([10.0, 0.0, 0.0], 1))
+
+        #queries far outside the occupied cells, or with very large radii,
+        #stay bounded by the cells that hold atoms
+        self.assertTrue(s.select_nearest([5000.0, 0.0, 0.0], 1)[0] in [12, 13, 14])
+        self.assertEqual(range(15), s.select_within([0], 1000.0))
+
+        waters[4].translate([-37.0, 0.0, 0.0])
+        self.assertEqual([0, 4], s.fragments_within([0], 5.0))
+        self.assertTrue(12 in s.select_within([0], 3.5))
+
+    def test_system_write(self):
+        #test writing a multi-fragment system through the merged molecule:
+        #atoms, coordinates, and bonds of all fragments are carried over
+        ethane = self.G.make_fragment("CC")
+        water = self.G.make_fragment("O")
+        water.translate([0.0, 0.0, 4.0])
+        s = geoprep.System([ethane, water], title="ethane and water")
+
+        merged = s.merged_molecule
+        self.assertEqual(11, len(merged.atoms))
+        self.assertEqual(len(ethane.bonds) + len(water.bonds),
+                         merged.OBMol.NumBonds())
+
+        sio = StringIO.StringIO(s.write("xyz"))
+        reread = self.G.read_fragment(fmt="xyz", handle=sio,
+                                      zero_to_origin=False)
+        sio.close()
+        for j, entry in enumerate(reread.geometry_list):
+            for k in (1, 2, 3):
+                self.assertAlmostEqual(s.coordinates[j][k - 1], entry[k], 4)
+
+        #moving a fragment rebuilds the merged molecule
+        water.translate([0.0, 0.0, 1.0])
+        self.assertIsNot(merged, s.merged_molecule)
+
     def test_system_select(self):
         #test selector operating across all fragments in system
 
@@ -244,6 +334,33 @@ class GTestCase(unittest.TestCase):
             read_fragment = self.G.read_fragment(name)
             self.assertSameGeometry(methanol, read_fragment, 0.001)
 
+    def test_iter_fragments(self):
+        #stream every record of a multi-frame XYZ file, with slicing and
+        #direct access through record offsets
+        frames = []
+        for name in ["ethane-staggered", "methanol1", "ethane-eclipsed"]:
+            with open("tests/data/{0}.xyz".format(name)) as infile:
+                frames.append(infile.read().strip() + "\n")
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            name = tmpdir + "/frames.xyz"
+            with open(name, "w") as outfile:
+                outfile.write("".join(frames))
+
+            fragments = list(self.G.iter_fragments(name))
+            self.assertEqual([8, 6, 8], [f.natoms for f in fragments])
+            self.assertEqual(fragments[0], self.G.read_fragment(name))
+
+            offsets = self.G.index_records(name)
+            self.assertEqual(3, len(offsets))
+            tail = list(self.G.iter_fragments(name, start=1, offsets=offsets))
+            self.assertEqual(fragments[1:], tail)
+            stepped = list(self.G.iter_fragments(name, step=2))
+            self.assertEqual([fragments[0], fragments[2]], stepped)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_mcs_basic(self):
         #test maximum common substructure search across identical molecules
 
@@ -266,6 +383,26 @@ class GTestCase(unittest.TestCase):
             v = expected[k]
             self.assertEqual(v, getattr(ss, k))
 
+        #results have the RDKit result's attributes and truth value
+        self.assertTrue(isinstance(ss, geoprep.MCSMatch))
+        self.assertTrue(ss)
+        self.assertTrue(ss.completed)
+
+    def test_mcs_pairs(self):
+        #pairwise maximum common substructure over a small library; results
+        #are cached by canonical SMILES set regardless of order
+        fragments = [self.G.make_fragment(s) for s in ["CCO", "CCN", "OCC"]]
+        pairs = self.G.mcs_pairs(fragments, timeout=10, workers=2)
+        self.assertEqual([(0, 1), (0, 2), (1, 2)], sorted(pairs))
+        self.assertEqual(2, pairs[(0, 1)].numAtoms)
+        self.assertEqual(3, pairs[(0, 2)].numAtoms)
+        self.assertEqual(pairs[(0, 1)], pairs[(1, 2)])
+
+        key = self.G.mcs_key([fragments[1], fragments[0]])
+        self.assertEqual(pairs[(0, 1)], self.G.cached_mcs(key))
+        self.assertEqual(pairs[(0, 1)],
+                         self.G.mcs([fragments[1], fragments[2]]))
+
     def test_align_basic(self):
         #test easiest case for molecule alignment: molecules the very same
         
@@ -312,6 +449,39 @@ class GTestCase(unittest.TestCase):
         alignment = self.G.align(methanol, scrambled, symmetry=False)
         self.assertTrue(alignment["rmsd"] < 10**-5)
 
+    def test_rmsd_matrix(self):
+        #batch alignment of conformers with identical atom order agrees with
+        #pairwise OBAlign
+        ethane1 = self.G.read_fragment("tests/data/ethane-staggered.xyz")
+        ethane2 = self.G.read_fragment("tests/data/ethane-eclipsed.xyz")
+        rotated = ethane1.clone()
+        rotated.rotate([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+        fragments = [ethane1, ethane2, rotated]
+
+        matrix = self.G.rmsd_matrix(fragments, workers=2)
+        self.assertEqual((3, 3), matrix.shape)
+        self.assertTrue(matrix[0, 2] < 10**-5)
+        pairwise = self.G.align(ethane1, ethane2, symmetry=False)
+        self.assertAlmostEqual(pairwise["rmsd"], matrix[0, 1], places=4)
+        self.assertTrue((matrix == matrix.T).all())
+
+        heavy = self.G.rmsd_matrix(fragments, includeH=False, symmetry=True,
+                                   workers=1)
+        self.assertTrue(heavy.max() < 0.0001)
+
+        alignments = self.G.align_many(ethane1, [rotated, ethane2], workers=1)
+        self.assertTrue(alignments[0]["rmsd"] < 10**-5)
+        self.assertTrue(numpy.allclose(ethane1.coordinates,
+                                       alignments[0]["fragment"].coordinates))
+        self.assertAlmostEqual(matrix[0, 1], alignments[1]["rmsd"], places=4)
+
+    def test_rmsd_matrix_empty(self):
+        #no fragments or no targets give empty results without any workers
+        ethane = self.G.read_fragment("tests/data/ethane-staggered.xyz")
+        self.assertEqual((0, 0), self.G.rmsd_matrix([]).shape)
+        self.assertEqual((1, 1), self.G.rmsd_matrix([ethane]).shape)
+        self.assertEqual([], self.G.align_many(ethane, [], workers=4))
+
     def test_align_unequal_geometry(self):
         #test molecule alignment: atom order is different, geometry slightly
         #different, rotation is different
@@ -321,6 +491,83 @@ class GTestCase(unittest.TestCase):
         alignment = self.G.align(methanol1, methanol2)
         self.assertTrue(alignment["rmsd"] < 0.95)
 
+    def test_embedding_cache(self):
+        #test reuse of cached 3D embeddings: a second Geotool sharing the
+        #cache directory gets the identical geometry without re-embedding
+        cache_dir = tempfile.mkdtemp()
+        try:
+            G1 = geoprep.Geotool(embedding_cache=cache_dir)
+            G2 = geoprep.Geotool(embedding_cache=cache_dir)
+            key = G1.embedding_key("CC(=O)O", "smiles")
+
+            self.assertEqual(None, G1.embedding_cache.get(key))
+            acetic1 = G1.make_fragment("CC(=O)O")
+            self.assertNotEqual(None, G1.embedding_cache.get(key))
+            acetic2 = G2.make_fragment("CC(=O)O")
+
+            self.assertEqual(acetic1.geometry_list, acetic2.geometry_list)
+            self.assertEqual(acetic1.smiles, acetic2.smiles)
+            self.assertEqual(3, acetic2.dim)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_make_fragments(self):
+        #test batch fragment construction across worker processes, in input
+        #order and in completion order, with per-item error capture
+        items = ["C", "CO", "not-a-smiles", "CCO", "O"]
+
+        results = list(self.G.make_fragments(items, workers=2, max_pending=2))
+        self.assertEqual(range(len(items)), [r["index"] for r in results])
+        for r in results:
+            if r["input"] == "not-a-smiles":
+                self.assertEqual(None, r["fragment"])
+                self.assertNotEqual(None, r["error"])
+            else:
+                expected = self.G.make_fragment(r["input"])
+                self.assertEqual(None, r["error"])
+                self.assertEqual(expected.geometry_list,
+                                 r["fragment"].geometry_list)
+
+        unordered = self.G.make_fragments(items, workers=2, ordered=False)
+        indexes = sorted([r["index"] for r in unordered])
+        self.assertEqual(range(len(items)), indexes)
+
+    def test_make_conformers(self):
+        #conformer ensemble is sorted by energy, within the energy window,
+        #and free of near-duplicates
+        r = self.G.make_conformers("CCCCO", n=12, energy_window=20.0,
+                                   rmsd_threshold=0.3, workers=2)
+        coordinates = r["coordinates"]
+        energies = r["energies"]
+        natoms = r["fragment"].natoms
+        self.assertEqual((len(energies), natoms, 3), coordinates.shape)
+        self.assertEqual(sorted(energies), list(energies))
+        self.assertTrue(energies[-1] - energies[0] <= 20.0)
+        self.assertTrue(numpy.allclose(coordinates[0],
+                                       r["fragment"].coordinates))
+
+        heavy = r["fragment"].atomic_numbers != 1
+        for k in range(1, len(energies)):
+            rmsd = geoprep._kabsch(coordinates[k][heavy],
+                                   coordinates[:k, heavy])[0]
+            self.assertTrue(rmsd.min() >= 0.3)
+
+        #duplicates are found whatever their energy difference, and a lower
+        #energy duplicate replaces the kept conformer
+        ensemble = geoprep.ConformerEnsemble(energy_window=20.0,
+                                             rmsd_threshold=0.3)
+        self.assertTrue(ensemble.add(energies[0] + 5.0, coordinates[0]))
+        self.assertFalse(ensemble.add(energies[0] + 8.0, coordinates[0]))
+        self.assertTrue(ensemble.add(energies[0], coordinates[0]))
+        self.assertEqual([energies[0]], list(ensemble.energies))
+
+        #the embedded geometry seeds the ensemble, so even a zero energy
+        #window leaves one conformer; no candidates at all is an error
+        r = self.G.make_conformers("CCCCO", n=1, energy_window=0.0,
+                                   workers=1)
+        self.assertTrue(len(r["energies"]) >= 1)
+        self.assertRaises(ValueError, self.G.make_conformers, "CCCCO", n=0)
+
     def test_geolist_to_fragment(self):
         #test creation of new fragment from geometry list: geometry lists
         #should match exactly across fragments
@@ -329,6 +576,53 @@ class GTestCase(unittest.TestCase):
         fcopy = self.G.geolist_to_fragment(methanol.geometry_list)
         self.assertEqual(methanol.geometry_list, fcopy.geometry_list)
 
+    def test_properties_follow_atoms(self):
+        #removing or adding hydrogens keeps properties on the atoms they
+        #were set for, even when hydrogens come before heavy atoms
+        water = self.G.geolist_to_fragment([["H", 0.757, 0.586, 0.0],
+                                            ["O", 0.0, 0.0, 0.0],
+                                            ["H", -0.757, 0.586, 0.0]])
+        water.set_properties("basis_name", [0, 1, 2],
+                             ["H-first", "O-basis", "H-last"])
+        water.removeh()
+        self.assertEqual(["O-basis"], water.atom_properties["basis_name"])
+        self.assertEqual(["O"], water.atom_properties["symbols"])
+
+        water.addh()
+        self.assertEqual(["O-basis", None, None],
+                         water.atom_properties["basis_name"])
+        self.assertEqual(["O", "H", "H"], water.atom_properties["symbols"])
+
+    def test_geolists_to_fragments(self):
+        #bulk conversion of a trajectory built directly from arrays
+        ethane1 = self.G.read_fragment("tests/data/ethane-staggered.xyz")
+        ethane2 = self.G.read_fragment("tests/data/ethane-eclipsed.xyz")
+        history = [ethane1.geometry_list, ethane2.geometry_list]
+        fragments = self.G.geolists_to_fragments(history)
+
+        self.assertEqual(history, [f.geometry_list for f in fragments])
+        self.assertEqual(ethane1.bonds, fragments[1].bonds)
+
+        direct = self.G.array_to_fragment(ethane1.atomic_numbers,
+                                          ethane1.coordinates)
+        self.assertEqual(ethane1.geometry_list, direct.geometry_list)
+        self.assertEqual(ethane1.smiles, direct.smiles)
+        self.assertRaises(ValueError, self.G.array_to_fragment, ["Xx"],
+                          [[0.0, 0.0, 0.0]])
+
+    def test_lazy_fragment_values(self):
+        #derived values are computed on first access; an explicit title
+        #takes precedence over the generated one
+        ethanol = self.G.make_fragment("CCO")
+        self.assertEqual(None, ethanol._smiles)
+        self.assertEqual(["C", "C", "O"], ethanol.atom_properties["symbols"][:3])
+        self.assertTrue(ethanol.smiles in ethanol.title)
+        self.assertEqual(26, ethanol.nelec)
+        self.assertEqual(0, ethanol.charge)
+
+        ethanol.title = "ethanol"
+        self.assertEqual("ethanol", ethanol.title)
+
     def test_deepcopy_fragment(self):
         #validate that deep copying duplicates a fragment and leaves the
         #duplicate independent of the original
@@ -345,6 +639,224 @@ class GTestCase(unittest.TestCase):
         self.assertTrue(methanol != copied)
         self.assertNotEqual(methanol.atom_properties, copied.atom_properties)
 
+    def test_property_columns(self):
+        #atom properties are stored by type but read back as plain lists
+        s = self.G.make_system(["CO", "O"])
+        methanol = s.fragments[0]
+        methanol.set_basis_name("cc-pVDZ")
+        methanol.set_properties("charge", [0, 1], [-0.25, 0.5])
+        table = methanol.atom_properties
+        self.assertEqual("category", table.columns["basis_name"].kind)
+        self.assertEqual("numeric", table.columns["charge"].kind)
+        self.assertEqual([-0.25, 0.5] + [None] * 4, table["charge"])
+
+        #bulk assignment through an index array
+        s.set_properties("basis_name", numpy.arange(6, 9), "6-31G")
+        expected = ["cc-pVDZ"] * 6 + ["6-31G"] * 3
+        self.assertEqual(expected, s.atom_properties("basis_name"))
+        self.assertEqual(["C", "O"] + ["H"] * 4 + ["O", "H", "H"],
+                         s.atom_properties("symbols"))
+
+        #mixing bools, ints, and floats keeps every value's own type
+        methanol.set_properties("flag", [0, 1], [True, False])
+        methanol.set_properties("flag", [2], [1])
+        methanol.set_properties("count", [0], [3])
+        methanol.set_properties("count", [1], [0.5])
+        flags = table["flag"]
+        self.assertEqual("object", table.columns["flag"].kind)
+        self.assertEqual([bool, bool, int], [type(f) for f in flags[:3]])
+        self.assertEqual([int, float],
+                         [type(c) for c in table["count"][:2]])
+
+        #lists handed out are copies, not the cached values
+        names = s.atom_properties("basis_name")
+        names[0] = "STO-3G"
+        self.assertEqual("cc-pVDZ", s.atom_properties("basis_name")[0])
+        charges = table["charge"]
+        charges[0] = 1.0
+        self.assertEqual(-0.25, table["charge"][0])
+
+    def test_basis_rules(self):
+        #element, SMARTS, and distance rules applied in one pass; later
+        #rules override earlier ones
+        s = self.G.make_system(["CO", "N"])
+        s.fragments[1].translate([20.0, 0.0, 0.0])
+        rules = geoprep.BasisRules([("element", "H", "6-31G"),
+                                    ("smarts", "[#8]", "6-31+G*"),
+                                    ("distance", "[#7]", 1.2, "cc-pVDZ")],
+                                   default="STO-3G")
+        rules.apply(s)
+        expected = ["STO-3G", "6-31+G*"] + ["6-31G"] * 4 + ["cc-pVDZ"] * 4
+        self.assertEqual(expected, s.atom_properties("basis_name"))
+
+        #SMARTS rules take attached hydrogens only when the pattern says so
+        hydroxyl = s.fragments[0].select("[#8][#1]", hydrogen="exclude")
+        rules.add_smarts("[#8][#1]", "6-31++G**")
+        rules.apply(s)
+        names = s.atom_properties("basis_name")
+        self.assertEqual(["6-31++G**"] * 2, [names[j] for j in hydroxyl])
+        methyl_hydrogens = [j for j in range(2, 6) if j not in hydroxyl]
+        self.assertEqual(["6-31G"] * 3, [names[j] for j in methyl_hydrogens])
+
+        #compiled rules are shared between equal rule tables
+        same = geoprep.BasisRules(rules.rules, default="STO-3G")
+        self.assertTrue(rules.compile() is same.compile())
+
+        self.assertRaises(ValueError, geoprep.BasisRules([("element", "Xx", "6-31G")]).compile)
+
+    def test_geometry_hash(self):
+        #content hash follows geometry, spin, and properties, and is the same
+        #for a system however its atoms are divided into fragments
+        methanol = self.G.make_fragment("CO")
+        cloned = methanol.clone()
+        h = methanol.geometry_hash()
+        self.assertEqual(h, cloned.geometry_hash())
+
+        #round trip leaves only floating point noise, well under tolerance
+        cloned.translate([0.0, 0.0, 0.001])
+        self.assertNotEqual(h, cloned.geometry_hash())
+        cloned.translate([0.0, 0.0, -0.001])
+        self.assertEqual(h, cloned.geometry_hash())
+
+        cloned.spin = 3
+        self.assertNotEqual(h, cloned.geometry_hash())
+        cloned.spin = 1
+        self.assertEqual(h, cloned.geometry_hash())
+
+        cloned.set_basis_name("cc-pVDZ")
+        self.assertNotEqual(h, cloned.geometry_hash())
+
+        water = self.G.make_fragment("O")
+        water.translate([5.0, 0.0, 0.0])
+        s1 = geoprep.System([methanol, water])
+        s2 = geoprep.System([water, methanol])
+        self.assertEqual(s1.geometry_hash(), s2.geometry_hash())
+        s2.set_properties("basis_name", [0], ["6-31G"])
+        self.assertNotEqual(s1.geometry_hash(), s2.geometry_hash())
+
+        #equality stays exact: the same hash is not enough
+        shifted = methanol.clone()
+        shifted.translate([0.0, 0.0, 0.000001])
+        self.assertNotEqual(methanol, shifted)
+        elements = methanol.atom_properties["symbols"]
+        order = range(2, methanol.natoms) + [0, 1]
+        reordered = self.G.array_to_fragment([elements[k] for k in order],
+                                             methanol.coordinates[order])
+        self.assertEqual(h, reordered.geometry_hash())
+        self.assertNotEqual(methanol, reordered)
+
+    def test_serialization(self):
+        #binary round trip of fragments and systems, directly, through
+        #pickle, and through shared memory
+        methanol = self.G.make_fragment("CO")
+        methanol.set_basis_name("cc-pVDZ")
+        methanol.set_properties("charge", [0, 1], [-0.5, 0.25])
+        methanol.title = "methanol"
+        acetate = self.G.make_fragment("CC(=O)[O-]")
+        s = geoprep.System([methanol, acetate], spin=1, title="pair")
+        s.set_properties("basis_name", [7], ["6-31+G*"])
+
+        restored = geoprep.from_bytes(methanol.to_bytes())
+        self.assertEqual(methanol, restored)
+        self.assertTrue(numpy.array_equal(methanol.coordinates,
+                                          restored.coordinates))
+        self.assertEqual(methanol.atom_properties["charge"],
+                         restored.atom_properties["charge"])
+
+        self.assertEqual(methanol, pickle.loads(pickle.dumps(methanol, 2)))
+
+        #arrays are read-only views of the buffer until changed
+        data = methanol.to_bytes()
+        restored = geoprep.from_bytes(data)
+        raw = numpy.frombuffer(data, dtype=numpy.uint8)
+        self.assertTrue(numpy.may_share_memory(restored.coordinates, raw))
+        self.assertFalse(restored.coordinates.flags.writeable)
+        restored.set_properties("charge", [0], [0.75])
+        self.assertEqual(0.75, restored.atom_properties["charge"][0])
+        self.assertEqual(-0.5, methanol.atom_properties["charge"][0])
+
+        shared = geoprep.to_shared(s)
+        rs = geoprep.from_bytes(shared)
+        self.assertEqual(s.geometry_hash(), rs.geometry_hash())
+        self.assertEqual("pair", rs.title)
+        self.assertEqual(-1, rs.charge)
+        self.assertEqual(s.atom_properties("basis_name"),
+                         rs.atom_properties("basis_name"))
+
+        self.assertRaises(ValueError, geoprep.from_bytes, "not geoprep data")
+
+        #header is magic, version, kind: unknown versions and kinds fail
+        #rather than being decoded as something else
+        data = methanol.to_bytes()
+        bad_version = data[:4] + struct.pack("<H", 99) + data[6:]
+        bad_kind = data[:6] + struct.pack("<H", 7) + data[8:]
+        self.assertRaises(ValueError, geoprep.from_bytes, bad_version)
+        self.assertRaises(ValueError, geoprep.from_bytes, bad_kind)
+
+    def test_flyweight_instances(self):
+        #repeated molecules share one template and only get their own OBMol
+        #when something needs it
+        s = self.G.make_system(["O"] * 5 + ["CO"], share_identical=True)
+        waters = s.fragments[:5]
+        for k, water in enumerate(waters):
+            water.translate([3.0 * k, 0.0, 0.0])
+
+        template = waters[1]._template
+        self.assertTrue(template is not None)
+        for water in waters[2:]:
+            self.assertTrue(water._template is template)
+            self.assertTrue(water._molecule is None)
+
+        self.assertEqual(waters[0].smiles, waters[4].smiles)
+        self.assertEqual(waters[0].bonds, waters[4].bonds)
+        self.assertNotEqual(waters[0].geometry_hash(),
+                            waters[4].geometry_hash())
+
+        rs = geoprep.from_bytes(s.to_bytes())
+        self.assertEqual(s.geometry_hash(), rs.geometry_hash())
+        self.assertTrue(waters[4]._molecule is None)
+
+        #systems write from arrays, but pybel access makes a real molecule
+        #with the instance geometry
+        s.write("xyz")
+        self.assertTrue(waters[4]._molecule is None)
+        waters[4].write("xyz")
+        self.assertTrue(waters[4]._molecule is not None)
+        self.assertTrue(numpy.allclose(waters[4].molecule.atoms[0].coords,
+                                       waters[4].coordinates[0]))
+
+        #sharing is opt-in
+        plain = self.G.make_system(["O"] * 2)
+        self.assertTrue(plain.fragments[1]._template is None)
+        self.assertTrue(plain.fragments[1]._molecule is not None)
+
+        waters[3].set_basis_name("cc-pVDZ")
+        self.assertEqual(["cc-pVDZ"] * 3, waters[3].atom_properties["basis_name"])
+        self.assertNotEqual(["cc-pVDZ"] * 3, waters[2].atom_properties["basis_name"])
+
+    def test_clone_copy_on_write(self):
+        #clones share property lists until one side writes to them, and
+        #keep exact coordinates independent of the original
+        methanol = self.G.make_fragment("CO")
+        methanol.set_basis_name("cc-pVDZ")
+        cloned = methanol.clone()
+
+        self.assertEqual(methanol.geometry_list, cloned.geometry_list)
+        self.assertTrue(methanol.atom_properties.columns["basis_name"] is
+                        cloned.atom_properties.columns["basis_name"])
+
+        cloned.set_basis_name("cc-pVTZ", selection=[0])
+        self.assertEqual("cc-pVDZ", methanol.atom_properties["basis_name"][0])
+        self.assertEqual("cc-pVTZ", cloned.atom_properties["basis_name"][0])
+
+        methanol.set_basis_name("6-31G", selection=[1])
+        self.assertEqual("cc-pVDZ", cloned.atom_properties["basis_name"][1])
+
+        cloned.translate([1.0, 0.0, 0.0])
+        self.assertNotEqual(methanol.geometry_list, cloned.geometry_list)
+        self.assertEqual(methanol.atoms[0].coords[1:],
+                         cloned.atoms[0].coords[1:])
+
     def test_translate(self):
         #test fragment geometry translation
         tvec = [1.5, 0.0, 0.0]
@@ -357,6 +869,26 @@ class GTestCase(unittest.TestCase):
             for k in (1, 2, 3):
                 self.assertEqual(g1[j][k] + tvec[k - 1], g2[j][k])
 
+    def test_rotate(self):
+        #test fragment rotation: a half turn about z twice restores geometry,
+        #and the underlying molecule follows the coordinate array
+        half_turn = [[-1.0, 0.0, 0.0], [0.0, -1.0, 0.0], [0.0, 0.0, 1.0]]
+        methanol = self.G.make_fragment("CO")
+        g1 = methanol.geometry_list
+        methanol.rotate(half_turn, center=[1.0, 2.0, 3.0])
+        g2 = methanol.geometry_list
+
+        for j in range(len(g1)):
+            self.assertAlmostEqual(2.0 - g1[j][1], g2[j][1])
+            self.assertAlmostEqual(4.0 - g1[j][2], g2[j][2])
+            self.assertAlmostEqual(g1[j][3], g2[j][3])
+            self.assertEqual(list(methanol.atoms[j].coords), g2[j][1:])
+
+        methanol.rotate(half_turn, center=[1.0, 2.0, 3.0])
+        for j in range(len(g1)):
+            for k in (1, 2, 3):
+                self.assertAlmostEqual(g1[j][k], methanol.geometry_list[j][k])
+
 def runTests():
     try:
         test_name = sys.argv[1]